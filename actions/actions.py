@@ -44,6 +44,7 @@ from utils import (
     pause_unit,
     resume_unit,
 )
+import stonith
 
 
 def pause(args):
@@ -97,8 +98,36 @@ def cleanup(args):
                     "'{}'".format(resource_name))
 
 
+def check_stonith(args):
+    """Probe the power interface of every configured fencing device.
+    Results are also cached for the unit status."""
+    try:
+        results = stonith.check_fencing_devices(force=True)
+    except subprocess.CalledProcessError as e:
+        log("ERROR: Failed to list fencing devices. "
+            "output: {}. return-code: {}".format(e.output, e.returncode))
+        log(traceback.format_exc())
+        action_set({'result': 'failure'})
+        action_fail("failed to list fencing devices")
+        return
+
+    lines = []
+    for node in sorted(results):
+        res = results[node]
+        lines.append('{}: {} ({}) {}'.format(
+            node, 'OK' if res['healthy'] else 'FAILED', res['resource'],
+            res['message']))
+    dead = stonith.unhealthy_nodes(results)
+    action_set({'result': 'failure' if dead else 'success',
+                'output': '\n'.join(lines)})
+    if dead:
+        action_fail("fencing device not answering for: "
+                    "{}".format(', '.join(dead)))
+
+
 ACTIONS = {"pause": pause, "resume": resume,
-           "status": status, "cleanup": cleanup}
+           "status": status, "cleanup": cleanup,
+           "check-stonith": check_stonith}
 
 
 def main(args):
@@ -0,0 +1 @@
+../../hooks/cluster_state.py
\ No newline at end of file
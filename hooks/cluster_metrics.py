@@ -0,0 +1,214 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus metrics for the node_exporter textfile collector.
+
+The metrics are rendered from the cluster state snapshot taken by the
+cluster_state collector plus one read of the corosync cmap, so exporting
+them costs no extra crm_mon run. Migrations and DC changes are counted by
+comparing each snapshot with the previous one; those counters live in
+COUNTERS_FILE and start again from zero if it is lost, which prometheus'
+rate() and increase() handle as a counter reset.
+
+NOTE: like cluster_state, this module only depends on the python standard
+library, it runs from cron outside of the hook environment.
+"""
+
+import json
+import re
+import subprocess
+
+import cluster_state
+
+CMAPCTL_CMD = ['corosync-cmapctl']
+COUNTERS_FILE = '/var/lib/hacluster/metrics-counters.json'
+TEXTFILE_NAME = 'hacluster.prom'
+
+# cmap key -> (metric, type, help)
+TOTEM_COUNTERS = {
+    'runtime.totem.pg.mrp.srp.operational_entered': (
+        'hacluster_totem_membership_transitions_total', 'counter',
+        'Times the totem protocol entered the operational state, i.e. '
+        'membership transitions seen by this node'),
+    'runtime.totem.pg.mrp.srp.mcast_retx': (
+        'hacluster_totem_retransmits_total', 'counter',
+        'Totem messages retransmitted by this node'),
+    'runtime.totem.pg.mrp.srp.consensus_timeouts': (
+        'hacluster_totem_consensus_timeouts_total', 'counter',
+        'Totem consensus timeouts seen by this node'),
+}
+
+
+def parse_cmapctl(output):
+    """Parse the output of `corosync-cmapctl`
+
+    :param output: string with lines like "key (type) = value"
+    :returns: dict of key -> value, numeric values are converted to int
+    :rtype: dict
+    """
+    cmap = {}
+    for line in output.splitlines():
+        match = re.match(r'(\S+) \((\w+)\) = (.*)$', line.strip())
+        if not match:
+            continue
+        key, _type, value = match.groups()
+        if _type.startswith(('u', 'i')) and value.lstrip('-').isdigit():
+            value = int(value)
+        cmap[key] = value
+    return cmap
+
+
+def query_cmap():
+    """Return the parsed corosync cmap"""
+    return parse_cmapctl(cluster_state._run(CMAPCTL_CMD))
+
+
+def quorum_votes(cmap):
+    """Return the votes of each node and the expected votes from the cmap
+
+    :returns: tuple of (dict of node name -> votes, expected votes)
+    """
+    votes = {}
+    for key, value in cmap.items():
+        match = re.match(r'nodelist\.node\.(\d+)\.ring0_addr$', key)
+        if match:
+            prefix = 'nodelist.node.{}.'.format(match.group(1))
+            name = cmap.get(prefix + 'name', value)
+            votes[name] = cmap.get(prefix + 'quorum_votes', 1)
+    expected = cmap.get('quorum.expected_votes', sum(votes.values()))
+    return votes, expected
+
+
+def update_counters(counters, snapshot):
+    """Count the migrations and DC changes since the previous snapshot
+
+    A resource migrated when it runs on a different set of nodes than it
+    did the last time it was seen running.
+
+    :param counters: counters returned for the previous snapshot
+    :param snapshot: current cluster state snapshot
+    :returns: updated counters
+    :rtype: dict
+    """
+    counters = {'dc': counters.get('dc'),
+                'dc_changes': counters.get('dc_changes', 0),
+                'locations': dict(counters.get('locations', {})),
+                'migrations': dict(counters.get('migrations', {}))}
+
+    dc = snapshot['crm_mon']['summary']['dc']
+    if dc and counters['dc'] and dc != counters['dc']:
+        counters['dc_changes'] += 1
+    if dc:
+        counters['dc'] = dc
+
+    for name, rsc in snapshot['crm_mon']['resources'].items():
+        nodes = sorted(rsc['nodes'])
+        if not nodes:
+            continue
+        previous = counters['locations'].get(name)
+        if previous is not None and previous != nodes:
+            counters['migrations'][name] = (
+                counters['migrations'].get(name, 0) + 1)
+        counters['migrations'].setdefault(name, 0)
+        counters['locations'][name] = nodes
+
+    return counters
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def render_metrics(snapshot, cmap, counters):
+    """Render the metrics in the prometheus text exposition format
+
+    :param snapshot: cluster state snapshot, see cluster_state.collect
+    :param cmap: parsed corosync cmap, see parse_cmapctl
+    :param counters: counters returned by update_counters
+    :returns: string with the metrics
+    """
+    metrics = []
+
+    def add(name, _type, _help, samples):
+        metrics.append('# HELP {} {}'.format(name, _help))
+        metrics.append('# TYPE {} {}'.format(name, _type))
+        for labels, value in samples:
+            metrics.append('{}{} {}'.format(name, labels, value))
+
+    state = snapshot['crm_mon']
+    add('hacluster_collector_timestamp_seconds', 'gauge',
+        'When the cluster state was collected',
+        [('', snapshot['timestamp'])])
+    add('hacluster_quorate', 'gauge', 'Whether the cluster has quorum',
+        [('', int(state['summary']['quorum']))])
+    votes, expected = quorum_votes(cmap)
+    add('hacluster_quorum_votes', 'gauge', 'Quorum votes of each node',
+        [(_labels(node=n), v) for n, v in sorted(votes.items())])
+    add('hacluster_quorum_expected_votes', 'gauge',
+        'Votes expected by the quorum service', [('', expected)])
+    add('hacluster_node_online', 'gauge', 'Whether the node is online',
+        [(_labels(node=n), int(v['online']))
+         for n, v in sorted(state['nodes'].items())])
+    add('hacluster_node_standby', 'gauge', 'Whether the node is in standby',
+        [(_labels(node=n), int(v['standby']))
+         for n, v in sorted(state['nodes'].items())])
+    add('hacluster_dc_changes_total', 'counter',
+        'Designated controller changes seen by the collector',
+        [('', counters['dc_changes'])])
+    add('hacluster_resource_fail_count', 'gauge',
+        'Resource fail count on each node',
+        [(_labels(resource=r, node=n), c)
+         for r, counts in sorted(state['fail_counts'].items())
+         for n, c in sorted(counts.items())])
+    add('hacluster_failed_actions', 'gauge',
+        'Failed resource actions not cleaned up',
+        [('', len(state['failed_actions']))])
+    add('hacluster_resource_migrations_total', 'counter',
+        'Resource location changes seen by the collector',
+        [(_labels(resource=r), c)
+         for r, c in sorted(counters['migrations'].items())])
+    add('hacluster_ring_faulty', 'gauge',
+        'Whether the corosync ring is marked faulty on this node',
+        [(_labels(ring=r['ring']), int(r['faulty']))
+         for r in snapshot['rings']])
+    for key, (name, _type, _help) in sorted(TOTEM_COUNTERS.items()):
+        if key in cmap:
+            add(name, _type, _help, [('', cmap[key])])
+
+    return '\n'.join(metrics) + '\n'
+
+
+def _load_counters(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export(snapshot, textfile, counters_file=COUNTERS_FILE):
+    """Write the metrics for snapshot to textfile
+
+    :param snapshot: cluster state snapshot, see cluster_state.collect
+    :param textfile: path of the file read by node_exporter
+    """
+    try:
+        cmap = query_cmap()
+    except (subprocess.CalledProcessError, OSError):
+        cmap = {}
+    counters = update_counters(_load_counters(counters_file), snapshot)
+    cluster_state.atomic_write(counters_file, json.dumps(counters))
+    cluster_state.atomic_write(textfile,
+                               render_metrics(snapshot, cmap, counters))
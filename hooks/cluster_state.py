@@ -0,0 +1,442 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsers for the pacemaker and corosync status tools.
+
+The parsed state is also kept in a snapshot file, refreshed every minute
+by running this module from cron (see setup_cluster_state_collector in
+utils.py), so that the nrpe checks and the hooks don't all have to query
+pacemaker on their own.
+
+NOTE: this module is also shipped next to the nrpe plugins (see
+files/nrpe), so it must only depend on the python standard library.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as etree
+
+CRM_MON_CMD = ['crm_mon', '--as-xml', '--inactive', '--failcounts']
+CFGTOOL_CMD = ['corosync-cfgtool', '-s']
+CONSTRAINTS_CMD = ['cibadmin', '--query', '--scope', 'constraints']
+
+SNAPSHOT_FILE = '/var/lib/hacluster/cluster-state.json'
+# The collector runs every minute, leave it some slack before considering
+# the snapshot stale.
+SNAPSHOT_MAX_AGE = 120
+
+NAGIOS_OK = 0
+NAGIOS_WARNING = 1
+NAGIOS_CRITICAL = 2
+NAGIOS_UNKNOWN = 3
+NAGIOS_STATES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+
+def _bool(value):
+    return value == 'true'
+
+
+def _run(cmd, sudo=False):
+    if sudo:
+        cmd = ['sudo', '-n'] + cmd
+    return subprocess.check_output(cmd, stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+
+
+def parse_crm_mon_xml(output):
+    """Parse the output of `crm_mon --as-xml --inactive --failcounts`
+
+    :param output: string with the XML generated by crm_mon
+    :returns: dict with the 'summary', 'nodes', 'resources', 'fail_counts'
+              and 'failed_actions' of the cluster
+    :rtype: dict
+    """
+    root = etree.fromstring(output)
+
+    summary = {'dc': None, 'quorum': False, 'nodes_configured': 0,
+               'resources_configured': 0, 'maintenance_mode': False}
+    dc = root.find('summary/current_dc')
+    if dc is not None and _bool(dc.attrib.get('present')):
+        summary['dc'] = dc.attrib.get('name')
+        summary['quorum'] = _bool(dc.attrib.get('with_quorum'))
+    nodes_configured = root.find('summary/nodes_configured')
+    if nodes_configured is not None:
+        summary['nodes_configured'] = int(nodes_configured.attrib['number'])
+    resources_configured = root.find('summary/resources_configured')
+    if resources_configured is not None:
+        summary['resources_configured'] = int(
+            resources_configured.attrib['number'])
+    options = root.find('summary/cluster_options')
+    if options is not None:
+        summary['maintenance_mode'] = _bool(
+            options.attrib.get('maintenance-mode'))
+
+    nodes = {}
+    for node in root.findall('nodes/node'):
+        nodes[node.attrib['name']] = {
+            'id': node.attrib.get('id'),
+            'online': _bool(node.attrib.get('online')),
+            'standby': _bool(node.attrib.get('standby')),
+            'maintenance': _bool(node.attrib.get('maintenance')),
+            'unclean': _bool(node.attrib.get('unclean')),
+            'resources_running': int(
+                node.attrib.get('resources_running', 0)),
+        }
+
+    # NOTE: clone and master/slave instances are reported once per instance
+    #       with the same id, they are merged in a single entry here.
+    resources = {}
+    resources_elem = root.find('resources')
+    for rsc in (resources_elem.iter('resource')
+                if resources_elem is not None else []):
+        entry = resources.setdefault(rsc.attrib['id'], {
+            'agent': rsc.attrib.get('resource_agent'),
+            'roles': [],
+            'nodes': [],
+            'active': False,
+            'failed': False,
+            'managed': True,
+        })
+        entry['roles'].append(rsc.attrib.get('role'))
+        entry['nodes'].extend(n.attrib['name'] for n in rsc.findall('node'))
+        entry['active'] |= _bool(rsc.attrib.get('active'))
+        entry['failed'] |= _bool(rsc.attrib.get('failed'))
+        entry['managed'] &= _bool(rsc.attrib.get('managed', 'true'))
+
+    fail_counts = {}
+    for node in root.findall('node_history/node'):
+        for history in node.findall('resource_history'):
+            count = history.attrib.get('fail-count')
+            if count is None:
+                continue
+            count = 1000000 if count == 'INFINITY' else int(count)
+            if count > 0:
+                fail_counts.setdefault(history.attrib['id'], {})[
+                    node.attrib['name']] = count
+
+    failed_actions = []
+    for failure in root.findall('failures/failure'):
+        op_key = failure.attrib.get('op_key', '')
+        failed_actions.append({
+            # op_key is <resource>_<task>_<interval>
+            'resource': op_key.rsplit('_', 2)[0],
+            'node': failure.attrib.get('node'),
+            'task': failure.attrib.get('task'),
+            'exitreason': failure.attrib.get('exitreason'),
+            'exitstatus': failure.attrib.get('exitstatus'),
+        })
+
+    return {'summary': summary,
+            'nodes': nodes,
+            'resources': resources,
+            'fail_counts': fail_counts,
+            'failed_actions': failed_actions}
+
+
+def parse_cfgtool_status(output):
+    """Parse the ring status printed by `corosync-cfgtool -s`
+
+    :param output: string with the output of corosync-cfgtool -s
+    :returns: one dict per ring with the 'ring', 'id', 'status' and
+              'faulty' keys
+    :rtype: list
+    """
+    rings = []
+    for line in output.splitlines():
+        line = line.strip()
+        match = re.match(r'RING ID (\d+)', line)
+        if match:
+            rings.append({'ring': int(match.group(1)), 'id': None,
+                          'status': None, 'faulty': True})
+            continue
+        if not rings:
+            continue
+        match = re.match(r'(id|status)\s*=\s*(.*)', line)
+        if match:
+            rings[-1][match.group(1)] = match.group(2)
+            if match.group(1) == 'status':
+                rings[-1]['faulty'] = 'no faults' not in match.group(2)
+
+    return rings
+
+
+def parse_leftover_constraints(output):
+    """Find location constraints left behind by `crm resource migrate/ban`
+
+    :param output: string with the output of
+                   `cibadmin --query --scope constraints`
+    :returns: list of (constraint id, resource) tuples
+    """
+    root = etree.fromstring(output)
+    return [(loc.attrib['id'], loc.attrib.get('rsc'))
+            for loc in root.iter('rsc_location')
+            if loc.attrib['id'].startswith('cli-')]
+
+
+def query_crm_mon(sudo=False):
+    """Return the parsed crm_mon status of the cluster"""
+    return parse_crm_mon_xml(_run(CRM_MON_CMD, sudo))
+
+
+def query_rings(sudo=False):
+    """Return the parsed corosync ring status of this node"""
+    return parse_cfgtool_status(_run(CFGTOOL_CMD, sudo))
+
+
+def query_leftover_constraints(sudo=False):
+    """Return the location constraints left behind by resource migrations"""
+    return parse_leftover_constraints(_run(CONSTRAINTS_CMD, sudo))
+
+
+def stopped_resources(state):
+    """Return the sorted names of resources with stopped instances"""
+    return sorted(name for name, rsc in state['resources'].items()
+                  if 'Stopped' in rsc['roles'])
+
+
+def failed_resources(state, resources=None):
+    """Return the resources with failures to clean up
+
+    A resource needs a cleanup when it has a fail count or a failed action on
+    a node, or crm_mon reports it failed.
+
+    :param state: parsed crm_mon output, see parse_crm_mon_xml
+    :param resources: only consider these resources, all of them by default
+    :returns: dict of resource -> sorted list of the nodes it failed on, the
+              list is empty when the failure isn't tied to a node
+    :rtype: dict
+    """
+    failed = {}
+    for name, counts in state['fail_counts'].items():
+        failed.setdefault(name, set()).update(counts)
+    for action in state['failed_actions']:
+        nodes = failed.setdefault(action['resource'], set())
+        if action['node']:
+            nodes.add(action['node'])
+    for name, rsc in state['resources'].items():
+        if rsc['failed']:
+            failed.setdefault(name, set())
+
+    # instances of unique clones are named <resource>:<instance>
+    cleanup = {}
+    for name, nodes in failed.items():
+        cleanup.setdefault(name.split(':')[0], set()).update(nodes)
+    return {name: sorted(nodes) for name, nodes in cleanup.items()
+            if resources is None or name in resources}
+
+
+def nagios_status(state, rings, constraints=None, failcount=1,
+                  warn_only=False, standby_ignore=False, expected_rings=None):
+    """Assess the cluster state the way the check_crm and
+    check_corosync_rings plugins did.
+
+    :param state: parsed crm_mon status, see parse_crm_mon_xml
+    :param rings: parsed ring status, see parse_cfgtool_status
+    :param constraints: leftover location constraints, None to skip
+    :param failcount: resource fail count to start warning on
+    :param warn_only: report node and resource problems as WARNING
+    :param standby_ignore: do not report nodes in standby
+    :param expected_rings: number of rings that should be found
+    :returns: tuple of (nagios state, list of messages, perfdata dict)
+    """
+    problem = NAGIOS_WARNING if warn_only else NAGIOS_CRITICAL
+    status = NAGIOS_OK
+    messages = []
+
+    def add(level, message):
+        messages.append(message)
+        return max(status, level)
+
+    if not state['summary']['quorum']:
+        status = add(NAGIOS_CRITICAL, 'No Quorum')
+
+    nodes = state['nodes']
+    offline = sorted(n for n, v in nodes.items() if not v['online'])
+    if offline:
+        status = add(problem, '{} Nodes Offline'.format(len(offline)))
+    standby = sorted(n for n, v in nodes.items() if v['standby'])
+    if standby and not standby_ignore:
+        status = add(problem, '{} in Standby'.format(', '.join(standby)))
+
+    for name in stopped_resources(state):
+        status = add(problem, '{} Stopped'.format(name))
+    for name, rsc in sorted(state['resources'].items()):
+        if rsc['failed'] and not rsc['managed']:
+            status = add(NAGIOS_CRITICAL, '{} unmanaged FAILED'.format(name))
+
+    if state['failed_actions']:
+        status = add(NAGIOS_CRITICAL,
+                     'FAILED actions detected or not cleaned up')
+
+    for name, counts in sorted(state['fail_counts'].items()):
+        count = max(counts.values())
+        if count >= failcount:
+            status = add(NAGIOS_WARNING,
+                         '{} failure detected, fail-count={}'.format(name,
+                                                                     count))
+
+    for constraint, rsc in (constraints or []):
+        status = add(NAGIOS_WARNING,
+                     '{} blocking location constraint detected'.format(rsc))
+
+    faulty = [r for r in rings if r['faulty']]
+    for ring in faulty:
+        status = add(NAGIOS_CRITICAL, 'ring {} {}'.format(ring['ring'],
+                                                          ring['status']))
+    if not rings:
+        status = add(NAGIOS_CRITICAL, 'No Rings Found')
+    elif expected_rings is not None and len(rings) != expected_rings:
+        status = add(NAGIOS_CRITICAL,
+                     'Expected {} rings but found {}'.format(expected_rings,
+                                                             len(rings)))
+
+    if not messages:
+        messages.append('Cluster OK')
+
+    perfdata = {
+        'nodes_online': len(nodes) - len(offline),
+        'nodes_offline': len(offline),
+        'nodes_standby': len(standby),
+        'resources_configured': state['summary']['resources_configured'],
+        'resources_stopped': len(stopped_resources(state)),
+        'failed_actions': len(state['failed_actions']),
+        'fail_count': sum(sum(c.values())
+                          for c in state['fail_counts'].values()),
+        'rings': len(rings),
+        'rings_faulty': len(faulty),
+    }
+    return status, messages, perfdata
+
+
+def format_nagios(status, messages, perfdata):
+    """Format the plugin output line, including the performance data"""
+    return 'CLUSTER {} - {} | {}'.format(
+        NAGIOS_STATES[status], ', '.join(messages),
+        ' '.join('{}={}'.format(k, v) for k, v in sorted(perfdata.items())))
+
+
+def collect(sudo=False):
+    """Query the cluster and return a timestamped snapshot of its state
+
+    :returns: dict with the 'timestamp', 'crm_mon', 'rings' and
+              'constraints' keys
+    :rtype: dict
+    """
+    return {'timestamp': time.time(),
+            'crm_mon': query_crm_mon(sudo),
+            'rings': query_rings(sudo),
+            'constraints': query_leftover_constraints(sudo)}
+
+
+def atomic_write(path, content, perms=0o644):
+    """Atomically replace the file at path with content
+
+    The content is written to a temporary file in the same directory which
+    is then renamed over the old one, readers never see a partial file.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname,
+                               prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, perms)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def write_snapshot(snapshot, path=SNAPSHOT_FILE):
+    """Atomically replace the snapshot file, readable by the nagios user"""
+    atomic_write(path, json.dumps(snapshot))
+
+
+def read_snapshot(path=SNAPSHOT_FILE, max_age=SNAPSHOT_MAX_AGE):
+    """Return the snapshot, None if it is missing, unreadable or stale
+
+    :param max_age: maximum age in seconds of the snapshot
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - snapshot.get('timestamp', 0) > max_age:
+        return None
+    return snapshot
+
+
+def invalidate_snapshot(path=SNAPSHOT_FILE):
+    """Remove the snapshot, e.g. after the cluster has been reconfigured"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_snapshot(max_age=SNAPSHOT_MAX_AGE, path=SNAPSHOT_FILE, sudo=False,
+                 write=False):
+    """Return the snapshot, querying the cluster if it is stale
+
+    :param max_age: maximum age in seconds of the snapshot
+    :param sudo: run the status tools through sudo for live queries
+    :param write: replace the snapshot file with the result of a live query
+    :raises: subprocess.CalledProcessError if the cluster can't be queried
+    """
+    snapshot = read_snapshot(path, max_age)
+    if snapshot is None:
+        snapshot = collect(sudo)
+        if write:
+            write_snapshot(snapshot, path)
+    return snapshot
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Write a snapshot of the cluster state')
+    parser.add_argument('--path', default=SNAPSHOT_FILE,
+                        help='Snapshot file (default: %(default)s)')
+    parser.add_argument('--textfile', default=None,
+                        help='Also export prometheus metrics to this file')
+    args = parser.parse_args(argv)
+    try:
+        snapshot = collect()
+        write_snapshot(snapshot, args.path)
+    except subprocess.CalledProcessError as e:
+        # Keep the previous snapshot, it expires and readers then query the
+        # cluster themselves.
+        sys.stderr.write('Unable to query the cluster: {}\n'.format(e))
+        return 1
+
+    if args.textfile:
+        # NOTE: imported here, cluster_metrics depends on this module
+        import cluster_metrics
+        cluster_metrics.export(snapshot, args.textfile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
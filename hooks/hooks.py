@@ -14,10 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import glob
 import os
-import shutil
 import socket
+import subprocess
 import sys
 
 _path = os.path.dirname(os.path.realpath(__file__))
@@ -33,12 +32,15 @@ _add_path(_root)
 
 
 import pcmk
+import stonith
+import unitstate
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     is_leader,
-    log,
     DEBUG,
     INFO,
+    WARNING,
     ERROR,
     related_units,
     relation_ids,
@@ -46,14 +48,13 @@ from charmhelpers.core.hookenv import (
     config,
     Hooks,
     UnregisteredHookError,
-    status_set,
 )
 
-from charmhelpers.core.host import (
-    service_stop,
-    service_running,
-    lsb_release,
-    CompareHostReleases,
+from hooktools import (
+    enable_log_buffer,
+    enable_status_buffer,
+    log,
+    status_set,
 )
 
 from charmhelpers.contrib.network.ip import (
@@ -79,19 +80,17 @@ from utils import (
     get_cluster_nodes,
     parse_data,
     configure_corosync,
-    configure_stonith,
-    configure_monitor_host,
-    configure_cluster_global,
+    stonith_enabled,
+    configure_cluster_globals,
     enable_lsb_services,
-    disable_lsb_services,
-    disable_upstart_services,
+    disable_init_services,
     get_ip_addr_from_resource_params,
     validate_dns_ha,
     setup_maas_api,
     setup_ocf_files,
     set_unit_status,
     ocf_file_exists,
-    kill_legacy_ocf_daemon_process,
+    kill_legacy_ocf_daemon_processes,
     try_pcmk_wait,
     maintenance_mode,
     needs_maas_dns_migration,
@@ -99,6 +98,20 @@ from utils import (
     MAASConfigIncomplete,
     pause_unit,
     resume_unit,
+    setup_cluster_state_collector,
+    remove_cluster_state_collector,
+    sync_files,
+    write_nrpe_checks,
+    resources_to_cleanup,
+    get_ring1_addr,
+    corosync_ring_count,
+    get_resource_wait_mode,
+    nrpe_ring_count_changed,
+    set_nrpe_ring_count,
+    update_peer_rtt,
+    compact_unit_state,
+    assign_admission_slots,
+    admission_wait,
 )
 
 from charmhelpers.contrib.charmsupport import nrpe
@@ -117,7 +130,7 @@ COROSYNC_CONF_FILES = [
 ]
 
 PACKAGES = ['crmsh', 'corosync', 'pacemaker', 'python-netaddr', 'ipmitool',
-            'libmonitoring-plugin-perl', 'python3-requests-oauthlib']
+            'python3-requests-oauthlib']
 
 SUPPORTED_TRANSPORTS = ['udp', 'udpu', 'multicast', 'unicast']
 DEPRECATED_TRANSPORT_VALUES = {"multicast": "udp", "unicast": "udpu"}
@@ -125,16 +138,12 @@ DEPRECATED_TRANSPORT_VALUES = {"multicast": "udp", "unicast": "udpu"}
 
 @hooks.hook('install.real')
 def install():
-    ubuntu_release = lsb_release()['DISTRIB_CODENAME'].lower()
-    # use libnagios on anything older than Xenial
-    if CompareHostReleases(ubuntu_release) < 'xenial':
-        PACKAGES.remove('libmonitoring-plugin-perl')
-        PACKAGES.append('libnagios-plugin-perl')
     # NOTE(dosaboy): we currently disallow upgrades due to bug #1382842. This
     # should be removed once the pacemaker package is fixed.
     status_set('maintenance', 'Installing apt packages')
     apt_install(filter_installed_packages(PACKAGES), fatal=True)
     setup_ocf_files()
+    setup_cluster_state_collector()
 
 
 def get_transport():
@@ -168,19 +177,25 @@ def config_changed():
         status_set('blocked', message)
         raise Exception(message)
 
+    # blocks on a typo rather than when the resources are configured
+    get_resource_wait_mode()
+
     enable_lsb_services('pacemaker')
 
     for rid in relation_ids('hanode'):
         hanode_relation_joined(rid)
 
     status_set('maintenance', "Setting up corosync")
+    if is_leader():
+        assign_admission_slots()
+        if config('corosync_measure_rtt'):
+            update_peer_rtt()
     if configure_corosync():
         try_pcmk_wait()
-        configure_cluster_global()
-        configure_monitor_host()
-        configure_stonith()
+        configure_cluster_globals()
 
     update_nrpe_config()
+    setup_cluster_state_collector()
 
     cfg = config()
     if (is_leader() and
@@ -215,6 +230,8 @@ def migrate_maas_dns():
 @hooks.hook('upgrade-charm.real')
 def upgrade_charm():
     install()
+    # the metadata of the agents is read again by the new charm
+    pcmk.clear_agent_metadata()
     migrate_maas_dns()
     update_nrpe_config()
 
@@ -223,7 +240,8 @@ def upgrade_charm():
 def hanode_relation_joined(relid=None):
     relation_set(
         relation_id=relid,
-        relation_settings={'private-address': get_relation_ip('hanode')}
+        relation_settings={'private-address': get_relation_ip('hanode'),
+                           'ring1-address': get_ring1_addr()}
     )
 
 
@@ -314,44 +332,97 @@ def ha_relation_changed():
 
     # NOTE: this should be removed in 15.04 cycle as corosync
     # configuration should be set directly on subordinate
+    if is_leader():
+        assign_admission_slots()
+        if config('corosync_measure_rtt'):
+            update_peer_rtt()
+    else:
+        # the units don't all query the DC at the same time
+        admission_wait('configuring the cluster')
     configure_corosync()
+    # the check expects the rings configured, the redundant one may have
+    # just been added
+    if relation_ids('nrpe-external-master') and nrpe_ring_count_changed():
+        update_nrpe_config()
     try_pcmk_wait()
-    configure_cluster_global()
-    configure_monitor_host()
-    configure_stonith()
+    configure_cluster_globals()
 
     # Only configure the cluster resources
     # from the oldest peer unit.
     if is_leader():
+        # Reject invalid parameters before anything is changed rather than
+        # after a failed transition.
+        metadata = pcmk.cached_agent_metadata()
+        existing = pcmk.crm_opts_exist(resources)
+        for res_name, res_type in resources.items():
+            errors = pcmk.validate_resource_params(
+                res_type, resource_params.get(res_name), cache=metadata,
+                existing=res_name in existing)
+            if errors:
+                msg = 'Invalid resource {}: {}'.format(res_name,
+                                                       '; '.join(errors))
+                status_set('blocked', msg)
+                raise Exception(msg)
+
+        # In batch mode the changes don't wait for the cluster to settle,
+        # there is a single wait once they are all made.
+        wait = get_resource_wait_mode() != 'batch'
+        # Changes already applied by a previous run of the hook which failed
+        # halfway through are not made again
+        journal = pcmk.ApplyJournal({'resources': resources,
+                                     'delete_resources': delete_resources,
+                                     'resource_params': resource_params,
+                                     'groups': groups,
+                                     'ms': ms,
+                                     'orders': orders,
+                                     'colocations': colocations,
+                                     'clones': clones,
+                                     'locations': locations,
+                                     'init_services': init_services},
+                                    wait=wait)
+
         log('Deleting Resources' % (delete_resources), level=DEBUG)
-        for res_name in delete_resources:
-            if pcmk.crm_opt_exists(res_name):
-                if ocf_file_exists(res_name, resources):
-                    log('Stopping and deleting resource %s' % res_name,
-                        level=DEBUG)
-                    if pcmk.crm_res_running(res_name):
-                        pcmk.commit('crm -w -F resource stop %s' % res_name)
-                else:
-                    log('Cleanuping and deleting resource %s' % res_name,
-                        level=DEBUG)
-                    pcmk.commit('crm resource cleanup %s' % res_name)
-                # Daemon process may still be running after the upgrade.
-                kill_legacy_ocf_daemon_process(res_name)
-                pcmk.commit('crm -w -F configure delete %s' % res_name)
+        deleted = [res_name for res_name in delete_resources
+                   if pcmk.crm_opt_exists(res_name)]
+        for res_name in deleted:
+            if ocf_file_exists(res_name, resources):
+                log('Stopping and deleting resource %s' % res_name,
+                    level=DEBUG)
+                # deleted resources are always stopped before anything
+                # else is configured
+                if pcmk.crm_res_running(res_name):
+                    journal.commit('stop:%s' % res_name,
+                                   'crm -w -F resource stop %s' % res_name,
+                                   wait=True)
+            else:
+                log('Cleanuping and deleting resource %s' % res_name,
+                    level=DEBUG)
+                journal.commit('delete-cleanup:%s' % res_name,
+                               'crm resource cleanup %s' % res_name)
+        # Daemon processes may still be running after the upgrade, /proc is
+        # scanned once for all of them.
+        kill_legacy_ocf_daemon_processes(deleted)
+        for res_name in deleted:
+            journal.commit('delete:%s' % res_name,
+                           'crm -w -F configure delete %s' % res_name,
+                           wait=True)
 
         log('Configuring Resources: %s' % (resources), level=DEBUG)
+        # disable the services we are going to put in HA, all at once
+        lsb_services = []
+        upstart_services = []
         for res_name, res_type in resources.items():
-            # disable the service we are going to put in HA
             if res_type.split(':')[0] == "lsb":
-                disable_lsb_services(res_type.split(':')[1])
-                if service_running(res_type.split(':')[1]):
-                    service_stop(res_type.split(':')[1])
+                lsb_services.append(res_type.split(':')[1])
             elif (len(init_services) != 0 and
                   res_name in init_services and
                   init_services[res_name]):
-                disable_upstart_services(init_services[res_name])
-                if service_running(init_services[res_name]):
-                    service_stop(init_services[res_name])
+                upstart_services.append(init_services[res_name])
+        disable_init_services(lsb_services, upstart_services)
+
+        # the checksums of the resources are read and written all at once
+        checksums = pcmk.resource_checksums(resources)
+        for res_name, res_type in resources.items():
             # Put the services in HA, if not already done so
             # if not pcmk.is_resource_present(res_name):
             if not pcmk.crm_opt_exists(res_name):
@@ -362,35 +433,39 @@ def ha_relation_changed():
                     cmd = ('crm -w -F configure primitive %s %s %s' %
                            (res_name, res_type, resource_params[res_name]))
 
-                pcmk.commit(cmd)
+                journal.commit('primitive:%s' % res_name, cmd)
                 log('%s' % cmd, level=DEBUG)
                 if config('monitor_host'):
                     cmd = ('crm -F configure location Ping-%s %s rule '
                            '-inf: pingd lte 0' % (res_name, res_name))
-                    pcmk.commit(cmd)
+                    journal.commit('location:Ping-%s' % res_name, cmd)
 
-            else:
+            elif not journal.applied('primitive:%s' % res_name):
                 # the resource already exists so it will be updated.
-                code = pcmk.crm_update_resource(res_name, res_type,
-                                                resource_params.get(res_name))
+                code = journal.run('update:%s' % res_name,
+                                   pcmk.crm_update_resource, res_name,
+                                   res_type, resource_params.get(res_name),
+                                   checksums=checksums)
                 if code != 0:
+                    pcmk.save_resource_checksums(checksums)
                     msg = "Cannot update pcmkr resource: {}".format(res_name)
                     status_set('blocked', msg)
                     raise Exception(msg)
+        pcmk.save_resource_checksums(checksums)
 
         log('Configuring Groups: %s' % (groups), level=DEBUG)
         for grp_name, grp_params in groups.items():
             if not pcmk.crm_opt_exists(grp_name):
                 cmd = ('crm -w -F configure group %s %s' %
                        (grp_name, grp_params))
-                pcmk.commit(cmd)
+                journal.commit('group:%s' % grp_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
         log('Configuring Master/Slave (ms): %s' % (ms), level=DEBUG)
         for ms_name, ms_params in ms.items():
             if not pcmk.crm_opt_exists(ms_name):
                 cmd = 'crm -w -F configure ms %s %s' % (ms_name, ms_params)
-                pcmk.commit(cmd)
+                journal.commit('ms:%s' % ms_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
         log('Configuring Orders: %s' % (orders), level=DEBUG)
@@ -398,7 +473,7 @@ def ha_relation_changed():
             if not pcmk.crm_opt_exists(ord_name):
                 cmd = 'crm -w -F configure order %s %s' % (ord_name,
                                                            ord_params)
-                pcmk.commit(cmd)
+                journal.commit('order:%s' % ord_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
         log('Configuring Clones: %s' % clones, level=DEBUG)
@@ -406,7 +481,7 @@ def ha_relation_changed():
             if not pcmk.crm_opt_exists(cln_name):
                 cmd = 'crm -w -F configure clone %s %s' % (cln_name,
                                                            cln_params)
-                pcmk.commit(cmd)
+                journal.commit('clone:%s' % cln_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
         # Ordering is important here, colocation and location constraints
@@ -418,7 +493,7 @@ def ha_relation_changed():
             if not pcmk.crm_opt_exists(col_name):
                 cmd = 'crm -w -F configure colocation %s %s' % (col_name,
                                                                 col_params)
-                pcmk.commit(cmd)
+                journal.commit('colocation:%s' % col_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
         log('Configuring Locations: %s' % locations, level=DEBUG)
@@ -426,33 +501,29 @@ def ha_relation_changed():
             if not pcmk.crm_opt_exists(loc_name):
                 cmd = 'crm -w -F configure location %s %s' % (loc_name,
                                                               loc_params)
-                pcmk.commit(cmd)
+                journal.commit('location:%s' % loc_name, cmd)
                 log('%s' % cmd, level=DEBUG)
 
-        for res_name, res_type in resources.items():
-            if len(init_services) != 0 and res_name in init_services:
-                # Checks that the resources are running and started.
-                # Ensure that clones are excluded as the resource is
-                # not directly controllable (dealt with below)
-                # Ensure that groups are cleaned up as a whole rather
-                # than as individual resources.
-                if (res_name not in clones.values() and
-                    res_name not in groups.values() and
-                        not pcmk.crm_res_running(res_name)):
-                    # Just in case, cleanup the resources to ensure they get
-                    # started in case they failed for some unrelated reason.
-                    cmd = 'crm resource cleanup %s' % res_name
-                    pcmk.commit(cmd)
-
-        for cl_name in clones:
-            # Always cleanup clones
-            cmd = 'crm resource cleanup %s' % cl_name
-            pcmk.commit(cmd)
-
-        for grp_name in groups:
-            # Always cleanup groups
-            cmd = 'crm resource cleanup %s' % grp_name
-            pcmk.commit(cmd)
+        if not journal.wait:
+            # One settle time for all the changes made above
+            pending = pcmk.wait_for_resources(
+                list(resources), config('resource_wait_timeout'))
+            if pending:
+                log('Resources not running after waiting %ss: %s' %
+                    (config('resource_wait_timeout'), ', '.join(pending)),
+                    level=WARNING)
+
+        # Only clean up the resources which failed, a cleanup resets the fail
+        # counts and makes every node probe the resource again.
+        failed = resources_to_cleanup(resources, clones, groups)
+        log('Cleaning up resources: %s' % failed, level=DEBUG)
+        for res_name, nodes in sorted(failed.items()):
+            cmd = 'crm_resource --cleanup --resource %s' % res_name
+            if len(nodes) == 1:
+                cmd += ' --node %s' % nodes[0]
+            journal.commit('cleanup:%s' % res_name, cmd)
+
+        journal.complete()
 
     for rel_id in relation_ids('ha'):
         relation_set(relation_id=rel_id, clustered="yes")
@@ -460,6 +531,7 @@ def ha_relation_changed():
 
 @hooks.hook()
 def stop():
+    remove_cluster_state_collector()
     cmd = 'crm -w -F node delete %s' % socket.gethostname()
     pcmk.commit(cmd)
     apt_purge(['corosync', 'pacemaker'], fatal=True)
@@ -474,35 +546,28 @@ def update_nrpe_config():
     scripts_dst = "/usr/local/lib/nagios/plugins"
     if not os.path.exists(scripts_dst):
         os.makedirs(scripts_dst)
-    for fname in glob.glob(os.path.join(scripts_src, "*")):
-        if os.path.isfile(fname):
-            shutil.copy2(fname,
-                         os.path.join(scripts_dst, os.path.basename(fname)))
+    sync_files(scripts_src, scripts_dst)
 
     sudoers_src = os.path.join(os.environ["CHARM_DIR"], "files",
                                "sudoers")
     sudoers_dst = "/etc/sudoers.d"
-    for fname in glob.glob(os.path.join(sudoers_src, "*")):
-        if os.path.isfile(fname):
-            shutil.copy2(fname,
-                         os.path.join(sudoers_dst, os.path.basename(fname)))
+    sync_files(sudoers_src, sudoers_dst)
 
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
 
     nrpe_setup = nrpe.NRPE(hostname=hostname)
 
-    apt_install('python-dbus')
+    apt_install(filter_installed_packages(['python-dbus']))
 
-    # corosync/crm checks
-    nrpe_setup.add_check(
-        shortname='corosync_rings',
-        description='Check Corosync rings {%s}' % current_unit,
-        check_cmd='check_corosync_rings')
+    # corosync/crm checks, the ring status is now reported by check_cluster
+    # along with the rest of the cluster status.
+    ring_count = corosync_ring_count()
+    nrpe_setup.remove_check(shortname='corosync_rings')
     nrpe_setup.add_check(
         shortname='crm_status',
         description='Check crm status {%s}' % current_unit,
-        check_cmd='check_crm')
+        check_cmd='check_cluster -r %d' % ring_count)
 
     # process checks
     nrpe_setup.add_check(
@@ -516,7 +581,31 @@ def update_nrpe_config():
         check_cmd='check_procs -c 1:1 -C pacemakerd'
     )
 
-    nrpe_setup.write()
+    write_nrpe_checks(nrpe_setup)
+    set_nrpe_ring_count(ring_count)
+
+
+@hooks.hook('update-status')
+def update_status():
+    compact_unit_state()
+    # Refresh the fencing device health once the cached results expire, the
+    # unit status is then assessed from the cache when the hook exits.
+    if stonith_enabled() and not is_unit_paused_set():
+        try:
+            stonith.check_fencing_devices()
+        except subprocess.CalledProcessError as e:
+            log('Unable to list fencing devices: {}'.format(e),
+                level=WARNING)
+
+
+@hooks.hook('leader-settings-changed')
+def leader_settings_changed():
+    # The leader published a new peer RTT, the totem timings may change.
+    if is_unit_paused_set():
+        log("Unit is paused, skipping leader-settings-changed", level=INFO)
+        return
+    if config('corosync_measure_rtt') and configure_corosync():
+        try_pcmk_wait()
 
 
 @hooks.hook('pre-series-upgrade')
@@ -536,6 +625,10 @@ def series_upgrade_complete():
 
 
 if __name__ == '__main__':
+    enable_log_buffer(str(config('log_level')).upper())
+    enable_status_buffer()
+    # the CIB journal and caches commit to unitdata many times per hook
+    unitstate.enable_wal(unitdata.kv())
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
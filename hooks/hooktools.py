@@ -0,0 +1,181 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Buffered juju-log and status-set.
+
+hookenv.log forks a juju-log process per message, which adds up to
+hundreds of forks for a hook configuring many resources. The charm modules
+log through log() below instead. Once the hook enables the buffer, messages
+below the configured level are dropped without forking and the others are
+queued, then written with one juju-log call per run of messages of the same
+level when:
+
+- an ERROR or CRITICAL message is logged,
+- the queued messages reach FLUSH_SIZE,
+- the hook exits, successfully or not.
+
+The workload status set with status_set() below is kept in memory as well
+and only sent once the hook exits, if it differs from the last status sent
+to juju, which is kept in unitdata. Until enabled, status_set() sends the
+status right away but still records it.
+
+Until the buffers are enabled, e.g. in actions and unit tests, log() is
+hookenv.log.
+"""
+
+import atexit
+import threading
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+LEVELS = [hookenv.TRACE, hookenv.DEBUG, hookenv.INFO, hookenv.WARNING,
+          hookenv.ERROR, hookenv.CRITICAL]
+# well below the argument size limit of juju-log (hookenv.SH_MAX_ARG)
+FLUSH_SIZE = 64 * 1024
+
+WORKLOAD_STATES = ['maintenance', 'blocked', 'waiting', 'active']
+# unitdata key of the last workload status sent to juju
+STATUS_KEY = 'hooktools-workload-status'
+
+_buffer = None
+_status = None
+
+
+class LogBuffer(object):
+    """Queue of log messages written to juju-log in batches"""
+
+    def __init__(self, level=hookenv.DEBUG):
+        """
+        :param level: messages below this level are dropped
+        :raises: ValueError if the level is unknown
+        """
+        self.threshold = LEVELS.index(level)
+        self.records = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def log(self, message, level=None):
+        if not isinstance(message, str):
+            message = repr(message)
+        # juju-log defaults to INFO, levels it knows under other names, e.g.
+        # WARN, are never dropped
+        _level = level or hookenv.INFO
+        if _level in LEVELS and LEVELS.index(_level) < self.threshold:
+            return
+        # the queued messages are written first if this one would take them
+        # over FLUSH_SIZE, counting the newline joining them
+        if self.records and self.size + len(message) + 1 > FLUSH_SIZE:
+            self.flush()
+        with self.lock:
+            self.records.append((level, message))
+            self.size += len(message) + 1
+        if level in (hookenv.ERROR, hookenv.CRITICAL) or \
+                self.size >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the queued messages, one juju-log call per level run
+
+        A run is split so no call exceeds FLUSH_SIZE, a message which is
+        larger on its own is written alone.
+        """
+        with self.lock:
+            records, self.records, self.size = self.records, [], 0
+        batch = []
+        size = 0
+        for i, (level, message) in enumerate(records):
+            if batch and size + len(message) + 1 > FLUSH_SIZE:
+                hookenv.log('\n'.join(batch), level=level)
+                batch = []
+                size = 0
+            batch.append(message)
+            size += len(message) + 1
+            if i + 1 == len(records) or records[i + 1][0] != level:
+                hookenv.log('\n'.join(batch), level=level)
+                batch = []
+                size = 0
+
+
+def enable_log_buffer(level=hookenv.DEBUG):
+    """Buffer the messages of log() until the hook exits
+
+    :param level: messages below this level are dropped
+    """
+    global _buffer
+    if level not in LEVELS:
+        hookenv.log('Unknown log level {}, using {}'.format(
+            level, hookenv.DEBUG), level=hookenv.WARNING)
+        level = hookenv.DEBUG
+    if _buffer is None:
+        _buffer = LogBuffer(level)
+        atexit.register(_buffer.flush)
+
+
+def log(message, level=None):
+    """Write a message to the juju log, see hookenv.log"""
+    if _buffer is None:
+        hookenv.log(message, level=level)
+    else:
+        _buffer.log(message, level=level)
+
+
+def _send_status(workload_state, message):
+    db = unitdata.kv()
+    if db.get(STATUS_KEY) == [workload_state, message]:
+        log('Workload status unchanged: {} {}'.format(workload_state,
+                                                      message),
+            level=hookenv.DEBUG)
+        return
+    hookenv.status_set(workload_state, message)
+    db.set(STATUS_KEY, [workload_state, message])
+    db.flush()
+
+
+class StatusBuffer(object):
+    """Workload status sent to juju once, when the hook exits"""
+
+    def __init__(self):
+        self.pending = None
+
+    def set(self, workload_state, message):
+        self.pending = (workload_state, message)
+
+    def flush(self):
+        """Send the last status set, unless juju already has it"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            _send_status(*pending)
+
+
+def enable_status_buffer():
+    """Send only the last status of status_set() when the hook exits"""
+    global _status
+    if _status is None:
+        _status = StatusBuffer()
+        atexit.register(_status.flush)
+
+
+def status_set(workload_state, message):
+    """Set the workload status, see hookenv.status_set
+
+    :raises: ValueError if the workload state is invalid
+    """
+    if workload_state not in WORKLOAD_STATES:
+        raise ValueError(
+            '{!r} is not a valid workload state'.format(workload_state))
+    if _status is None:
+        _send_status(workload_state, message)
+    else:
+        _status.set(workload_state, message)
@@ -19,10 +19,11 @@ import subprocess
 
 from charmhelpers.fetch import apt_install
 from charmhelpers.core.hookenv import (
-    log,
     ERROR,
 )
 
+from hooktools import log
+
 MAAS_STABLE_PPA = 'ppa:maas-maintainers/stable '
 MAAS_PROFILE_NAME = 'maas-juju-hacluster'
 
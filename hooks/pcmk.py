@@ -12,25 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cluster_state
 import hashlib
+import json
+import os
 import re
+import shlex
+import stonith
 import subprocess
 import socket
 import tempfile
 import time
+import unitstate
 import xml.etree.ElementTree as etree
 
 from distutils.version import StrictVersion
 from io import StringIO
 from charmhelpers.core import unitdata
+from charmhelpers.core.host import file_hash
 from charmhelpers.core.hookenv import (
-    log,
     ERROR,
     INFO,
     DEBUG,
     WARNING,
 )
 
+from hooktools import log
+
 
 class ServicesNotUp(Exception):
     pass
@@ -40,6 +48,23 @@ class PropertyNotFound(Exception):
     pass
 
 
+# unitdata key of the journal of CIB changes being applied
+APPLY_JOURNAL_KEY = 'pcmk-apply-journal'
+
+OCF_ROOT = '/usr/lib/ocf/resource.d'
+# unitdata key of the cached metadata of a resource agent
+RA_METADATA_PREFIX = 'pcmk-ra-metadata-'
+RA_METADATA_KEY = RA_METADATA_PREFIX + '{}'
+# crm section -> (CIB element, id) of the option sets the charm manages
+CLUSTER_OPTION_SETS = {
+    'property': ('crm_config/cluster_property_set', 'cib-bootstrap-options'),
+    'rsc_defaults': ('rsc_defaults/meta_attributes', 'rsc-options'),
+}
+# keywords starting a new section of a crm primitive definition
+PRIMITIVE_SECTIONS = ('params', 'meta', 'utilization', 'op', 'op_params',
+                      'op_meta')
+
+
 def wait_for_pcmk(retries=12, sleep=10):
     crm_up = None
     hostname = socket.gethostname()
@@ -56,7 +81,109 @@ def wait_for_pcmk(retries=12, sleep=10):
 
 
 def commit(cmd):
-    return subprocess.call(cmd.split())
+    try:
+        return subprocess.call(cmd.split())
+    finally:
+        # the cluster state snapshot is outdated by any change, including
+        # a snapshot the cron collector took while cmd was running
+        cluster_state.invalidate_snapshot()
+
+
+def no_wait(cmd):
+    """Return the crm command cmd without waiting for the cluster to settle"""
+    return re.sub(r'^crm -w ', 'crm ', cmd)
+
+
+def wait_for_resources(resources, timeout):
+    """Wait once for the cluster to settle after changes made without waiting
+
+    :param resources: resources expected to run once the cluster settled
+    :param timeout: maximum time to wait in seconds
+    :returns: sorted list of the resources which are not running or failed
+    """
+    cmd = ['crm_resource', '--wait', '--timeout', '{}s'.format(timeout)]
+    if subprocess.call(cmd) != 0:
+        log('Cluster did not settle in {}s'.format(timeout), level=WARNING)
+    try:
+        state = cluster_state.query_crm_mon()
+    except (subprocess.CalledProcessError, OSError, etree.ParseError) as e:
+        log('Unable to query the resources: {}'.format(e), level=WARNING)
+        return sorted(resources)
+    return sorted(name for name in resources
+                  if not state['resources'].get(name, {}).get('active') or
+                  state['resources'][name]['failed'])
+
+
+class ApplyJournal(object):
+    """Write-ahead journal of the CIB changes applied by a hook
+
+    Each change is identified by an idempotency key and recorded in unitdata
+    once it succeeded; the journal is flushed after every change so it
+    survives the hook failing halfway. A hook retrying the same plan then
+    skips the changes already applied instead of replaying every cleanup and
+    `crm -w` wait. A different plan, i.e. new relation data, starts over.
+    """
+
+    def __init__(self, plan, db=None, wait=True):
+        """
+        :param plan: json serializable description of the changes to apply,
+                     e.g. the resources, groups... requested by the principle
+        :param db: unitdata storage, defaults to unitdata.kv()
+        :param wait: let `crm -w` commands wait for the cluster to settle,
+                     otherwise see wait_for_resources
+        """
+        self.db = db or unitdata.kv()
+        self.wait = wait
+        self.plan_id = hashlib.md5(
+            json.dumps(plan, sort_keys=True).encode('utf-8')).hexdigest()
+        journal = self.db.get(APPLY_JOURNAL_KEY) or {}
+        if journal.get('plan') == self.plan_id:
+            self.applied_keys = journal.get('applied', [])
+            log('Resuming CIB changes, already applied: {}'
+                .format(self.applied_keys), level=INFO)
+        else:
+            self.applied_keys = []
+        self._save()
+
+    def _save(self):
+        self.db.set(APPLY_JOURNAL_KEY, {'plan': self.plan_id,
+                                        'applied': self.applied_keys})
+        self.db.flush()
+
+    def applied(self, key):
+        return key in self.applied_keys
+
+    def run(self, key, func, *args, **kwargs):
+        """Call func unless the change key was already applied
+
+        The change is recorded as applied when func returns 0 or None.
+
+        :returns: what func returned, 0 if it was skipped
+        """
+        if self.applied(key):
+            log('Skipping {}, already applied'.format(key), level=DEBUG)
+            return 0
+        ret = func(*args, **kwargs)
+        if not ret:
+            self.applied_keys.append(key)
+            self._save()
+        return ret
+
+    def commit(self, key, cmd, wait=None):
+        """Run the crm command cmd unless the change key was already applied
+
+        :param wait: wait for the cluster to settle after a `crm -w` command,
+                     defaults to the wait of the journal
+        :returns: exit code of cmd, 0 if it was skipped
+        """
+        if not (self.wait if wait is None else wait):
+            cmd = no_wait(cmd)
+        return self.run(key, commit, cmd)
+
+    def complete(self):
+        """All the changes were applied, forget about the plan"""
+        self.db.unset(APPLY_JOURNAL_KEY)
+        self.db.flush()
 
 
 def is_resource_present(resource):
@@ -93,6 +220,13 @@ def crm_opt_exists(opt_name):
     return False
 
 
+def crm_opts_exist(opt_names):
+    """Return the names of opt_names found in the cluster configuration,
+    like crm_opt_exists but querying the configuration once"""
+    output = subprocess.getstatusoutput("crm configure show")[1]
+    return {opt_name for opt_name in opt_names if opt_name in output}
+
+
 def crm_res_running(opt_name):
     (_, output) = subprocess.getstatusoutput(
         "crm resource status %s" % opt_name)
@@ -113,22 +247,15 @@ def list_nodes():
     return nodes
 
 
-def _maas_ipmi_stonith_resource(node, power_params):
-    rsc_name = 'res_stonith_%s' % node
-    rsc = ('primitive %s stonith:external/ipmi params hostname=%s ipaddr=%s '
-           'userid=%s passwd=%s interface=lan' %
-           (rsc_name, node, power_params['power_address'],
-            power_params['power_user'], power_params['power_pass']))
+def maas_stonith_primitive(maas_nodes, crm_node, timeouts=None):
+    """Return the STONITH primitive and constraint for a cluster node
 
-    # ensure ipmi stonith agents are not running on the nodes that
-    # they manage.
-    constraint = ('location const_loc_stonith_avoid_%s %s -inf: %s' %
-                  (node, rsc_name, node))
-
-    return rsc, constraint
-
-
-def maas_stonith_primitive(maas_nodes, crm_node):
+    :param maas_nodes: node inventory from MAAS
+    :param crm_node: name of the node in the cluster
+    :param timeouts: dict of power_type -> fence agent timeout overrides
+    :returns: tuple of (primitive, constraint), (False, False) if the node
+              or its power_type is not supported
+    """
     power_type = power_params = None
     for node in maas_nodes:
         if node['hostname'].startswith(crm_node):
@@ -138,14 +265,13 @@ def maas_stonith_primitive(maas_nodes, crm_node):
     if not power_type or not power_params:
         return False, False
 
-    rsc = constraint = None
-    # we can extend to support other power flavors in the future?
-    if power_type == 'ipmi':
-        rsc, constraint = _maas_ipmi_stonith_resource(crm_node, power_params)
-    else:
+    backend = stonith.get_backend(power_type)
+    if not backend:
         log('Unsupported STONITH power_type: %s' % power_type, ERROR)
         return False, False
 
+    rsc, constraint = backend.primitive(crm_node, power_params,
+                                        (timeouts or {}).get(power_type))
     if not rsc or not constraint:
         return False, False
 
@@ -208,9 +334,76 @@ def set_property(name, value):
     :param name: property name
     :param value: new value
     """
-    subprocess.check_call(['crm', 'configure',
-                           'property', '%s=%s' % (name, value)],
-                          universal_newlines=True)
+    try:
+        subprocess.check_call(['crm', 'configure',
+                               'property', '%s=%s' % (name, value)],
+                              universal_newlines=True)
+    finally:
+        cluster_state.invalidate_snapshot()
+
+
+def parse_cluster_options(output):
+    """Read the cluster properties and resource defaults from the XML
+    generated by `crm configure show xml`
+
+    :param output: string with the output of `crm configure show xml`
+    :returns: dict of CLUSTER_OPTION_SETS section -> dict of name -> value
+    """
+    root = etree.parse(StringIO(output)).getroot()
+    options = {section: {} for section in CLUSTER_OPTION_SETS}
+    for section, (xpath, set_id) in CLUSTER_OPTION_SETS.items():
+        for element in root.findall(
+                "configuration/{}[@id='{}']/nvpair".format(xpath, set_id)):
+            options[section][element.attrib['name']] = element.attrib['value']
+    return options
+
+
+def get_cluster_options():
+    """Retrieve the cluster properties and resource defaults in one query
+
+    :returns: dict of CLUSTER_OPTION_SETS section -> dict of name -> value
+    """
+    output = subprocess.check_output(['crm', 'configure', 'show', 'xml'],
+                                     universal_newlines=True)
+    return parse_cluster_options(output)
+
+
+def update_cluster_options(properties=None, rsc_defaults=None):
+    """Set the cluster properties and resource defaults which differ
+
+    The current values are read in one query and only the options with a
+    different value are written, with one crm command per option set, so a
+    hook which doesn't change anything doesn't bump the CIB epoch. The other
+    options of a set, e.g. dc-version maintained by pacemaker, are left
+    alone.
+
+    :param properties: dict of cluster property -> value
+    :param rsc_defaults: dict of resource default -> value
+    :returns: exit code of crm, 0 if nothing had to change
+    """
+    desired = {'property': properties or {},
+               'rsc_defaults': rsc_defaults or {}}
+    current = get_cluster_options()
+    retcode = 0
+    changed = False
+    for section in sorted(CLUSTER_OPTION_SETS):
+        changes = {name: str(value)
+                   for name, value in desired[section].items()
+                   if current[section].get(name) != str(value)}
+        if not changes:
+            continue
+        changed = True
+        log('Updating {} {}'.format(section, changes), level=INFO)
+        code = commit('crm configure {} {}'.format(
+            section, ' '.join('{}={}'.format(name, value)
+                              for name, value in sorted(changes.items()))))
+        if code != 0:
+            log('Failed to update the cluster {}, crm exit code: {}'.format(
+                section, code), level=WARNING)
+            retcode = retcode or code
+    if not changed:
+        log('Cluster options unchanged', level=DEBUG)
+    return retcode
 
 
 def crm_version():
@@ -227,17 +420,23 @@ def crm_version():
         return StrictVersion(matched.group(1))
 
 
-def crm_update_resource(res_name, res_type, res_params=None, force=False):
+def crm_update_resource(res_name, res_type, res_params=None, force=False,
+                        checksums=None):
     """Update a resource using `crm configure load update`
 
     :param res_name: resource name
     :param res_type: resource type (e.g. IPaddr2)
     :param res_params: resource's parameters (e.g. "params ip=10.5.250.250")
+    :param checksums: checksums read with resource_checksums, the checksum of
+                      the resource is then read from and updated in this dict
+                      instead of unitdata, see save_resource_checksums
     """
     db = unitdata.kv()
+    key = resource_checksum_key(res_name, res_type)
     res_hash = resource_checksum(res_name, res_type, res_params)
+    stored = db.get(key) if checksums is None else checksums.get(key)
 
-    if not force and db.get('{}-{}'.format(res_name, res_type)) == res_hash:
+    if not force and stored == res_hash:
         log("Resource {} already defined and parameters haven't changed"
             .format(res_name))
         return 0
@@ -265,11 +464,40 @@ def crm_update_resource(res_name, res_type, res_params=None, force=False):
         log('crm command exit code: {}'.format(retcode), level=level)
 
         if retcode == 0:
-            db.set('{}-{}'.format(res_name, res_type), res_hash)
+            if checksums is None:
+                db.set(key, res_hash)
+            else:
+                checksums[key] = res_hash
 
         return retcode
 
 
+def resource_checksum_key(res_name, res_type):
+    """Return the unitdata key of the checksum of a resource"""
+    return '{}-{}'.format(res_name, res_type)
+
+
+def resource_checksums(resources):
+    """Read the stored checksums of many resources in one query
+
+    :param resources: dict of resource name -> type
+    :returns: dict of resource_checksum_key -> checksum of the resources
+              with a stored checksum
+    """
+    return unitstate.getmany(unitdata.kv(),
+                             [resource_checksum_key(name, _type)
+                              for name, _type in resources.items()])
+
+
+def save_resource_checksums(checksums):
+    """Store the checksums updated by crm_update_resource
+
+    :param checksums: dict of resource_checksum_key -> checksum
+    :returns: list of the keys whose checksum changed
+    """
+    return unitstate.setmany(unitdata.kv(), checksums)
+
+
 def resource_checksum(res_name, res_type, res_params=None):
     """Create a md5 checksum of the resource parameters.
 
@@ -283,3 +511,148 @@ def resource_checksum(res_name, res_type, res_params=None):
     if res_params is not None:
         m.update(res_params.encode('utf-8'))
     return m.hexdigest()
+
+
+def normalize_agent(res_type):
+    """Return the agent of a resource as class:provider:type
+
+    :param res_type: resource type (e.g. IPaddr2 or ocf:heartbeat:IPaddr2),
+                     crm defaults to the ocf:heartbeat agents
+    """
+    if ':' not in res_type:
+        return 'ocf:heartbeat:{}'.format(res_type)
+    return res_type
+
+
+def parse_params(res_params):
+    """Return the instance attributes set by a primitive definition
+
+    :param res_params: resource's parameters (e.g. "params ip=10.5.250.250
+                       op monitor interval=10s")
+    :returns: dict of parameter -> value
+    :raises: ValueError if the quoting is wrong
+    """
+    params = {}
+    # attributes before any section are params too
+    in_params = True
+    for token in shlex.split(res_params or ''):
+        if token in PRIMITIVE_SECTIONS:
+            in_params = token == 'params'
+        elif in_params and '=' in token:
+            name, value = token.split('=', 1)
+            params[name] = value
+    return params
+
+
+def parse_agent_metadata(output):
+    """Return the parameters described by the metadata of a resource agent
+
+    :param output: string with the XML of `crm_resource --show-metadata`
+    :returns: dict of parameter -> {'required': bool, 'default': str}
+    """
+    params = {}
+    for param in etree.fromstring(output).findall('parameters/parameter'):
+        content = param.find('content')
+        params[param.attrib['name']] = {
+            'required': param.attrib.get('required') == '1',
+            'default': (content.attrib.get('default')
+                        if content is not None else None),
+        }
+    return params
+
+
+def agent_metadata(agent, cache=None):
+    """Return the parameters of an OCF resource agent
+
+    The metadata is cached in unitdata with a checksum of the agent script,
+    it is only read again once the agent was upgraded.
+
+    :param agent: agent as ocf:provider:type
+    :param cache: metadata read with cached_agent_metadata, the metadata of
+                  the agent is then looked up and added there
+    :returns: dict, see parse_agent_metadata, None if the agent isn't
+              installed or its metadata can't be read
+    """
+    _, provider, _type = agent.split(':')
+    version = file_hash(os.path.join(OCF_ROOT, provider, _type), 'sha256')
+    if version is None:
+        return None
+
+    db = unitdata.kv()
+    key = RA_METADATA_KEY.format(agent)
+    cached = db.get(key) if cache is None else cache.get(agent)
+    if cached and cached['version'] == version:
+        return cached['parameters']
+
+    try:
+        params = parse_agent_metadata(subprocess.check_output(
+            ['crm_resource', '--show-metadata', agent],
+            universal_newlines=True))
+    except (subprocess.CalledProcessError, OSError, etree.ParseError) as e:
+        log('Unable to read the metadata of {}: {}'.format(agent, e),
+            level=WARNING)
+        return None
+    cached = {'version': version, 'parameters': params}
+    if cache is not None:
+        cache[agent] = cached
+    db.set(key, cached)
+    db.flush()
+    return params
+
+
+def cached_agent_metadata():
+    """Read the metadata cached for all the agents in one query
+
+    :returns: dict of agent -> cached metadata, see agent_metadata
+    """
+    return unitstate.getrange(unitdata.kv(), RA_METADATA_PREFIX, strip=True)
+
+
+def clear_agent_metadata():
+    """Forget the metadata cached for all the agents"""
+    db = unitdata.kv()
+    unitstate.unsetrange(db, RA_METADATA_PREFIX)
+    db.flush()
+
+
+def validate_resource_params(res_type, res_params=None, cache=None,
+                             existing=False):
+    """Check the parameters of a resource against the metadata of its agent
+
+    Only OCF agents are checked, LSB and systemd agents take no parameters.
+
+    :param res_type: resource type (e.g. IPaddr2)
+    :param res_params: resource's parameters (e.g. "params ip=10.5.250.250")
+    :param cache: metadata read with cached_agent_metadata
+    :param existing: the resource is already configured, its unknown
+                     parameters, e.g. removed from a newer agent, are only
+                     logged so the clusters carrying them can be upgraded
+    :returns: list of the problems found, empty if the parameters are valid
+              or the agent can't be checked
+    """
+    agent = normalize_agent(res_type)
+    if not agent.startswith('ocf:') or agent.count(':') != 2:
+        return []
+    try:
+        params = parse_params(res_params)
+    except ValueError as e:
+        return ['unable to parse "{}": {}'.format(res_params, e)]
+    metadata = agent_metadata(agent, cache)
+    if metadata is None:
+        return []
+
+    errors = []
+    unknown = sorted(set(params) - set(metadata))
+    if unknown:
+        error = 'unknown parameters for {}: {}'.format(agent,
+                                                       ', '.join(unknown))
+        if existing:
+            log(error, level=WARNING)
+        else:
+            errors.append(error)
+    missing = sorted(name for name, param in metadata.items()
+                     if param['required'] and name not in params)
+    if missing:
+        errors.append('missing required parameters for {}: {}'.format(
+            agent, ', '.join(missing)))
+    return errors
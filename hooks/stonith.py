@@ -0,0 +1,361 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import time
+import xml.etree.ElementTree as etree
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    DEBUG,
+    ERROR,
+    WARNING,
+)
+
+from hooktools import log
+
+STONITH_HEALTH_KEY = 'stonith-health'
+# How long probe results are trusted before the devices are probed again.
+# A bit longer than the default update-status interval (5 minutes): results
+# which are exactly one interval old are used, the devices are probed every
+# other update-status.
+STONITH_HEALTH_TTL = 330
+# Upper bound for a single probe, all probes run concurrently so this is
+# also (roughly) the upper bound for a full health check.
+STONITH_PROBE_TIMEOUT = 10
+STONITH_PROBE_WORKERS = 8
+
+# Packages providing the fence agents used by the backends
+PACKAGES = ['fence-agents']
+
+FencingDevice = namedtuple('FencingDevice',
+                           ['resource', 'node', 'agent', 'params'])
+
+
+def list_fencing_devices():
+    """List the STONITH primitives configured in the CIB.
+
+    :returns: fencing devices found in the resources section of the CIB
+    :rtype: list of FencingDevice
+    """
+    out = subprocess.check_output(['cibadmin', '--query',
+                                   '--scope', 'resources'],
+                                  universal_newlines=True)
+    return parse_fencing_devices(out)
+
+
+def parse_fencing_devices(output):
+    """Parse the STONITH primitives from the resources section of the CIB
+
+    :param output: string with the output of `cibadmin -Q -o resources`
+    :returns: fencing devices sorted by resource name
+    :rtype: list of FencingDevice
+    """
+    root = etree.fromstring(output)
+    devices = []
+    for primitive in root.iter('primitive'):
+        if primitive.attrib.get('class') != 'stonith':
+            continue
+
+        params = {}
+        for attrs in primitive.findall('instance_attributes'):
+            for nvpair in attrs.findall('nvpair'):
+                params[nvpair.attrib['name']] = nvpair.attrib.get('value')
+
+        rsc_name = primitive.attrib['id']
+        node = (params.get('hostname') or params.get('pcmk_host_list') or
+                rsc_name.replace('res_stonith_', ''))
+        devices.append(FencingDevice(rsc_name, node,
+                                     primitive.attrib.get('type'), params))
+
+    return sorted(devices, key=lambda d: d.resource)
+
+
+def _run_probe(cmd, timeout, env=None, stdin=None):
+    """Run a probe command, never waiting longer than timeout seconds
+
+    :returns: tuple of (healthy, message)
+    """
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                      timeout=timeout, env=env, input=stdin,
+                                      universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        return False, 'no answer after {}s'.format(timeout)
+    except subprocess.CalledProcessError as e:
+        lines = (e.output or '').strip().splitlines()
+        return False, lines[-1] if lines else 'exit code {}'.format(
+            e.returncode)
+    except OSError as e:
+        return False, str(e)
+
+    return True, out.strip() or 'OK'
+
+
+def _probe_ipmi(params, timeout):
+    """Query the chassis power status of an external/ipmi device."""
+    # NOTE: the password is handed over through the environment so it does
+    #       not show up in the process list.
+    missing = [name for name in ('ipaddr', 'userid') if not params.get(name)]
+    if missing:
+        return False, 'missing {}'.format(', '.join(missing))
+    env = dict(os.environ, IPMI_PASSWORD=params.get('passwd') or '')
+    cmd = ['ipmitool', '-I', params.get('interface') or 'lan',
+           '-H', params.get('ipaddr'), '-U', params.get('userid'), '-E',
+           '-N', str(max(1, timeout // 2)), '-R', '1',
+           'chassis', 'power', 'status']
+    return _run_probe(cmd, timeout, env=env)
+
+
+def _probe_fence_agent(agent, params, timeout):
+    """Run a fence agent's monitor action against its device.
+
+    Options are passed on stdin, as pacemaker does, which keeps the
+    credentials out of the process list.
+    """
+    options = dict(params, action='monitor')
+    options.pop('pcmk_host_list', None)
+    stdin = ''.join('{}={}\n'.format(k, v) for k, v in sorted(options.items()))
+    return _run_probe([agent], timeout, stdin=stdin)
+
+
+class StonithBackend(object):
+    """Builds the fencing primitive for a MAAS power type.
+
+    Subclasses map the MAAS power parameters of a node onto the parameters
+    of a fence agent. The connection timeouts are kept short by default
+    since they add directly to the time needed to fence a node, and so to
+    the failover time.
+    """
+    # MAAS power_type handled by the backend
+    power_type = None
+    # fence agent, as found in /usr/sbin
+    agent = None
+    # fence agent connection timeouts (seconds)
+    timeouts = {}
+
+    def agent_params(self, node, power_params):
+        """Return the fence agent parameters as a list of (name, value)
+
+        :param node: name of the node fenced by the device
+        :param power_params: power parameters of the node in MAAS
+        :returns: list of (name, value), None if the node can't be fenced
+        """
+        log('No fence agent parameters for {} power_type {}'
+            .format(node, self.power_type), level=ERROR)
+        return None
+
+    def primitive(self, node, power_params, timeouts=None):
+        """Return the crm definitions of the fencing primitive for node
+
+        :param node: name of the node fenced by the device
+        :param power_params: power parameters of the node in MAAS
+        :param timeouts: dict overriding the backend connection timeouts
+        :returns: tuple of (primitive, location constraint), (False, False)
+                  if the node can't be fenced
+        """
+        agent_params = self.agent_params(node, power_params)
+        if agent_params is None:
+            return False, False
+
+        _timeouts = dict(self.timeouts)
+        _timeouts.update(timeouts or {})
+        params = [('pcmk_host_list', node)]
+        params += agent_params
+        params += sorted(_timeouts.items())
+
+        rsc_name = 'res_stonith_%s' % node
+        rsc = 'primitive %s stonith:%s params %s' % (
+            rsc_name, self.agent,
+            ' '.join('%s=%s' % (k, v) for k, v in params))
+        # ensure stonith agents are not running on the nodes that
+        # they manage.
+        constraint = ('location const_loc_stonith_avoid_%s %s -inf: %s' %
+                      (node, rsc_name, node))
+        return rsc, constraint
+
+    def probe(self, params, timeout):
+        return _probe_fence_agent(self.agent, params, timeout)
+
+
+class IpmiBackend(StonithBackend):
+    power_type = 'ipmi'
+    agent = 'fence_ipmilan'
+    timeouts = {'login_timeout': 5, 'power_timeout': 10, 'shell_timeout': 5}
+
+    def agent_params(self, node, power_params):
+        params = [('ipaddr', power_params['power_address']),
+                  ('login', power_params['power_user']),
+                  ('passwd', power_params['power_pass'])]
+        # MAAS only selects LAN (IPMI 1.5) when LAN_2_0 is not supported
+        if power_params.get('power_driver') != 'LAN':
+            params.append(('lanplus', 1))
+        return params
+
+
+class RedfishBackend(StonithBackend):
+    power_type = 'redfish'
+    agent = 'fence_redfish'
+    # BMC web services are typically slower to answer than IPMI
+    timeouts = {'login_timeout': 10, 'power_timeout': 20,
+                'shell_timeout': 10}
+
+    def agent_params(self, node, power_params):
+        params = [('ipaddr', power_params['power_address']),
+                  ('login', power_params['power_user']),
+                  ('passwd', power_params['power_pass']),
+                  ('ssl_insecure', 1)]
+        if power_params.get('node_id'):
+            params.append(('systems_uri', '/redfish/v1/Systems/%s' %
+                           power_params['node_id']))
+        return params
+
+
+class VirshBackend(StonithBackend):
+    power_type = 'virsh'
+    agent = 'fence_virsh'
+    timeouts = {'login_timeout': 5, 'power_timeout': 10, 'shell_timeout': 5}
+
+    def agent_params(self, node, power_params):
+        # power_address is a libvirt URI, e.g. qemu+ssh://user@host/system
+        url = urlparse(power_params['power_address'])
+        if not url.hostname:
+            # e.g. qemu:///system, the hypervisor of the node isn't known
+            log('Unable to fence {}, libvirt URI {} has no host'
+                .format(node, power_params['power_address']), level=ERROR)
+            return None
+        params = [('ipaddr', url.hostname),
+                  ('login', url.username or 'root'),
+                  ('port', power_params['power_id'])]
+        if power_params.get('power_pass'):
+            params.append(('passwd', power_params['power_pass']))
+        return params
+
+
+# MAAS power_type -> backend
+BACKENDS = {b.power_type: b() for b in (IpmiBackend,
+                                        RedfishBackend,
+                                        VirshBackend)}
+
+
+def get_backend(power_type):
+    """Return the backend for a MAAS power type, None if unsupported"""
+    return BACKENDS.get(power_type)
+
+
+def parse_timeouts(value):
+    """Parse per backend timeout overrides
+
+    :param value: string of space separated power_type:name=value items,
+                  e.g. "redfish:power_timeout=30 ipmi:login_timeout=3"
+    :returns: dict of power_type -> dict of timeout name -> value
+    :raises: ValueError if an item is malformed
+    """
+    timeouts = {}
+    for item in (value or '').split():
+        try:
+            power_type, setting = item.split(':', 1)
+            name, seconds = setting.split('=', 1)
+            timeouts.setdefault(power_type, {})[name] = int(seconds)
+        except ValueError:
+            raise ValueError('Invalid STONITH timeout: %s' % item)
+    return timeouts
+
+
+# Fencing agent type -> function(params, timeout) returning (healthy, message)
+PROBES = {
+    'external/ipmi': _probe_ipmi,
+}
+for _backend in BACKENDS.values():
+    PROBES[_backend.agent] = _backend.probe
+
+
+def probe_device(device, timeout=STONITH_PROBE_TIMEOUT):
+    """Check that the power interface behind a fencing device answers.
+
+    :param device: FencingDevice to probe
+    :param timeout: seconds after which the device is considered dead
+    :returns: dict with the 'resource', 'healthy' and 'message' keys
+    """
+    probe = PROBES.get(device.agent)
+    if probe is None:
+        healthy, message = True, 'no probe for {}'.format(device.agent)
+    else:
+        healthy, message = probe(device.params, timeout)
+
+    if not healthy:
+        log('Fencing device {} for {} is not answering: {}'
+            .format(device.resource, device.node, message), level=WARNING)
+
+    return {'resource': device.resource,
+            'healthy': healthy,
+            'message': message}
+
+
+def probe_devices(devices, timeout=STONITH_PROBE_TIMEOUT,
+                  workers=STONITH_PROBE_WORKERS):
+    """Probe all the fencing devices concurrently
+
+    :param devices: list of FencingDevice
+    :returns: dict of node name -> probe result
+    """
+    if not devices:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(devices))) as pool:
+        results = pool.map(lambda d: probe_device(d, timeout), devices)
+        return {d.node: r for d, r in zip(devices, results)}
+
+
+def check_fencing_devices(max_age=STONITH_HEALTH_TTL, force=False):
+    """Return the health of every fencing device, probing if needed.
+
+    Results are kept in the unit's kv store and reused while they are younger
+    than max_age seconds.
+
+    :param max_age: maximum age in seconds of cached results
+    :param force: ignore any cached results
+    :returns: dict of node name -> probe result
+    """
+    db = unitdata.kv()
+    cached = db.get(STONITH_HEALTH_KEY)
+    if (not force and cached and
+            time.time() - cached['timestamp'] < max_age):
+        log('Using cached fencing device health', level=DEBUG)
+        return cached['results']
+
+    results = probe_devices(list_fencing_devices())
+    db.set(STONITH_HEALTH_KEY, {'timestamp': time.time(),
+                                'results': results})
+    db.flush()
+    return results
+
+
+def cached_fencing_health():
+    """Return the last fencing device probe results without probing.
+
+    :returns: dict of node name -> probe result, empty if never probed
+    """
+    cached = unitdata.kv().get(STONITH_HEALTH_KEY)
+    return cached['results'] if cached else {}
+
+
+def unhealthy_nodes(results):
+    """Return the sorted names of the nodes whose fencing device is down."""
+    return sorted(node for node, r in results.items() if not r['healthy'])
@@ -0,0 +1,120 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import re
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from charmhelpers.core.hookenv import (
+    DEBUG,
+    WARNING,
+)
+
+from hooktools import log
+
+# leader setting holding the worst peer RTT (ms) measured by the leader
+PEER_RTT_KEY = 'corosync-peer-rtt'
+
+# Totem timings, all in ms
+PROFILES = {
+    # the values corosync.conf used to hard code
+    'default': {'token': 3000,
+                'token_retransmits_before_loss_const': 10,
+                'join': 60,
+                'consensus': 3600,
+                'max_messages': 20},
+    # dedicated, low latency network: detect failures fast
+    'low-latency': {'token': 1000,
+                    'token_retransmits_before_loss_const': 4,
+                    'join': 50,
+                    'consensus': 1200,
+                    'max_messages': 20},
+    # nodes spread across racks or sites
+    'wan': {'token': 10000,
+            'token_retransmits_before_loss_const': 10,
+            'join': 1000,
+            'consensus': 12000,
+            'max_messages': 10},
+    # many nodes: the token takes longer to go around
+    'large': {'token': 5000,
+              'token_retransmits_before_loss_const': 10,
+              'join': 100,
+              'consensus': 6000,
+              'max_messages': 50},
+}
+
+# The token has to go around every node, give it this many round trips per
+# node before it is declared lost.
+RTT_TOKEN_FACTOR = 20
+PING_COUNT = 5
+PING_WORKERS = 8
+
+
+def parse_ping_rtt(output):
+    """Return the maximum RTT (ms) reported by `ping -q`, None if missing"""
+    match = re.search(r'= [\d.]+/[\d.]+/([\d.]+)/[\d.]+ ms', output)
+    return float(match.group(1)) if match else None
+
+
+def ping(addr, count=PING_COUNT):
+    """Return the maximum RTT (ms) to addr, None if it doesn't answer"""
+    cmd = ['ping6' if ':' in addr else 'ping',
+           '-q', '-n', '-c', str(count), '-i', '0.2', '-W', '1', addr]
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        log('No answer from {}: {}'.format(addr, e.output), level=WARNING)
+        return None
+    return parse_ping_rtt(out)
+
+
+def measure_rtt(addresses, count=PING_COUNT):
+    """Ping all the addresses concurrently
+
+    :param addresses: list of addresses to ping
+    :returns: worst RTT (ms) measured, None if no address answered
+    """
+    if not addresses:
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(PING_WORKERS,
+                                            len(addresses))) as pool:
+        rtts = [rtt for rtt in pool.map(lambda a: ping(a, count), addresses)
+                if rtt is not None]
+    log('Peer RTTs (ms): {}'.format(rtts), level=DEBUG)
+    return max(rtts) if rtts else None
+
+
+def totem_settings(profile, node_count, rtt=None):
+    """Return the totem timings for the cluster
+
+    :param profile: name of the tuning profile, see PROFILES
+    :param node_count: number of nodes in the cluster
+    :param rtt: worst RTT (ms) between the nodes, if measured
+    :returns: dict of totem option -> value
+    :raises: KeyError if the profile doesn't exist
+    """
+    settings = dict(PROFILES[profile])
+    if rtt:
+        # round up to 100ms so small RTT variations don't change the config
+        token = int(math.ceil(RTT_TOKEN_FACTOR * max(node_count, 2) * rtt /
+                              100.0)) * 100
+        settings['token'] = max(settings['token'], token)
+    # corosync.conf(5): consensus must be at least 1.2 * token
+    settings['consensus'] = max(settings['consensus'],
+                                int(math.ceil(settings['token'] * 1.2)))
+    return settings
@@ -0,0 +1,214 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk operations and maintenance of the unit state database.
+
+charmhelpers.core.unitdata.Storage sets, gets and deletes one key per
+statement. The helpers below work on a Storage with batched statements and
+keep its semantics: unchanged keys aren't rewritten and the changes are
+recorded in the revision of the current hook scope.
+
+NOTE: charmhelpers is synced from upstream, these stay on the charm side
+until Storage offers them.
+"""
+
+import datetime
+import json
+import sys
+
+# SQLite limits a statement to 999 host parameters by default
+MAX_PARAMS = 500
+
+
+def _prefix_clause(prefix):
+    """Return the where clause and parameters matching the keys starting
+    with prefix
+
+    Unlike Storage.getrange's key like 'prefix%', which is case insensitive
+    and treats _ and % in the prefix as wildcards, a range on the key is
+    answered from the primary key index instead of scanning the whole table.
+    """
+    # the smallest string greater than all the strings starting with prefix
+    upper = prefix
+    while upper and upper[-1] == chr(sys.maxunicode):
+        upper = upper[:-1]
+    if not upper:
+        return 'key >= ?', [prefix]
+    upper = upper[:-1] + chr(ord(upper[-1]) + 1)
+    return 'key >= ? and key < ?', [prefix, upper]
+
+
+def enable_wal(db, synchronous='NORMAL'):
+    """Use write-ahead logging and relax the fsync policy
+
+    In WAL mode a commit only appends to the log, and with synchronous=NORMAL
+    it no longer waits for an fsync. A committed transaction is still safe
+    if the process crashes, it may only be rolled back by a power loss or an
+    OS crash. The journal mode is stored in the database, the synchronous
+    mode is per connection.
+
+    :param db: unitdata.Storage
+    :param synchronous: SQLite synchronous mode (OFF, NORMAL, FULL)
+    :returns: the journal mode in use, in-memory databases can't use WAL
+    """
+    db.cursor.execute('pragma journal_mode=wal')
+    mode = db.cursor.fetchone()[0]
+    db.cursor.execute('pragma synchronous=%s' % synchronous)
+    return mode
+
+
+def _select_many(db, keys):
+    """Return the (key, serialized data) of the keys found, querying
+    MAX_PARAMS keys at a time"""
+    keys = list(keys)
+    rows = []
+    for i in range(0, len(keys), MAX_PARAMS):
+        chunk = keys[i:i + MAX_PARAMS]
+        db.cursor.execute(
+            'select key, data from kv where key in (%s)' %
+            ','.join(['?'] * len(chunk)), chunk)
+        rows.extend(db.cursor.fetchall())
+    return rows
+
+
+def getmany(db, keys, prefix=''):
+    """Get the values of many keys with one query per MAX_PARAMS keys
+
+    :param db: unitdata.Storage
+    :param keys: keys to get
+    :param prefix: prefix of all the keys
+    :returns: dict of the keys found, without the prefix, to their values
+    """
+    return {k[len(prefix):]: json.loads(v)
+            for k, v in _select_many(db, ['%s%s' % (prefix, key)
+                                          for key in keys])}
+
+
+def getrange(db, prefix, strip=False):
+    """Get the keys starting with prefix from the primary key index
+
+    :param db: unitdata.Storage
+    :param prefix: common prefix of the keys
+    :param strip: strip the prefix from the keys returned
+    :returns: dict of the keys to their values
+    """
+    where, params = _prefix_clause(prefix)
+    db.cursor.execute('select key, data from kv where ' + where, params)
+    if not strip:
+        prefix = ''
+    return {k[len(prefix):]: json.loads(v) for k, v in db.cursor.fetchall()}
+
+
+def setmany(db, mapping, prefix=''):
+    """Set the values of many keys with batched statements
+
+    Like Storage.set, keys already holding the same value are left untouched
+    and the changes are recorded in the current revision.
+
+    :param db: unitdata.Storage
+    :param mapping: dict of keys to JSON-serializable values
+    :param prefix: prefix of all the keys
+    :returns: list of the keys changed, with the prefix
+    """
+    current = dict(_select_many(db, ['%s%s' % (prefix, key)
+                                     for key in mapping]))
+    changed = []
+    for k, v in mapping.items():
+        key = '%s%s' % (prefix, k)
+        serialized = json.dumps(v)
+        if current.get(key) != serialized:
+            changed.append((key, serialized))
+    if not changed:
+        return []
+
+    db.cursor.executemany(
+        'insert or replace into kv (key, data) values (?, ?)', changed)
+    if db.revision:
+        db.cursor.executemany(
+            'insert or replace into kv_revisions (revision, key, data) '
+            'values (?, ?, ?)',
+            [(db.revision, k, v) for k, v in changed])
+    return [k for k, _ in changed]
+
+
+def unsetrange(db, prefix):
+    """Remove the keys starting with prefix using the primary key index
+
+    Like Storage.unsetrange, the removal is recorded in the current revision
+    as the prefix followed by %.
+
+    :param db: unitdata.Storage
+    :param prefix: common prefix of the keys
+    """
+    where, params = _prefix_clause(prefix)
+    db.cursor.execute('delete from kv where ' + where, params)
+    if db.revision and db.cursor.rowcount:
+        db.cursor.execute(
+            'insert into kv_revisions values (?, ?, ?)',
+            ['%s%%' % prefix, db.revision, json.dumps('DELETED')])
+
+
+def prune(db, keep=None, max_age=None):
+    """Remove the revisions of the oldest hooks
+
+    The revisions recorded by Storage.hook_scope are otherwise kept forever.
+    Hooks beyond either limit are removed, the current one is always kept.
+
+    :param db: unitdata.Storage
+    :param keep: keep the revisions of the last keep hooks
+    :param max_age: datetime.timedelta, remove the revisions of hooks older
+                    than this
+    :returns: number of revisions removed
+    """
+    cutoff = 0
+    if keep is not None:
+        db.cursor.execute(
+            'select version from hooks order by version desc '
+            'limit 1 offset ?', [keep])
+        row = db.cursor.fetchone()
+        if row:
+            cutoff = max(cutoff, row[0])
+    if max_age is not None:
+        oldest = (datetime.datetime.utcnow() - max_age).isoformat()
+        db.cursor.execute(
+            'select max(version) from hooks where date < ?', [oldest])
+        row = db.cursor.fetchone()
+        if row[0] is not None:
+            cutoff = max(cutoff, row[0])
+    if db.revision:
+        cutoff = min(cutoff, db.revision - 1)
+    if not cutoff:
+        return 0
+
+    # kv_revisions is already indexed on (key, revision) by its primary key,
+    # this one serves the removal by revision
+    db.cursor.execute('create index if not exists kv_revisions_revision '
+                      'on kv_revisions (revision)')
+    db.cursor.execute('delete from kv_revisions where revision <= ?',
+                      [cutoff])
+    pruned = db.cursor.rowcount
+    db.cursor.execute('delete from hooks where version <= ?', [cutoff])
+    return pruned
+
+
+def vacuum(db):
+    """Commit, then rebuild the database file to give the space of removed
+    rows back to the filesystem and defragment it
+
+    :param db: unitdata.Storage
+    """
+    db.flush()
+    db.cursor.execute('vacuum')
+    # empty the write-ahead log as well, a no-op in rollback mode
+    db.cursor.execute('pragma wal_checkpoint(truncate)')
@@ -15,23 +15,43 @@
 # limitations under the License.
 
 import ast
+import cluster_metrics
+import datetime
+import cluster_state
+import glob
+import hashlib
 import pcmk
 import maas
+import stonith
+import totem
+import unitstate
 import json
 import os
+import grp
+import pwd
+import random
 import re
+import shutil
+import signal
 import subprocess
 import socket
 import fcntl
 import struct
+import threading
 import time
 import xml.etree.ElementTree as ET
+import yaml
 
 from base64 import b64decode
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
+    cached,
+    charm_dir,
+    is_leader,
+    leader_get,
+    leader_set,
     local_unit,
-    log,
     DEBUG,
     ERROR,
     INFO,
@@ -39,10 +59,16 @@ from charmhelpers.core.hookenv import (
     relation_get,
     related_units,
     relation_ids,
+    relation_set,
     config,
     unit_get,
+)
+
+from hooktools import (
+    log,
     status_set,
 )
+
 from charmhelpers.contrib.openstack.utils import (
     get_host_ip,
     set_unit_paused,
@@ -59,20 +85,21 @@ from charmhelpers.core.host import (
     service_start,
     service_stop,
     service_running,
+    service_reload,
     write_file,
     file_hash,
     lsb_release,
     init_is_systemd,
     CompareHostReleases,
+    modulo_distribution,
 )
 from charmhelpers.fetch import (
     apt_install,
     add_source,
     apt_update,
+    filter_installed_packages,
 )
-from charmhelpers.contrib.hahelpers.cluster import (
-    peer_ips,
-)
+from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.network import ip as utils
 
 try:
@@ -108,6 +135,10 @@ COROSYNC_CONF_FILES = [
     COROSYNC_HACLUSTER_ACL,
 ]
 SUPPORTED_TRANSPORTS = ['udp', 'udpu', 'multicast', 'unicast']
+SUPPORTED_RRP_MODES = ['none', 'passive', 'active']
+SUPPORTED_RESOURCE_WAIT_MODES = ['serial', 'batch']
+# extra-binding providing the addresses of the redundant ring
+RING1_BINDING = 'corosync-ring1'
 PCMKR_MAX_RETRIES = 3
 PCMKR_SLEEP_SECS = 5
 
@@ -117,6 +148,45 @@ SYSTEMD_OVERRIDES_FILE = '{}/overrides.conf'
 
 MAAS_DNS_CONF_DIR = '/etc/maas_dns'
 
+CLUSTER_STATE_CRON = '/etc/cron.d/hacluster-cluster-state'
+# unitdata key of the path the cluster metrics are exported to
+PROMETHEUS_TEXTFILE_KEY = 'prometheus-textfile'
+
+NRPE_CHECKS_KEY = 'nrpe-checks-hash'
+# number of corosync rings expected by the crm_status NRPE check
+NRPE_RING_COUNT_KEY = 'nrpe-ring-count'
+
+HOST_IP_CACHE_KEY = 'host-ip-cache'
+# Cached answers younger than this are used without asking DNS again
+HOST_IP_CACHE_TTL = 3600
+# How long to wait for DNS before falling back to a stale cached answer
+HOST_IP_RESOLVE_TIMEOUT = 5
+
+# Retention of the hook revisions recorded in unitdata: a day of
+# update-status hooks, and never more than a week.
+UNIT_STATE_KEEP_HOOKS = 288
+UNIT_STATE_MAX_AGE = datetime.timedelta(days=7)
+UNIT_STATE_VACUUM_KEY = 'unit-state-vacuumed'
+UNIT_STATE_VACUUM_INTERVAL = 86400
+
+# leader setting holding the fingerprint of the cluster wide configuration
+# last applied by the leader
+CLUSTER_GLOBALS_KEY = 'cluster-globals-fingerprint'
+# config options the cluster wide configuration is derived from
+CLUSTER_GLOBALS_OPTIONS = ['stonith_enabled', 'stonith_timeouts', 'maas_url',
+                           'maas_credentials', 'monitor_host',
+                           'monitor_interval']
+# properties of the systemd units of the services put under pacemaker control
+SYSTEMD_UNIT_PROPERTIES = ['LoadState', 'ActiveState', 'UnitFileState']
+# unit file states of units which won't be started at boot
+DISABLED_UNIT_FILE_STATES = ('disabled', 'masked', 'static', 'indirect')
+# seconds a process has to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 10
+# interpreters whose processes are named after the script they run
+INTERPRETERS = re.compile(r'^(python|perl)[\d.]*$')
+# leader setting holding the admission slot of each peer unit
+ADMISSION_SLOTS_KEY = 'admission-slots'
+
 
 class MAASConfigIncomplete(Exception):
     pass
@@ -145,6 +215,67 @@ def enable_lsb_services(*services):
         subprocess.check_call(['update-rc.d', '-f', service, 'defaults'])
 
 
+def systemd_unit_states(services):
+    """Query the state of the systemd units of services at once
+
+    @param services: list of service names
+    @returns dict - service -> dict of LoadState, ActiveState and
+                    UnitFileState
+    """
+    if not services:
+        return {}
+    cmd = ['systemctl', 'show', '--property={}'.format(
+        ','.join(SYSTEMD_UNIT_PROPERTIES)), '--'] + list(services)
+    output = subprocess.check_output(cmd, universal_newlines=True)
+    # one block of properties per unit, in the order they were given
+    blocks = [block for block in output.split('\n\n') if block.strip()]
+    states = {}
+    for service, block in zip(services, blocks):
+        states[service] = dict(line.split('=', 1)
+                               for line in block.splitlines() if '=' in line)
+    return states
+
+
+def disable_init_services(lsb_services=(), upstart_services=()):
+    """Disable and stop the services put under pacemaker control
+
+    On systemd the state of all the units is read with one `systemctl show`
+    and the ones which are still enabled or running are disabled and
+    stopped in one `systemctl disable --now` transaction. They aren't
+    masked, pacemaker starts them through their init script or unit.
+
+    @param lsb_services: list of services with an LSB init script
+    @param upstart_services: list of services with an upstart job
+    """
+    services = sorted(set(lsb_services) | set(upstart_services))
+    if not services:
+        return
+    if not init_is_systemd():
+        disable_lsb_services(*lsb_services)
+        disable_upstart_services(*upstart_services)
+        for service in services:
+            if service_running(service):
+                service_stop(service)
+        return
+
+    pending = []
+    for service, state in sorted(systemd_unit_states(services).items()):
+        if state.get('LoadState') == 'not-found':
+            log('Service {} not found, not disabling it'.format(service),
+                level=WARNING)
+        elif (state.get('UnitFileState') not in DISABLED_UNIT_FILE_STATES or
+                state.get('ActiveState') not in ('inactive', 'failed')):
+            pending.append(service)
+    if pending:
+        log('Disabling and stopping {}'.format(', '.join(pending)),
+            level=INFO)
+        subprocess.check_call(['systemctl', 'disable', '--now', '--'] +
+                              pending)
+    else:
+        log('Services {} already disabled'.format(', '.join(services)),
+            level=DEBUG)
+
+
 def get_iface_ipaddr(iface):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     return socket.inet_ntoa(fcntl.ioctl(
@@ -230,11 +361,16 @@ def get_corosync_conf():
 
     # NOTE(jamespage) use local charm configuration over any provided by
     # principle charm
+    ha_nodes = get_ha_nodes()
+    rings = get_ring_conf(transport, ha_nodes)
+    totem_conf = get_totem_conf(len(ha_nodes))
     conf = {
         'ip_version': ip_version,
-        'ha_nodes': get_ha_nodes(),
+        'ha_nodes': ha_nodes,
         'transport': transport,
+        'totem': totem_conf,
     }
+    conf.update(rings)
 
     # NOTE(jamespage): only populate multicast configuration if udp is
     #                  configured
@@ -264,9 +400,11 @@ def get_corosync_conf():
         for unit in related_units(relid):
             conf = {
                 'ip_version': ip_version,
-                'ha_nodes': get_ha_nodes(),
+                'ha_nodes': ha_nodes,
                 'transport': transport,
+                'totem': totem_conf,
             }
+            conf.update(rings)
 
             # NOTE(jamespage): only populate multicast configuration if udpu is
             #                  configured
@@ -398,6 +536,217 @@ def get_transport():
     return val
 
 
+def get_rrp_mode():
+    """Return the redundant ring protocol mode set in the charm config"""
+    rrp_mode = config('corosync_rrp_mode') or 'none'
+    if rrp_mode not in SUPPORTED_RRP_MODES:
+        msg = ("Unsupported corosync_rrp_mode '%s' - supported modes are: %s"
+               % (rrp_mode, ', '.join(SUPPORTED_RRP_MODES)))
+        status_set('blocked', msg)
+        raise ValueError(msg)
+    return rrp_mode
+
+
+def get_resource_wait_mode():
+    """Return how the leader waits for the cluster to settle while it
+    configures the resources, as set in the charm config"""
+    wait_mode = config('resource_wait_mode') or 'serial'
+    if wait_mode not in SUPPORTED_RESOURCE_WAIT_MODES:
+        msg = ("Unsupported resource_wait_mode '%s' - supported modes are: "
+               "%s" % (wait_mode, ', '.join(SUPPORTED_RESOURCE_WAIT_MODES)))
+        status_set('blocked', msg)
+        raise ValueError(msg)
+    return wait_mode
+
+
+def get_ring1_addr():
+    """Return the address of this unit on the redundant ring"""
+    return utils.get_relation_ip(RING1_BINDING)
+
+
+def get_ring_conf(transport, ha_nodes):
+    """Return the corosync.conf context of the redundant ring
+
+    The second ring runs over the network space bound to the corosync-ring1
+    extra-binding, every peer publishes its address there as ring1-address.
+    It's only configured once all the nodes have published a ring1 address
+    distinct from their ring0 one.
+
+    @param transport: corosync transport, see get_transport
+    @param ha_nodes: dict of corosync id -> ring0 address, see get_ha_nodes
+    @returns dict - with the 'rrp_mode' and 'ring1_nodes' (corosync id ->
+                    ring1 address) keys, empty if the ring isn't configured
+    """
+    rrp_mode = get_rrp_mode()
+    if rrp_mode == 'none':
+        return {}
+    if transport != 'udpu':
+        log('corosync_rrp_mode requires the unicast transport, not '
+            'configuring the redundant ring', level=WARNING)
+        return {}
+
+    topology = peer_topology()
+    ring1_nodes = {get_corosync_id(local_unit()): get_ring1_addr()}
+    for unit, corosync_id in topology.corosync_ids.items():
+        ring1_nodes[corosync_id] = topology.settings[unit].get(
+            'ring1-address')
+
+    missing = sorted(nodeid for nodeid, addr in ha_nodes.items()
+                     if not ring1_nodes.get(nodeid) or
+                     ring1_nodes[nodeid] == addr)
+    if missing:
+        log('Redundant ring address not available yet for nodes {}, '
+            'not configuring the redundant ring'.format(missing),
+            level=WARNING)
+        return {}
+
+    return {'rrp_mode': rrp_mode, 'ring1_nodes': ring1_nodes}
+
+
+def corosync_ring_count():
+    """Number of corosync rings configured in corosync.conf
+
+    The redundant ring is only configured once the transport and all the
+    peers allow it, see get_ring_conf.
+    """
+    if get_rrp_mode() == 'none':
+        return 1
+    return 2 if get_ring_conf(get_transport(), get_ha_nodes()) else 1
+
+
+def nrpe_ring_count_changed():
+    """Whether the crm_status NRPE check expects another number of rings
+
+    @returns boolean - True if the NRPE checks have to be refreshed
+    """
+    return unitdata.kv().get(NRPE_RING_COUNT_KEY) != corosync_ring_count()
+
+
+def set_nrpe_ring_count(count):
+    """Record the number of rings expected by the crm_status NRPE check"""
+    db = unitdata.kv()
+    db.set(NRPE_RING_COUNT_KEY, count)
+    db.flush()
+
+
+def get_totem_profile():
+    """Return the totem tuning profile set in the charm config"""
+    profile = config('corosync_totem_profile') or 'default'
+    if profile not in totem.PROFILES:
+        msg = ("Unsupported corosync_totem_profile '%s' - supported "
+               "profiles are: %s" % (profile,
+                                     ', '.join(sorted(totem.PROFILES))))
+        status_set('blocked', msg)
+        raise ValueError(msg)
+    return profile
+
+
+def get_totem_conf(node_count):
+    """Return the totem timings to render in corosync.conf
+
+    When corosync_measure_rtt is set the token is stretched to the peer RTT
+    measured by the leader, see update_peer_rtt. Every unit derives the same
+    values from the leader's measure.
+
+    @param node_count: number of nodes in the cluster
+    @returns dict - totem option -> value
+    """
+    rtt = None
+    if config('corosync_measure_rtt'):
+        rtt = leader_get(totem.PEER_RTT_KEY)
+    return totem.totem_settings(get_totem_profile(), node_count,
+                                float(rtt) if rtt else None)
+
+
+def update_peer_rtt():
+    """Measure the RTT to the peers and share it with the other units
+
+    Only meant to be run by the leader. The measure is only published when
+    it changes the totem timings, so the peers don't restart corosync for
+    nothing.
+
+    @returns boolean - True if a new measure was published
+    """
+    ha_nodes = get_ha_nodes()
+    rtt = totem.measure_rtt(sorted(peer_topology().addresses.values()))
+    if rtt is None:
+        return False
+
+    profile = get_totem_profile()
+    current = leader_get(totem.PEER_RTT_KEY)
+    if (current and
+            totem.totem_settings(profile, len(ha_nodes), float(current)) ==
+            totem.totem_settings(profile, len(ha_nodes), rtt)):
+        log('Peer RTT {}ms does not change the totem timings'.format(rtt),
+            level=DEBUG)
+        return False
+
+    log('Publishing peer RTT {}ms'.format(rtt), level=INFO)
+    leader_set({totem.PEER_RTT_KEY: '{:.3f}'.format(rtt)})
+    return True
+
+
+def assign_admission_slots():
+    """Spread the peers over the admission slots and share the assignment
+
+    Only meant to be run by the leader, which never waits for a slot. The
+    assignment is only published when it changes.
+
+    @returns boolean - True if a new assignment was published
+    """
+    slots = int(config('admission_slots') or 0)
+    assignment = {}
+    if slots > 0:
+        peers = sorted(peer_topology().units,
+                       key=lambda u: int(u.split('/')[-1]))
+        assignment = {unit: i % slots for i, unit in enumerate(peers)}
+    value = json.dumps(assignment, sort_keys=True)
+    if leader_get(ADMISSION_SLOTS_KEY) == value:
+        return False
+
+    log('Publishing admission slots {}'.format(value), level=INFO)
+    leader_set({ADMISSION_SLOTS_KEY: value})
+    return True
+
+
+def admission_wait(operation_name='operation'):
+    """Wait for the admission slot of this unit plus a random jitter
+
+    Every unit runs ha-relation-changed at the same time when the principal
+    changes its relation data. The non-leaders wait here before querying the
+    cluster so the DC doesn't get all their CIB queries at once: slot N
+    waits (N + 1) * admission_slot_wait seconds, then up to hook_jitter
+    more seconds. A unit without a slot yet, e.g. one which just joined,
+    uses its unit number instead, see modulo_distribution.
+
+    @param operation_name: str - what is delayed, for the log
+    @returns float - seconds waited
+    """
+    if is_leader():
+        return 0
+
+    slots = int(config('admission_slots') or 0)
+    delay = 0
+    if slots > 0:
+        slot_wait = int(config('admission_slot_wait') or 0)
+        assignment = json.loads(leader_get(ADMISSION_SLOTS_KEY) or '{}')
+        slot = assignment.get(local_unit())
+        if slot is None:
+            delay = modulo_distribution(modulo=slots, wait=slot_wait,
+                                        non_zero_wait=True)
+        else:
+            delay = (slot + 1) * slot_wait
+    jitter = int(config('hook_jitter') or 0)
+    if jitter > 0:
+        delay += random.uniform(0, jitter)
+
+    if delay:
+        log('Waiting {:.1f} seconds before {}'.format(delay, operation_name),
+            level=DEBUG)
+        time.sleep(delay)
+    return delay
+
+
 def get_ipv6_addr():
     """Exclude any ip addresses configured or managed by corosync."""
     excludes = []
@@ -418,11 +767,169 @@ def get_ipv6_addr():
     return utils.get_ipv6_addr(exc_list=excludes)[0]
 
 
+def ensure_dnspython():
+    """Install dnspython if it can't be imported
+
+    charmhelpers' ns_query installs it on first use, which concurrent
+    lookups would all try at the same time.
+    """
+    try:
+        import dns.resolver  # noqa: F401
+    except ImportError:
+        apt_install('python3-dnspython', fatal=True)
+
+
+def resolve_host_ips(hostnames, ttl=HOST_IP_CACHE_TTL,
+                     timeout=HOST_IP_RESOLVE_TIMEOUT):
+    """Resolve hostnames to IP addresses concurrently, caching the answers
+
+    Answers are kept in the unit's kv store. Names without a fresh answer
+    are all looked up at the same time; when a lookup takes longer than
+    timeout seconds, or fails, the last known answer is used instead. Names
+    which were never resolved are waited for.
+
+    @param hostnames: list of hostnames, addresses are returned as is
+    @param ttl: seconds a cached answer is used without a new lookup
+    @param timeout: seconds to wait for DNS before using a stale answer
+    @returns dict - hostname -> IP address
+    @raises ValueError - if a name was never resolved
+    """
+    db = unitdata.kv()
+    cache = db.get(HOST_IP_CACHE_KEY) or {}
+    now = time.time()
+    results = {}
+    pending = []
+    for name in sorted(set(hostnames)):
+        cached = cache.get(name)
+        if cached and now - cached['timestamp'] < ttl:
+            results[name] = cached['addr']
+        else:
+            pending.append(name)
+
+    if not pending:
+        return results
+
+    # installed once here rather than by every lookup thread
+    ensure_dnspython()
+    answers = {}
+    # answers arriving once the results are collected are dropped
+    collected = threading.Event()
+    lock = threading.Lock()
+
+    def lookup(name):
+        try:
+            addr = get_host_ip(name)
+        except Exception as e:
+            log('Failed to resolve {}: {}'.format(name, e), level=WARNING)
+            return
+        with lock:
+            if not collected.is_set():
+                answers[name] = addr
+
+    # NOTE: daemon threads, a lookup stuck on DNS must not hold the hook
+    #       once a stale answer has been used for it.
+    threads = [threading.Thread(target=lookup, args=(name,), daemon=True)
+               for name in pending]
+    for thread in threads:
+        thread.start()
+    deadline = now + timeout
+    for name, thread in zip(pending, threads):
+        if name in cache:
+            thread.join(max(0, deadline - time.time()))
+        else:
+            thread.join()
+
+    with lock:
+        collected.set()
+
+    unresolved = []
+    for name in pending:
+        addr = answers.get(name)
+        if addr:
+            cache[name] = {'addr': addr, 'timestamp': now}
+            results[name] = addr
+        elif name in cache:
+            log('Using last known address {} for {}'.format(
+                cache[name]['addr'], name), level=WARNING)
+            results[name] = cache[name]['addr']
+        else:
+            unresolved.append(name)
+
+    db.set(HOST_IP_CACHE_KEY, cache)
+    db.flush()
+    if unresolved:
+        raise ValueError('Unable to resolve {}'.format(', '.join(unresolved)))
+    return results
+
+
+class PeerTopology(object):
+    """The peers of this unit on the hanode relation
+
+    All the settings of each peer are read with a single relation-get, the
+    hook tools are run once per unit rather than once per unit and key.
+    Use peer_topology() to share one instance between all the callers of a
+    hook.
+    """
+
+    def __init__(self, relation='hanode'):
+        self.relation = relation
+        # relation id -> sorted unit names
+        self.relations = {}
+        # unit name -> relation settings
+        self.settings = {}
+        for relid in relation_ids(relation):
+            units = sorted(related_units(relid))
+            self.relations[relid] = units
+            for unit in units:
+                self.settings[unit] = relation_get(rid=relid, unit=unit) or {}
+
+    @property
+    def units(self):
+        """Sorted names of the peer units"""
+        return sorted(self.settings)
+
+    @property
+    def addresses(self):
+        """dict of peer unit -> private-address, like peer_ips"""
+        return {unit: settings.get('private-address')
+                for unit, settings in self.settings.items()}
+
+    @property
+    def corosync_ids(self):
+        """dict of peer unit -> corosync node id"""
+        return {unit: get_corosync_id(unit) for unit in self.settings}
+
+    @property
+    def ready_units(self):
+        """Sorted names of the peer units which flagged themselves ready"""
+        return sorted(unit for unit, settings in self.settings.items()
+                      if settings.get('ready'))
+
+    @property
+    def ready_addresses(self):
+        """Sorted private-address of the ready peer units"""
+        return sorted(self.settings[unit].get('private-address')
+                      for unit in self.ready_units)
+
+    def peer_count(self, relid):
+        """Number of units related to this unit on relid"""
+        return len(self.relations.get(relid, []))
+
+
+@cached
+def peer_topology(relation='hanode'):
+    """Return the PeerTopology of relation, read once per hook"""
+    return PeerTopology(relation)
+
+
 def get_ha_nodes():
-    ha_units = peer_ips(peer_relation='hanode')
+    topology = peer_topology()
+    ha_units = topology.addresses
+    if not config('prefer-ipv6'):
+        host_ips = resolve_host_ips(list(ha_units.values()) +
+                                    [unit_get('private-address')])
     ha_nodes = {}
-    for unit in ha_units:
-        corosync_id = get_corosync_id(unit)
+    for unit, corosync_id in topology.corosync_ids.items():
         addr = ha_units[unit]
         if config('prefer-ipv6'):
             if not utils.is_ipv6(addr):
@@ -432,13 +939,13 @@ def get_ha_nodes():
 
             ha_nodes[corosync_id] = addr
         else:
-            ha_nodes[corosync_id] = get_host_ip(addr)
+            ha_nodes[corosync_id] = host_ips[addr]
 
     corosync_id = get_corosync_id(local_unit())
     if config('prefer-ipv6'):
         addr = get_ipv6_addr()
     else:
-        addr = get_host_ip(unit_get('private-address'))
+        addr = host_ips[unit_get('private-address')]
 
     ha_nodes[corosync_id] = addr
 
@@ -452,11 +959,7 @@ def get_cluster_nodes():
     else:
         hosts.append(unit_get('private-address'))
 
-    for relid in relation_ids('hanode'):
-        for unit in related_units(relid):
-            if relation_get('ready', rid=relid, unit=unit):
-                hosts.append(relation_get('private-address', unit, relid))
-
+    hosts.extend(peer_topology().ready_addresses)
     hosts.sort()
     return hosts
 
@@ -474,11 +977,19 @@ def parse_data(relid, unit, key):
     return {}
 
 
+def stonith_enabled():
+    """Whether STONITH has been enabled in the charm configuration"""
+    return config('stonith_enabled') in ['true', 'True', True]
+
+
 def configure_stonith():
-    if config('stonith_enabled') not in ['true', 'True', True]:
-        log('Disabling STONITH', level=INFO)
-        cmd = "crm configure property stonith-enabled=false"
-        pcmk.commit(cmd)
+    """Create or update the STONITH resources of the nodes when STONITH is
+    enabled
+
+    The stonith-enabled property itself is set by configure_cluster_global.
+    """
+    if not stonith_enabled():
+        log('STONITH disabled', level=DEBUG)
     else:
         log('Enabling STONITH for all nodes in cluster.', level=INFO)
         # configure stontih resources for all nodes in cluster.
@@ -500,28 +1011,48 @@ def configure_stonith():
             status_set('blocked', msg)
             raise Exception(msg)
 
-        cluster_nodes = pcmk.list_nodes()
-        for node in cluster_nodes:
-            rsc, constraint = pcmk.maas_stonith_primitive(nodes, node)
+        try:
+            timeouts = stonith.parse_timeouts(config('stonith_timeouts'))
+        except ValueError as e:
+            status_set('blocked', str(e))
+            raise
+
+        apt_install(filter_installed_packages(stonith.PACKAGES), fatal=True)
+
+        primitives = {}
+        for node in pcmk.list_nodes():
+            rsc, constraint = pcmk.maas_stonith_primitive(nodes, node,
+                                                          timeouts)
             if not rsc:
                 msg = 'Failed to determine STONITH primitive for ' \
                       'node %s' % node
                 status_set('blocked', msg)
                 raise Exception(msg)
-
-            rsc_name = str(rsc).split(' ')[1]
+            # primitive <name> <type> params ...
+            _, rsc_name, rsc_type, rsc_params = str(rsc).split(' ', 3)
+            primitives[rsc_name] = (rsc_type, rsc_params, rsc, constraint)
+
+        checksums = pcmk.resource_checksums(
+            {rsc_name: p[0] for rsc_name, p in primitives.items()})
+        for rsc_name, (rsc_type, rsc_params, rsc, constraint) in \
+                sorted(primitives.items()):
             if not pcmk.is_resource_present(rsc_name):
                 log('Creating new STONITH primitive %s.' % rsc_name,
                     level=DEBUG)
                 cmd = 'crm -F configure %s' % rsc
-                pcmk.commit(cmd)
+                if pcmk.commit(cmd) == 0:
+                    key = pcmk.resource_checksum_key(rsc_name, rsc_type)
+                    checksums[key] = pcmk.resource_checksum(
+                        rsc_name, rsc_type, rsc_params)
                 if constraint:
                     cmd = 'crm -F configure %s' % constraint
                     pcmk.commit(cmd)
-            else:
-                log('STONITH primitive already exists for node.', level=DEBUG)
-
-        pcmk.commit("crm configure property stonith-enabled=true")
+            elif pcmk.crm_update_resource(rsc_name, rsc_type, rsc_params,
+                                          checksums=checksums) != 0:
+                # e.g. stonith_timeouts changed on a deployed cluster
+                log('Failed to update STONITH primitive %s.' % rsc_name,
+                    level=WARNING)
+        pcmk.save_resource_checksums(checksums)
 
 
 def configure_monitor_host():
@@ -560,17 +1091,50 @@ def configure_cluster_global():
     # corosync two_node=1.  In this case quorum is required for
     # initial cluster startup but not if a node was previously in
     # contact with the full cluster.
-    log('Configuring no-quorum-policy to stop', level=DEBUG)
-    cmd = "crm configure property no-quorum-policy=stop"
+    properties = {'no-quorum-policy': 'stop',
+                  'cluster-recheck-interval': 60,
+                  'stonith-enabled': str(stonith_enabled()).lower()}
+    pcmk.update_cluster_options(properties=properties,
+                                rsc_defaults={'resource-stickiness': 100})
+
+
+def cluster_globals_fingerprint():
+    """Checksum of what the cluster wide configuration is derived from
+
+    @returns str - hex digest
+    """
+    data = {opt: config(opt) for opt in CLUSTER_GLOBALS_OPTIONS}
+    # a STONITH device is configured for every node
+    data['nodes'] = sorted(get_cluster_nodes())
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
 
-    pcmk.commit(cmd)
-    cmd = ('crm configure rsc_defaults $id="rsc-options" '
-           'resource-stickiness="100"')
-    pcmk.commit(cmd)
+def configure_cluster_globals():
+    """Apply the cluster properties, monitor host and STONITH configuration
 
-    log('Configuring cluster-recheck-interval to 60 seconds', level=DEBUG)
-    cmd = "crm configure property cluster-recheck-interval=60"
-    pcmk.commit(cmd)
+    They are the same for the whole cluster, so the leader applies them and
+    publishes the fingerprint of the configuration it applied. The other
+    units skip them when that fingerprint matches their own configuration,
+    and apply them as before when it doesn't, e.g. when the leader hasn't
+    seen the latest change yet.
+
+    @returns boolean - True if the configuration was applied
+    """
+    fingerprint = cluster_globals_fingerprint()
+    leader = is_leader()
+    if not leader and leader_get(CLUSTER_GLOBALS_KEY) == fingerprint:
+        log('Cluster wide configuration already applied by the leader',
+            level=DEBUG)
+        return False
+
+    configure_monitor_host()
+    # the STONITH resources have to exist before stonith-enabled is set
+    configure_stonith()
+    configure_cluster_global()
+    if leader:
+        leader_set({CLUSTER_GLOBALS_KEY: fingerprint})
+    return True
 
 
 def get_ip_addr_from_resource_params(params):
@@ -882,6 +1446,200 @@ def pause_unit():
                    "Paused. Use 'resume' action to resume normal service.")
 
 
+def setup_cluster_state_collector():
+    """Refresh the cluster state snapshot from cron every minute
+
+    When prometheus_textfile_dir is set the collector also exports the
+    cluster metrics there for the node_exporter textfile collector.
+    """
+    cmd = '/usr/bin/python3 {}'.format(
+        os.path.join(charm_dir(), 'hooks', 'cluster_state.py'))
+    textfile = None
+    textfile_dir = config('prometheus_textfile_dir')
+    if textfile_dir:
+        textfile = os.path.join(textfile_dir, cluster_metrics.TEXTFILE_NAME)
+        cmd += ' --textfile {}'.format(textfile)
+    write_file(CLUSTER_STATE_CRON,
+               '# Managed by juju\n'
+               '* * * * * root {} >/dev/null 2>&1\n'.format(cmd),
+               perms=0o644)
+    remove_prometheus_textfile(keep=textfile)
+
+
+def remove_prometheus_textfile(keep=None):
+    """Remove the metrics exported to a previous prometheus_textfile_dir
+
+    node_exporter would otherwise keep exporting the frozen metrics left in
+    a directory the collector no longer writes to.
+
+    @param keep: path the metrics are now exported to, None if they aren't
+    """
+    db = unitdata.kv()
+    textfile = db.get(PROMETHEUS_TEXTFILE_KEY)
+    if textfile is None:
+        # exported before the path was recorded
+        textfile_dir = config().previous('prometheus_textfile_dir')
+        if textfile_dir:
+            textfile = os.path.join(textfile_dir,
+                                    cluster_metrics.TEXTFILE_NAME)
+    if textfile and textfile != keep and os.path.exists(textfile):
+        log('Removing the cluster metrics exported to {}'.format(textfile),
+            level=INFO)
+        os.remove(textfile)
+    db.set(PROMETHEUS_TEXTFILE_KEY, keep)
+    db.flush()
+
+
+def remove_cluster_state_collector():
+    """Stop refreshing the cluster state snapshot"""
+    remove_prometheus_textfile()
+    for path in (CLUSTER_STATE_CRON, cluster_state.SNAPSHOT_FILE,
+                 cluster_metrics.COUNTERS_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_cluster_state(max_age=cluster_state.SNAPSHOT_MAX_AGE):
+    """Return the cluster state snapshot, querying the cluster if it is stale
+
+    @returns dict - see cluster_state.collect, None if pacemaker can't be
+                    queried
+    """
+    try:
+        return cluster_state.get_snapshot(max_age, write=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        log('Unable to query the cluster state: {}'.format(e), level=WARNING)
+        return None
+
+
+def resources_to_cleanup(resources, clones, groups):
+    """Return the resources of the principle which need a cleanup
+
+    The failures are read from a fresh crm_mon. If pacemaker can't be
+    queried, all the clones and groups are cleaned up.
+
+    @param resources: resources requested by the principle
+    @param clones: clones requested by the principle
+    @param groups: groups requested by the principle
+    @returns dict - resource -> list of the nodes to clean it up on, all of
+                    them if empty
+    """
+    state = get_cluster_state(max_age=0)
+    if state is None:
+        return dict.fromkeys(list(clones) + list(groups), [])
+    return cluster_state.failed_resources(state['crm_mon'], resources)
+
+
+def sync_files(src_dir, dst_dir):
+    """Copy the files of src_dir whose content differs in dst_dir
+
+    @param src_dir: directory with the files to install
+    @param dst_dir: directory the files are installed into
+    @returns list - paths of the files updated in dst_dir
+    """
+    changed = []
+    for fname in sorted(glob.glob(os.path.join(src_dir, '*'))):
+        if not os.path.isfile(fname):
+            continue
+        dst = os.path.join(dst_dir, os.path.basename(fname))
+        if file_hash(dst, 'sha256') != file_hash(fname, 'sha256'):
+            shutil.copy2(fname, dst)
+            changed.append(dst)
+    return changed
+
+
+def nrpe_checks_hash(nrpe_setup):
+    """Fingerprint everything NRPE.write would write for nrpe_setup"""
+    data = {
+        'hostname': nrpe_setup.hostname,
+        'context': nrpe_setup.nagios_context,
+        'servicegroups': nrpe_setup.nagios_servicegroups,
+        'checks': [(c.shortname, c.description, c.check_cmd)
+                   for c in nrpe_setup.checks],
+        'relations': (relation_ids('local-monitors') +
+                      relation_ids('nrpe-external-master')),
+    }
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_nrpe_checks(nrpe_setup):
+    """Write the nrpe checks of nrpe_setup if they changed
+
+    Unlike NRPE.write, which restarts nagios-nrpe-server every time, the
+    checks are only written when their definitions changed since the last
+    run and nagios-nrpe-server is then reloaded. A restart makes the nagios
+    server see all the checks of the unit failing for a while.
+
+    @param nrpe_setup: nrpe.NRPE with the checks added
+    @returns boolean - True if the checks were written
+    """
+    try:
+        nagios_uid = pwd.getpwnam('nagios').pw_uid
+        nagios_gid = grp.getgrnam('nagios').gr_gid
+    except KeyError:
+        log('Nagios user not set up, nrpe checks not updated', level=WARNING)
+        return False
+
+    if not os.path.exists(nrpe.NRPE.nagios_logdir):
+        os.mkdir(nrpe.NRPE.nagios_logdir)
+        os.chown(nrpe.NRPE.nagios_logdir, nagios_uid, nagios_gid)
+
+    db = unitdata.kv()
+    checks_hash = nrpe_checks_hash(nrpe_setup)
+    check_files = [os.path.join(nrpe.NRPE.nrpe_confdir,
+                                '{}.cfg'.format(c.command))
+                   for c in nrpe_setup.checks]
+    if (db.get(NRPE_CHECKS_KEY) == checks_hash and
+            all(os.path.exists(f) for f in check_files)):
+        log('nrpe checks are up to date', level=DEBUG)
+        return False
+
+    if not os.path.isdir(nrpe.NRPE.nrpe_confdir):
+        log('{} not found, nrpe checks not updated'.format(
+            nrpe.NRPE.nrpe_confdir), level=WARNING)
+        return False
+
+    nrpe_monitors = {}
+    for check in nrpe_setup.checks:
+        check.write(nrpe_setup.nagios_context, nrpe_setup.hostname,
+                    nrpe_setup.nagios_servicegroups)
+        nrpe_monitors[check.shortname] = {'command': check.command}
+
+    service_reload('nagios-nrpe-server', restart_on_failure=True)
+
+    monitors = {'monitors': {'remote': {'nrpe': nrpe_monitors}}}
+    for rid in (relation_ids('local-monitors') +
+                relation_ids('nrpe-external-master')):
+        relation_set(relation_id=rid, monitors=yaml.dump(monitors))
+
+    db.set(NRPE_CHECKS_KEY, checks_hash)
+    db.flush()
+    return True
+
+
+def compact_unit_state():
+    """Prune the old hook revisions of unitdata, vacuum it once a day
+
+    charmhelpers records the environment, config and relation data of every
+    hook in unitdata and never removes them.
+
+    @returns int - number of revisions pruned
+    """
+    db = unitdata.kv()
+    pruned = unitstate.prune(db, keep=UNIT_STATE_KEEP_HOOKS,
+                             max_age=UNIT_STATE_MAX_AGE)
+    if pruned:
+        log('Pruned {} unit state revisions'.format(pruned), level=DEBUG)
+    if time.time() - db.get(UNIT_STATE_VACUUM_KEY, 0) > \
+            UNIT_STATE_VACUUM_INTERVAL:
+        db.set(UNIT_STATE_VACUUM_KEY, time.time())
+        unitstate.vacuum(db)
+    else:
+        db.flush()
+    return pruned
+
+
 def assess_status_helper():
     """Assess status of unit
 
@@ -904,27 +1662,44 @@ def assess_status_helper():
     except pcmk.ServicesNotUp:
         message = 'Pacemaker is down'
         status = 'blocked'
-    for relid in relation_ids('hanode'):
-        if len(related_units(relid)) + 1 < node_count:
+    topology = peer_topology()
+    for relid in topology.relations:
+        if topology.peer_count(relid) + 1 < node_count:
             status = 'blocked'
             message = ("Insufficient peer units for ha cluster "
                        "(require {})".format(node_count))
 
     # if the status was not changed earlier, we verify the maintenance status
-    try:
-        if status == 'active':
-            prop = pcmk.get_property('maintenance-mode').strip()
-    except pcmk.PropertyNotFound:
-        # the property is not the output of 'crm configure show xml', so we use
-        # the default value for this property. For crmsh>=2.2.0 the default
-        # value is automatically provided by show-property or get-property.
-        prop = 'false'
-
-    if (status == 'active' and prop == 'true'):
+    maintenance = False
+    if status == 'active':
+        state = get_cluster_state()
+        if state:
+            maintenance = state['crm_mon']['summary']['maintenance_mode']
+        else:
+            try:
+                prop = pcmk.get_property('maintenance-mode').strip()
+            except pcmk.PropertyNotFound:
+                # the property is not the output of 'crm configure show xml',
+                # so we use the default value for this property. For
+                # crmsh>=2.2.0 the default value is automatically provided by
+                # show-property or get-property.
+                prop = 'false'
+            maintenance = prop == 'true'
+
+    if status == 'active' and maintenance:
         # maintenance mode enabled in pacemaker
         status = 'maintenance'
         message = 'Pacemaker in maintenance mode'
 
+    # NOTE: only look at the results of the last probe, the fencing devices
+    # are probed by the update-status hook and the check-stonith action.
+    if status == 'active' and stonith_enabled():
+        dead = stonith.unhealthy_nodes(stonith.cached_fencing_health())
+        if dead:
+            status = 'blocked'
+            message = ('STONITH device not answering for: {}'
+                       ''.format(', '.join(dead)))
+
     return status, message
 
 
@@ -949,19 +1724,106 @@ def ocf_file_exists(res_name, resources,
     return False
 
 
-def kill_legacy_ocf_daemon_process(res_name):
-    """Kill legacy ocf daemon process
+def program_name(argv):
+    """Return the name of the program a process runs
 
-    @param res_name: The name of the ocf process to kill
+    @param argv: list of the command line arguments of the process
+    @returns str - basename of the executable, or of the script when the
+                   executable is an interpreter, None if argv is empty
     """
-    ocf_name = res_name.replace('res_', '').replace('_', '-')
-    reg_expr = '([0-9]+)\s+[^0-9]+{}'.format(ocf_name)
-    cmd = ['ps', '-eo', 'pid,cmd']
-    ps = subprocess.check_output(cmd).decode('utf-8')
-    res = re.search(reg_expr, ps, re.MULTILINE)
-    if res:
-        pid = res.group(1)
-        subprocess.call(['sudo', 'kill', '-9', pid])
+    if not argv:
+        return None
+    name = os.path.basename(argv[0])
+    if INTERPRETERS.match(name):
+        # python3 -u /usr/bin/ceilometer-agent-central --config...
+        for arg in argv[1:]:
+            if not arg.startswith('-'):
+                return os.path.basename(arg)
+    return name
+
+
+def find_processes(names, proc='/proc'):
+    """Find the processes running any of the given programs
+
+    /proc is scanned once for all the names. Only the executable, or the
+    script run by an interpreter, is compared with the names, not the other
+    arguments: `tail -f /var/log/aodh/aodh-evaluator` doesn't run
+    aodh-evaluator.
+
+    @param names: list of program names
+    @param proc: mount point of procfs
+    @returns dict - program name -> sorted list of pids
+    """
+    found = {name: [] for name in names}
+    for entry in os.listdir(proc):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(proc, entry, 'cmdline'), 'rb') as f:
+                cmdline = f.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            # the process exited meanwhile
+            continue
+        name = program_name([arg for arg in cmdline.split('\0') if arg])
+        if name in found:
+            found[name].append(int(entry))
+    return {name: sorted(pids) for name, pids in found.items()}
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def terminate_processes(pids, timeout=TERMINATE_TIMEOUT):
+    """Send SIGTERM to the processes, then SIGKILL if they didn't exit
+
+    @param pids: list of pids
+    @param timeout: seconds the processes have to exit after SIGTERM
+    @returns list - pids which had to be killed
+    """
+    alive = []
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            alive.append(pid)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.time() + timeout
+    while alive and time.time() < deadline:
+        time.sleep(0.1)
+        alive = [pid for pid in alive if _pid_exists(pid)]
+
+    for pid in alive:
+        log('Process {} did not exit after SIGTERM, killing it'.format(pid),
+            level=WARNING)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    return alive
+
+
+def kill_legacy_ocf_daemon_processes(res_names):
+    """Kill legacy ocf daemon processes
+
+    @param res_names: The names of the resources whose ocf processes to kill
+    """
+    ocf_names = [res_name.replace('res_', '').replace('_', '-')
+                 for res_name in res_names]
+    if not ocf_names:
+        return
+    pids = []
+    for ocf_name, found in sorted(find_processes(ocf_names).items()):
+        if found:
+            log('Stopping legacy {} processes: {}'.format(ocf_name, found),
+                level=INFO)
+            pids.extend(found)
+    terminate_processes(pids)
 
 
 def maintenance_mode(enable):
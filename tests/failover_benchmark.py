@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how long a VIP takes to fail over when a node is lost.
+
+A corosync/pacemaker cluster is built from LXD containers, with the
+corosync.conf rendered from the charm template and totem profile. For each
+run the node holding the VIP is killed (lxc stop --force) or cut off from
+its peers (iptables), and a surviving node is polled with crm_mon to time:
+
+  detection  the lost node is seen offline or unclean
+  fencing    the lost node is offline and clean again, only when STONITH
+             is configured with --stonith
+  recovery   the VIP is started on another node
+  reachable  the VIP answers ping from the host
+
+The results, with the configuration they were measured with, are written
+as JSON so runs with different settings can be compared, e.g.
+
+  ./tests/failover_benchmark.py --nodes 3 --profile low-latency \\
+      --fault partition --runs 5 --output low-latency.json
+
+Requires a working LXD setup, the containers are deleted at the end unless
+--keep is given.
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_path = os.path.dirname(os.path.realpath(__file__))
+_root = os.path.abspath(os.path.join(_path, '..'))
+sys.path.insert(0, _root)
+sys.path.insert(0, os.path.join(_root, 'hooks'))
+
+import jinja2  # noqa: E402
+
+import cluster_state  # noqa: E402
+import totem  # noqa: E402
+
+PACKAGES = ['corosync', 'pacemaker', 'crmsh', 'resource-agents']
+POLL_INTERVAL = 0.2
+CLUSTER_TIMEOUT = 300
+METRICS = ['detection', 'fencing', 'recovery', 'reachable']
+
+
+def lxc(*args, **kwargs):
+    return subprocess.check_output(('lxc',) + args, universal_newlines=True,
+                                   **kwargs)
+
+
+def lxc_exec(node, *cmd, **kwargs):
+    return lxc('exec', node, '--', *cmd, **kwargs)
+
+
+def node_address(node):
+    """Return the IPv4 address of the container on its first interface"""
+    for _ in range(60):
+        out = lxc('list', node, '--format', 'json')
+        for addr in json.loads(out)[0]['state']['network']['eth0'][
+                'addresses']:
+            if addr['family'] == 'inet':
+                return addr['address']
+        time.sleep(1)
+    raise Exception('{} did not get an address'.format(node))
+
+
+def render_corosync_conf(addresses, profile):
+    """Render corosync.conf for the nodes like the charm does"""
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(_root, 'templates')))
+    context = {
+        'ip_version': 'ipv4',
+        'transport': 'udpu',
+        'ha_nodes': {1000 + i: addr for i, addr in enumerate(addresses)},
+        'totem': totem.totem_settings(profile, len(addresses)),
+    }
+    return env.get_template('corosync.conf').render(context)
+
+
+def setup_cluster(args):
+    nodes = ['{}-{}'.format(args.prefix, i) for i in range(args.nodes)]
+    for node in nodes:
+        lxc('launch', args.image, node)
+    addresses = [node_address(node) for node in nodes]
+    authkey = base64.b64encode(os.urandom(128)).decode()
+    conf = render_corosync_conf(addresses, args.profile)
+
+    for node in nodes:
+        lxc_exec(node, 'cloud-init', 'status', '--wait')
+        lxc_exec(node, 'apt-get', 'update', '-q')
+        lxc_exec(node, 'apt-get', 'install', '-qy', *PACKAGES)
+        lxc_exec(node, 'tee', '/etc/corosync/corosync.conf', input=conf)
+        lxc_exec(node, 'sh', '-c',
+                 'base64 -d > /etc/corosync/authkey', input=authkey)
+        lxc_exec(node, 'systemctl', 'restart', 'corosync', 'pacemaker')
+
+    wait_for(nodes[0], lambda s: all(n['online']
+                                     for n in s['nodes'].values()) and
+             len(s['nodes']) == len(nodes), CLUSTER_TIMEOUT)
+
+    vip = args.vip or '{}.250'.format(addresses[0].rsplit('.', 1)[0])
+    crm = ['property stonith-enabled={}'.format(
+        'true' if args.stonith else 'false'),
+        'primitive res_vip ocf:heartbeat:IPaddr2 params ip={} '
+        'cidr_netmask=24 op monitor interval={}s'.format(
+            vip, args.monitor_interval)]
+    if args.stonith:
+        crm.append(args.stonith)
+    for cmd in crm:
+        lxc_exec(nodes[0], 'sh', '-c', 'crm configure {}'.format(cmd))
+    return nodes, vip
+
+
+def crm_mon(node):
+    return cluster_state.parse_crm_mon_xml(
+        lxc_exec(node, 'crm_mon', '--as-xml', '--inactive'))
+
+
+def vip_node(state):
+    nodes = state['resources'].get('res_vip', {}).get('nodes', [])
+    return nodes[0] if nodes else None
+
+
+def wait_for(node, condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if condition(crm_mon(node)):
+                return
+        except subprocess.CalledProcessError:
+            pass
+        time.sleep(POLL_INTERVAL)
+    raise Exception('Cluster did not settle in {}s'.format(timeout))
+
+
+def vip_reachable(vip):
+    return subprocess.call(['ping', '-c', '1', '-W', '1', vip],
+                           stdout=subprocess.DEVNULL) == 0
+
+
+def inject_fault(node, fault):
+    if fault == 'kill':
+        lxc('stop', '--force', node)
+    else:
+        for chain, port in (('INPUT', '--dport'), ('OUTPUT', '--sport')):
+            lxc_exec(node, 'iptables', '-A', chain, '-p', 'udp', port,
+                     '5405', '-j', 'DROP')
+
+
+def heal(node, fault):
+    if fault == 'kill':
+        lxc('start', node)
+    else:
+        lxc_exec(node, 'iptables', '-F')
+
+
+def run_once(nodes, vip, args):
+    """Lose the node running the VIP and time the failover
+
+    :returns: dict of metric -> seconds after the fault, None if not seen
+    """
+    state = crm_mon(nodes[0])
+    victim = vip_node(state)
+    survivor = next(n for n in nodes if n != victim)
+    result = dict.fromkeys(METRICS)
+    result['victim'] = victim
+
+    start = time.time()
+    inject_fault(victim, args.fault)
+    deadline = start + args.timeout
+    while time.time() < deadline:
+        now = time.time() - start
+        try:
+            state = crm_mon(survivor)
+        except subprocess.CalledProcessError:
+            time.sleep(POLL_INTERVAL)
+            continue
+        lost = state['nodes'].get(victim, {})
+        if result['detection'] is None and (not lost.get('online') or
+                                            lost.get('unclean')):
+            result['detection'] = now
+        if (args.stonith and result['detection'] is not None and
+                result['fencing'] is None and not lost.get('online') and
+                not lost.get('unclean')):
+            result['fencing'] = now
+        owner = vip_node(state)
+        if result['recovery'] is None and owner and owner != victim:
+            result['recovery'] = now
+        if result['recovery'] is not None and result['reachable'] is None:
+            if vip_reachable(vip):
+                result['reachable'] = time.time() - start
+        if result['reachable'] is not None and (
+                result['fencing'] is not None or not args.stonith):
+            break
+        time.sleep(POLL_INTERVAL)
+
+    heal(victim, args.fault)
+    wait_for(survivor, lambda s: all(n['online']
+                                     for n in s['nodes'].values()),
+             CLUSTER_TIMEOUT)
+    lxc_exec(survivor, 'crm', 'resource', 'cleanup', 'res_vip')
+    return result
+
+
+def summarize(runs):
+    """Return min/median/max of each metric over the runs that saw it"""
+    summary = {}
+    for metric in METRICS:
+        values = [r[metric] for r in runs if r[metric] is not None]
+        if values:
+            summary[metric] = {'min': min(values),
+                               'median': statistics.median(values),
+                               'max': max(values),
+                               'samples': len(values)}
+    return summary
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--image', default='ubuntu:18.04')
+    parser.add_argument('--prefix', default='hacluster-bench')
+    parser.add_argument('--profile', default='default',
+                        choices=sorted(totem.PROFILES))
+    parser.add_argument('--fault', default='kill',
+                        choices=['kill', 'partition'])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--monitor-interval', type=int, default=10)
+    parser.add_argument('--timeout', type=int, default=120,
+                        help='Seconds to wait for the failover of a run')
+    parser.add_argument('--vip', help='Defaults to .250 in the LXD subnet')
+    parser.add_argument('--stonith',
+                        help='crm configure arguments of a fencing device, '
+                             'e.g. "primitive st stonith:fence_dummy"')
+    parser.add_argument('--output', default='failover-report.json')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the containers')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    nodes = ['{}-{}'.format(args.prefix, i) for i in range(args.nodes)]
+    try:
+        nodes, vip = setup_cluster(args)
+        runs = []
+        for i in range(args.runs):
+            result = run_once(nodes, vip, args)
+            result['run'] = i
+            print(json.dumps(result))
+            runs.append(result)
+    finally:
+        if not args.keep:
+            for node in nodes:
+                subprocess.call(['lxc', 'delete', '--force', node])
+
+    report = {
+        'config': {
+            'nodes': args.nodes,
+            'image': args.image,
+            'profile': args.profile,
+            'totem': totem.totem_settings(args.profile, args.nodes),
+            'fault': args.fault,
+            'monitor_interval': args.monitor_interval,
+            'stonith': args.stonith,
+        },
+        'runs': runs,
+        'summary': summarize(runs),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Report written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
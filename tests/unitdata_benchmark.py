@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time unitdata lookups as the number of keys grows.
+
+For each keyspace size, the per-resource keys of a small prefix are read
+with unitstate.getrange(), with the `key like 'prefix%'` query of
+Storage.getrange and with unitstate.getmany(), e.g.
+
+  ./tests/unitdata_benchmark.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+_path = os.path.dirname(os.path.realpath(__file__))
+_root = os.path.abspath(os.path.join(_path, '..'))
+sys.path.insert(0, _root)
+sys.path.insert(0, os.path.join(_root, 'hooks'))
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+import unitstate  # noqa: E402
+
+
+def populate(db, size):
+    unitstate.setmany(db, {'res_{:07d}-IPaddr2'.format(i): 'x' * 32
+                           for i in range(size)})
+    unitstate.setmany(db, {'pcmk-ra-metadata-ocf:heartbeat:{}'.format(i): {}
+                           for i in range(10)})
+    db.flush()
+
+
+def like(db, prefix):
+    db.cursor.execute('select key, data from kv where key like ?',
+                      ['%s%%' % prefix])
+    return db.cursor.fetchall()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--number', type=int, default=200,
+                        help='Lookups timed for each query')
+    args = parser.parse_args(argv)
+
+    prefix = 'pcmk-ra-metadata-'
+    keys = ['res_{:07d}-IPaddr2'.format(i) for i in range(10)]
+    print('{:>8} {:>12} {:>12} {:>12}'.format('keys', 'getrange', 'like',
+                                              'getmany'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            db = unitdata.Storage(os.path.join(tmpdir, '{}.db'.format(size)))
+            populate(db, size)
+            timings = [
+                timeit.timeit(lambda: unitstate.getrange(db, prefix),
+                              number=args.number),
+                timeit.timeit(lambda: like(db, prefix), number=args.number),
+                timeit.timeit(lambda: unitstate.getmany(db, keys),
+                              number=args.number),
+            ]
+            print('{:>8} {:>10.1f}us {:>10.1f}us {:>10.1f}us'.format(
+                size, *(t / args.number * 1e6 for t in timings)))
+            db.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -30,3 +30,7 @@ _add_path(_actions)
 _add_path(_hooks)
 _add_path(_charmhelpers)
 _add_path(_unit_tests)
+
+# The hooks keep state in unitdata, e.g. the last workload status sent, the
+# tests must not leave a .unit-state.db behind for the next run.
+os.environ.setdefault('UNIT_STATE_DB', ':memory:')
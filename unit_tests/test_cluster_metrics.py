@@ -0,0 +1,113 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import cluster_metrics
+import cluster_state
+
+from test_cluster_state import (
+    CFGTOOL_OUTPUT,
+    CRM_MON_XML,
+)
+
+CMAPCTL_OUTPUT = '''nodelist.node.0.nodeid (u32) = 1000
+nodelist.node.0.ring0_addr (str) = 10.5.0.10
+nodelist.node.1.nodeid (u32) = 1001
+nodelist.node.1.ring0_addr (str) = 10.5.0.11
+nodelist.node.1.name (str) = juju-1
+nodelist.node.1.quorum_votes (u32) = 2
+quorum.provider (str) = corosync_votequorum
+runtime.totem.pg.mrp.srp.operational_entered (u64) = 4
+runtime.totem.pg.mrp.srp.mcast_retx (u64) = 12
+totem.token (u32) = 3000
+'''
+
+
+def snapshot():
+    return {'timestamp': 1000,
+            'crm_mon': cluster_state.parse_crm_mon_xml(CRM_MON_XML),
+            'rings': cluster_state.parse_cfgtool_status(CFGTOOL_OUTPUT),
+            'constraints': []}
+
+
+class TestClusterMetrics(unittest.TestCase):
+
+    def test_parse_cmapctl(self):
+        cmap = cluster_metrics.parse_cmapctl(CMAPCTL_OUTPUT)
+        self.assertEqual(cmap['totem.token'], 3000)
+        self.assertEqual(cmap['quorum.provider'], 'corosync_votequorum')
+        self.assertEqual(cluster_metrics.quorum_votes(cmap),
+                         ({'10.5.0.10': 1, 'juju-1': 2}, 3))
+
+    def test_update_counters(self):
+        state = snapshot()
+        counters = cluster_metrics.update_counters({}, state)
+        self.assertEqual(counters['dc_changes'], 0)
+        self.assertEqual(counters['migrations']['res_ks_vip'], 0)
+
+        state = copy.deepcopy(state)
+        state['crm_mon']['summary']['dc'] = 'juju-0'
+        state['crm_mon']['resources']['res_ks_vip']['nodes'] = ['juju-1']
+        # a stopped resource keeps its last location
+        state['crm_mon']['resources']['res_ks_db']['nodes'] = []
+        counters = cluster_metrics.update_counters(
+            json.loads(json.dumps(counters)), state)
+        self.assertEqual(counters['dc_changes'], 1)
+        self.assertEqual(counters['migrations'],
+                         {'res_ks_vip': 1, 'res_ks_db': 0,
+                          'res_ks_haproxy': 0})
+        self.assertEqual(counters['locations']['res_ks_db'], ['juju-0'])
+
+    def test_render_metrics(self):
+        cmap = cluster_metrics.parse_cmapctl(CMAPCTL_OUTPUT)
+        counters = cluster_metrics.update_counters({}, snapshot())
+        metrics = cluster_metrics.render_metrics(snapshot(), cmap, counters)
+        lines = metrics.splitlines()
+        for line in ('hacluster_quorate 1',
+                     'hacluster_quorum_votes{node="juju-1"} 2',
+                     'hacluster_quorum_expected_votes 3',
+                     'hacluster_node_online{node="juju-2"} 0',
+                     'hacluster_resource_fail_count{node="juju-1",'
+                     'resource="res_ks_haproxy"} 1000000',
+                     'hacluster_resource_migrations_total'
+                     '{resource="res_ks_vip"} 0',
+                     'hacluster_ring_faulty{ring="1"} 1',
+                     'hacluster_totem_membership_transitions_total 4',
+                     '# TYPE hacluster_dc_changes_total counter'):
+            self.assertIn(line, lines)
+        self.assertNotIn('hacluster_totem_consensus_timeouts_total', metrics)
+
+    @mock.patch.object(cluster_metrics, 'query_cmap')
+    def test_export(self, query_cmap):
+        query_cmap.return_value = {}
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        textfile = os.path.join(tmpdir, 'hacluster.prom')
+        counters_file = os.path.join(tmpdir, 'state', 'counters.json')
+
+        cluster_metrics.export(snapshot(), textfile, counters_file)
+        state = snapshot()
+        state['crm_mon']['summary']['dc'] = 'juju-0'
+        cluster_metrics.export(state, textfile, counters_file)
+        with open(textfile) as f:
+            self.assertIn('hacluster_dc_changes_total 1\n', f.read())
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         ['hacluster.prom', 'state'])
@@ -0,0 +1,252 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import cluster_state
+
+
+CRM_MON_XML = '''<?xml version="1.0"?>
+<crm_mon version="1.1.18">
+    <summary>
+        <stack type="corosync" />
+        <current_dc present="true" version="1.1.18-2b07d5c5a9" name="juju-1" id="1001" with_quorum="true" />
+        <last_update time="Thu Mar 14 10:00:00 2019" />
+        <nodes_configured number="3" expected_votes="unknown" />
+        <resources_configured number="5" disabled="0" blocked="0" />
+        <cluster_options stonith-enabled="false" symmetric-cluster="true" no-quorum-policy="stop" maintenance-mode="false" />
+    </summary>
+    <nodes>
+        <node name="juju-0" id="1000" online="true" standby="false" standby_onfail="false" maintenance="false" pending="false" unclean="false" shutdown="false" expected_up="true" is_dc="false" resources_running="1" type="member" />
+        <node name="juju-1" id="1001" online="true" standby="true" standby_onfail="false" maintenance="false" pending="false" unclean="false" shutdown="false" expected_up="true" is_dc="true" resources_running="0" type="member" />
+        <node name="juju-2" id="1002" online="false" standby="false" standby_onfail="false" maintenance="false" pending="false" unclean="true" shutdown="false" expected_up="true" is_dc="false" resources_running="0" type="member" />
+    </nodes>
+    <resources>
+        <group id="grp_ks_vips" number_resources="1" >
+             <resource id="res_ks_vip" resource_agent="ocf::heartbeat:IPaddr2" role="Started" active="true" orphaned="false" blocked="false" managed="true" failed="false" failure_ignored="false" nodes_running_on="1" >
+                 <node name="juju-0" id="1000" cached="false"/>
+             </resource>
+        </group>
+        <clone id="cl_ks_haproxy" multi_state="false" unique="false" managed="true" failed="false" failure_ignored="false" >
+            <resource id="res_ks_haproxy" resource_agent="lsb:haproxy" role="Started" active="true" orphaned="false" blocked="false" managed="true" failed="false" failure_ignored="false" nodes_running_on="1" >
+                <node name="juju-0" id="1000" cached="false"/>
+            </resource>
+            <resource id="res_ks_haproxy" resource_agent="lsb:haproxy" role="Stopped" active="false" orphaned="false" blocked="false" managed="true" failed="false" failure_ignored="false" nodes_running_on="0" />
+        </clone>
+        <resource id="res_ks_db" resource_agent="ocf::heartbeat:Dummy" role="Started" active="true" orphaned="false" blocked="false" managed="false" failed="true" failure_ignored="false" nodes_running_on="1" >
+            <node name="juju-0" id="1000" cached="false"/>
+        </resource>
+    </resources>
+    <node_history>
+        <node name="juju-0">
+            <resource_history id="res_ks_vip" orphan="false" migration-threshold="1000000">
+                <operation_history call="10" task="start" last-rc-change="Thu Mar 14 09:00:00 2019" last-run="Thu Mar 14 09:00:00 2019" exec-time="49ms" queue-time="0ms" rc="0" rc_text="ok" />
+            </resource_history>
+            <resource_history id="res_ks_haproxy" orphan="false" migration-threshold="1000000" fail-count="2" last-failure="Thu Mar 14 09:30:00 2019">
+                <operation_history call="12" task="monitor" interval="5000ms" last-rc-change="Thu Mar 14 09:30:00 2019" exec-time="12ms" queue-time="0ms" rc="7" rc_text="not running" />
+            </resource_history>
+        </node>
+        <node name="juju-1">
+            <resource_history id="res_ks_haproxy" orphan="false" migration-threshold="1000000" fail-count="INFINITY" last-failure="Thu Mar 14 09:30:00 2019" />
+        </node>
+    </node_history>
+    <failures>
+        <failure op_key="res_ks_haproxy_monitor_5000" node="juju-0" exitstatus="not running" exitreason="" exitcode="7" call="12" status="complete" last-rc-change="Thu Mar 14 09:30:00 2019" queued="0" exec="12" interval="5000" task="monitor" />
+    </failures>
+</crm_mon>
+'''  # noqa
+
+CFGTOOL_OUTPUT = '''Printing ring status.
+Local node ID 1000
+RING ID 0
+\tid\t= 10.5.0.10
+\tstatus\t= ring 0 active with no faults
+RING ID 1
+\tid\t= 10.6.0.10
+\tstatus\t= Marking ringid 1 interface 10.6.0.10 FAULTY
+'''
+
+CIB_CONSTRAINTS_XML = '''<constraints>
+  <rsc_location id="cli-prefer-res_ks_vip" rsc="res_ks_vip" role="Started" node="juju-0" score="INFINITY"/>
+  <rsc_location id="loc_ping" rsc="res_ks_vip" score="-INFINITY"/>
+</constraints>
+'''  # noqa
+
+
+class TestClusterState(unittest.TestCase):
+
+    def test_parse_crm_mon_xml(self):
+        state = cluster_state.parse_crm_mon_xml(CRM_MON_XML)
+        self.assertEqual(state['summary'],
+                         {'dc': 'juju-1', 'quorum': True,
+                          'nodes_configured': 3, 'resources_configured': 5,
+                          'maintenance_mode': False})
+        self.assertEqual(sorted(state['nodes']),
+                         ['juju-0', 'juju-1', 'juju-2'])
+        self.assertTrue(state['nodes']['juju-1']['standby'])
+        self.assertFalse(state['nodes']['juju-2']['online'])
+        self.assertTrue(state['nodes']['juju-2']['unclean'])
+
+        haproxy = state['resources']['res_ks_haproxy']
+        self.assertEqual(haproxy['roles'], ['Started', 'Stopped'])
+        self.assertEqual(haproxy['nodes'], ['juju-0'])
+        self.assertTrue(haproxy['active'])
+        self.assertFalse(state['resources']['res_ks_db']['managed'])
+
+        self.assertEqual(state['fail_counts'],
+                         {'res_ks_haproxy': {'juju-0': 2,
+                                             'juju-1': 1000000}})
+        self.assertEqual(state['failed_actions'],
+                         [{'resource': 'res_ks_haproxy',
+                           'node': 'juju-0',
+                           'task': 'monitor',
+                           'exitreason': '',
+                           'exitstatus': 'not running'}])
+        self.assertEqual(cluster_state.stopped_resources(state),
+                         ['res_ks_haproxy'])
+
+    def test_failed_resources(self):
+        state = cluster_state.parse_crm_mon_xml(CRM_MON_XML)
+        self.assertEqual(cluster_state.failed_resources(state),
+                         {'res_ks_haproxy': ['juju-0', 'juju-1'],
+                          'res_ks_db': []})
+        self.assertEqual(
+            cluster_state.failed_resources(state, ['res_ks_vip', 'res_ks_db']),
+            {'res_ks_db': []})
+
+        state['fail_counts'] = {'res_foo:1': {'juju-2': 1}}
+        state['failed_actions'] = []
+        state['resources'] = {}
+        self.assertEqual(cluster_state.failed_resources(state),
+                         {'res_foo': ['juju-2']})
+
+    def test_parse_cfgtool_status(self):
+        self.assertEqual(
+            cluster_state.parse_cfgtool_status(CFGTOOL_OUTPUT),
+            [{'ring': 0, 'id': '10.5.0.10',
+              'status': 'ring 0 active with no faults', 'faulty': False},
+             {'ring': 1, 'id': '10.6.0.10',
+              'status': 'Marking ringid 1 interface 10.6.0.10 FAULTY',
+              'faulty': True}])
+
+    def test_parse_leftover_constraints(self):
+        self.assertEqual(
+            cluster_state.parse_leftover_constraints(CIB_CONSTRAINTS_XML),
+            [('cli-prefer-res_ks_vip', 'res_ks_vip')])
+
+    def test_nagios_status(self):
+        state = cluster_state.parse_crm_mon_xml(CRM_MON_XML)
+        rings = cluster_state.parse_cfgtool_status(CFGTOOL_OUTPUT)
+        constraints = cluster_state.parse_leftover_constraints(
+            CIB_CONSTRAINTS_XML)
+        status, messages, perfdata = cluster_state.nagios_status(
+            state, rings, constraints)
+        self.assertEqual(status, cluster_state.NAGIOS_CRITICAL)
+        self.assertEqual(messages, [
+            '1 Nodes Offline',
+            'juju-1 in Standby',
+            'res_ks_haproxy Stopped',
+            'res_ks_db unmanaged FAILED',
+            'FAILED actions detected or not cleaned up',
+            'res_ks_haproxy failure detected, fail-count=1000000',
+            'res_ks_vip blocking location constraint detected',
+            'ring 1 Marking ringid 1 interface 10.6.0.10 FAULTY',
+        ])
+        self.assertEqual(perfdata['nodes_online'], 2)
+        self.assertEqual(perfdata['rings_faulty'], 1)
+        self.assertEqual(perfdata['failed_actions'], 1)
+
+    def test_nagios_status_ok(self):
+        state = cluster_state.parse_crm_mon_xml(CRM_MON_XML)
+        state['nodes'] = {'juju-0': state['nodes']['juju-0']}
+        state['resources'].pop('res_ks_haproxy')
+        state['resources'].pop('res_ks_db')
+        state['fail_counts'] = {}
+        state['failed_actions'] = []
+        rings = cluster_state.parse_cfgtool_status(CFGTOOL_OUTPUT)[:1]
+        status, messages, perfdata = cluster_state.nagios_status(
+            state, rings, expected_rings=1)
+        self.assertEqual(status, cluster_state.NAGIOS_OK)
+        self.assertEqual(
+            cluster_state.format_nagios(status, messages, perfdata),
+            'CLUSTER OK - Cluster OK | fail_count=0 failed_actions=0 '
+            'nodes_offline=0 nodes_online=1 nodes_standby=0 '
+            'resources_configured=5 resources_stopped=0 rings=1 '
+            'rings_faulty=0')
+
+        status, messages, _ = cluster_state.nagios_status(
+            state, [], warn_only=True)
+        self.assertEqual(status, cluster_state.NAGIOS_CRITICAL)
+        self.assertEqual(messages, ['No Rings Found'])
+
+
+class TestClusterStateSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'hacluster', 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.object(cluster_state.time, 'time')
+    def test_write_read_snapshot(self, time):
+        time.return_value = 1000
+        cluster_state.write_snapshot({'timestamp': 1000, 'rings': []},
+                                     self.path)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['state.json'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        self.assertEqual(cluster_state.read_snapshot(self.path),
+                         {'timestamp': 1000, 'rings': []})
+
+        time.return_value = 1000 + cluster_state.SNAPSHOT_MAX_AGE + 1
+        self.assertIsNone(cluster_state.read_snapshot(self.path))
+
+        cluster_state.invalidate_snapshot(self.path)
+        cluster_state.invalidate_snapshot(self.path)
+        self.assertIsNone(cluster_state.read_snapshot(self.path, 3600))
+
+    @mock.patch.object(cluster_state, '_run')
+    def test_get_snapshot(self, _run):
+        outputs = {'crm_mon': CRM_MON_XML,
+                   'corosync-cfgtool': CFGTOOL_OUTPUT,
+                   'cibadmin': CIB_CONSTRAINTS_XML}
+        _run.side_effect = lambda cmd, sudo: outputs[cmd[0]]
+
+        snapshot = cluster_state.get_snapshot(path=self.path, write=True)
+        self.assertEqual(_run.call_count, 3)
+        self.assertEqual(snapshot['crm_mon']['summary']['dc'], 'juju-1')
+        self.assertEqual(len(snapshot['rings']), 2)
+
+        # a fresh snapshot is read back without querying the cluster
+        self.assertEqual(
+            cluster_state.get_snapshot(path=self.path)['crm_mon'],
+            snapshot['crm_mon'])
+        self.assertEqual(_run.call_count, 3)
+
+    @mock.patch.object(cluster_state, '_run')
+    def test_main_query_failure(self, _run):
+        cluster_state.write_snapshot({'timestamp': 1}, self.path)
+        _run.side_effect = subprocess.CalledProcessError(1, 'crm_mon')
+        with mock.patch('sys.stderr'):
+            self.assertEqual(cluster_state.main(['--path', self.path]), 1)
+        # the previous snapshot is kept
+        self.assertEqual(cluster_state.read_snapshot(self.path, 1e10),
+                         {'timestamp': 1})
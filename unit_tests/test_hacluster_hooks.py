@@ -23,8 +23,11 @@ import test_utils
 mock_apt = mock.MagicMock()
 sys.modules['apt_pkg'] = mock_apt
 import hooks
+import pcmk
 import utils
 
+from charmhelpers.core import unitdata
+
 
 @mock.patch.object(hooks, 'log', lambda *args, **kwargs: None)
 @mock.patch('utils.COROSYNC_CONF', os.path.join(tempfile.mkdtemp(),
@@ -34,6 +37,35 @@ class TestCorosyncConf(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False)
+        patcher = mock.patch.object(hooks, 'resources_to_cleanup')
+        self.resources_to_cleanup = patcher.start()
+        self.resources_to_cleanup.return_value = {}
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pcmk, 'validate_resource_params')
+        self.validate_resource_params = patcher.start()
+        self.validate_resource_params.return_value = []
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pcmk, 'crm_opts_exist')
+        self.crm_opts_exist = patcher.start()
+        self.crm_opts_exist.return_value = set()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(hooks, 'assign_admission_slots')
+        self.assign_admission_slots = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(hooks, 'update_nrpe_config')
+        self.update_nrpe_config = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(hooks, 'get_resource_wait_mode')
+        patcher.start().return_value = 'serial'
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(hooks, 'nrpe_ring_count_changed')
+        self.nrpe_ring_count_changed = patcher.start()
+        self.nrpe_ring_count_changed.return_value = False
+        self.addCleanup(patcher.stop)
+        # the apply journal and the resource checksums are committed
+        patcher = mock.patch.object(unitdata, 'kv')
+        patcher.start().return_value = unitdata.Storage(':memory:')
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
@@ -44,9 +76,7 @@ class TestCorosyncConf(unittest.TestCase):
     @mock.patch('pcmk.crm_opt_exists')
     @mock.patch.object(hooks, 'is_leader')
     @mock.patch.object(hooks, 'configure_corosync')
-    @mock.patch.object(hooks, 'configure_cluster_global')
-    @mock.patch.object(hooks, 'configure_monitor_host')
-    @mock.patch.object(hooks, 'configure_stonith')
+    @mock.patch.object(hooks, 'configure_cluster_globals')
     @mock.patch.object(hooks, 'related_units')
     @mock.patch.object(hooks, 'get_cluster_nodes')
     @mock.patch.object(hooks, 'relation_set')
@@ -58,8 +88,7 @@ class TestCorosyncConf(unittest.TestCase):
     def test_ha_relation_changed(self, parse_data, config, commit,
                                  get_corosync_conf, relation_ids, relation_set,
                                  get_cluster_nodes, related_units,
-                                 configure_stonith, configure_monitor_host,
-                                 configure_cluster_global, configure_corosync,
+                                 configure_cluster_globals, configure_corosync,
                                  is_leader, crm_opt_exists,
                                  wait_for_pcmk, write_maas_dns_address):
 
@@ -68,6 +97,7 @@ class TestCorosyncConf(unittest.TestCase):
             return res_name == "res_ubuntu"
 
         crm_opt_exists.side_effect = fake_crm_opt_exists
+        self.crm_opts_exist.return_value = {'res_ubuntu'}
         commit.return_value = 0
         is_leader.return_value = True
         related_units.return_value = ['ha/0', 'ha/1', 'ha/2']
@@ -98,17 +128,39 @@ class TestCorosyncConf(unittest.TestCase):
             return rel_get_data.get(key, {})
 
         parse_data.side_effect = fake_parse_data
+        self.resources_to_cleanup.return_value = {'res_foo': ['juju-0'],
+                                                  'res_bar': []}
 
         with mock.patch.object(tempfile, "NamedTemporaryFile",
                                side_effect=lambda: self.tmpfile):
             hooks.ha_relation_changed()
 
         relation_set.assert_any_call(relation_id='hanode:1', ready=True)
-        configure_stonith.assert_called_with()
-        configure_monitor_host.assert_called_with()
-        configure_cluster_global.assert_called_with()
+        self.assign_admission_slots.assert_called_once_with()
+        # an existing resource isn't rejected for unknown parameters
+        self.validate_resource_params.assert_any_call(
+            'IPaddr2', 'params ubuntu=42', cache={}, existing=True)
+        self.validate_resource_params.assert_any_call(
+            'ocf:heartbeat:IPaddr2', 'params bar', cache={}, existing=False)
+        # the NRPE checks already expect the configured rings
+        self.nrpe_ring_count_changed.assert_called_once_with()
+        self.update_nrpe_config.assert_not_called()
+        configure_cluster_globals.assert_called_with()
         configure_corosync.assert_called_with()
         write_maas_dns_address.assert_not_called()
+        self.resources_to_cleanup.assert_called_once_with(
+            rel_get_data['resources'], rel_get_data['clones'],
+            rel_get_data['groups'])
+        commit.assert_any_call(
+            'crm_resource --cleanup --resource res_foo --node juju-0')
+        commit.assert_any_call('crm_resource --cleanup --resource res_bar')
+        self.assertNotIn(mock.call('crm resource cleanup cl_foo'),
+                         commit.call_args_list)
+        # all the changes were applied
+        self.assertIsNone(unitdata.kv().get(pcmk.APPLY_JOURNAL_KEY))
+        self.assertEqual(unitdata.kv().get('res_ubuntu-IPaddr2'),
+                         pcmk.resource_checksum('res_ubuntu', 'IPaddr2',
+                                                'params ubuntu=42'))
 
         for kw, key in [('location', 'locations'),
                         ('clone', 'clones'),
@@ -138,9 +190,7 @@ class TestCorosyncConf(unittest.TestCase):
     @mock.patch('pcmk.crm_opt_exists')
     @mock.patch.object(hooks, 'is_leader')
     @mock.patch.object(hooks, 'configure_corosync')
-    @mock.patch.object(hooks, 'configure_cluster_global')
-    @mock.patch.object(hooks, 'configure_monitor_host')
-    @mock.patch.object(hooks, 'configure_stonith')
+    @mock.patch.object(hooks, 'configure_cluster_globals')
     @mock.patch.object(hooks, 'related_units')
     @mock.patch.object(hooks, 'get_cluster_nodes')
     @mock.patch.object(hooks, 'relation_set')
@@ -152,9 +202,8 @@ class TestCorosyncConf(unittest.TestCase):
     def test_ha_relation_changed_dns_ha(self, parse_data, config, commit,
                                         get_corosync_conf, relation_ids,
                                         relation_set, get_cluster_nodes,
-                                        related_units, configure_stonith,
-                                        configure_monitor_host,
-                                        configure_cluster_global,
+                                        related_units,
+                                        configure_cluster_globals,
                                         configure_corosync, is_leader,
                                         crm_opt_exists,
                                         wait_for_pcmk, validate_dns_ha,
@@ -209,9 +258,7 @@ class TestCorosyncConf(unittest.TestCase):
     @mock.patch('pcmk.crm_opt_exists')
     @mock.patch.object(hooks, 'is_leader')
     @mock.patch.object(hooks, 'configure_corosync')
-    @mock.patch.object(hooks, 'configure_cluster_global')
-    @mock.patch.object(hooks, 'configure_monitor_host')
-    @mock.patch.object(hooks, 'configure_stonith')
+    @mock.patch.object(hooks, 'configure_cluster_globals')
     @mock.patch.object(hooks, 'related_units')
     @mock.patch.object(hooks, 'get_cluster_nodes')
     @mock.patch.object(hooks, 'relation_set')
@@ -222,9 +269,9 @@ class TestCorosyncConf(unittest.TestCase):
     @mock.patch.object(hooks, 'parse_data')
     def test_ha_relation_changed_dns_ha_missing(
             self, parse_data, config, commit, get_corosync_conf, relation_ids,
-            relation_set, get_cluster_nodes, related_units, configure_stonith,
-            configure_monitor_host, configure_cluster_global,
-            configure_corosync, is_leader, crm_opt_exists,
+            relation_set, get_cluster_nodes, related_units,
+            configure_cluster_globals, configure_corosync, is_leader,
+            crm_opt_exists,
             wait_for_pcmk, validate_dns_ha, setup_maas_api):
 
         def fake_validate():
@@ -269,12 +316,19 @@ class TestCorosyncConf(unittest.TestCase):
 class TestHooks(test_utils.CharmTestCase):
     TO_PATCH = [
         'config',
-        'enable_lsb_services'
+        'enable_lsb_services',
+        'setup_cluster_state_collector',
+        'configure_cluster_globals',
+        'assign_admission_slots',
     ]
 
     def setUp(self):
         super(TestHooks, self).setUp(hooks, self.TO_PATCH)
         self.config.side_effect = self.test_config.get
+        # the last workload status sent is kept in the unit state
+        patcher = mock.patch.object(unitdata, 'kv')
+        patcher.start().return_value = unitdata.Storage(':memory:')
+        self.addCleanup(patcher.stop)
 
     @mock.patch.object(hooks, 'relation_ids')
     @mock.patch.object(hooks, 'hanode_relation_joined')
@@ -304,6 +358,8 @@ class TestHooks(test_utils.CharmTestCase):
         mock_maintenance_mode.assert_not_called()
         mock_relation_ids.assert_called_with('hanode')
         mock_hanode_relation_joined.assert_called_once_with('hanode:1')
+        self.configure_cluster_globals.assert_called_once_with()
+        self.assign_admission_slots.assert_called_once_with()
 
         # enable maintenance
         self.test_config.set_previous('maintenance-mode', False)
@@ -351,15 +407,19 @@ class TestHooks(test_utils.CharmTestCase):
         write_maas_dns_address.assert_called_with(
             "res_keystone_public_hostname", "172.16.0.1")
 
+    @mock.patch.object(hooks, 'get_ring1_addr')
     @mock.patch.object(hooks, 'get_relation_ip')
     @mock.patch.object(hooks, 'relation_set')
     def test_hanode_relation_joined(self,
                                     mock_relation_set,
-                                    mock_get_relation_ip):
+                                    mock_get_relation_ip,
+                                    mock_get_ring1_addr):
         mock_get_relation_ip.return_value = '10.10.10.2'
+        mock_get_ring1_addr.return_value = '10.20.10.2'
         hooks.hanode_relation_joined('hanode:1')
         mock_get_relation_ip.assert_called_once_with('hanode')
         mock_relation_set.assert_called_once_with(
             relation_id='hanode:1',
-            relation_settings={'private-address': '10.10.10.2'}
+            relation_settings={'private-address': '10.10.10.2',
+                               'ring1-address': '10.20.10.2'}
         )
@@ -17,13 +17,17 @@ import mock
 import os
 import re
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
 import unittest
 
 import utils
 import pcmk
 
+from charmhelpers.core import unitdata
+
 
 def write_file(path, content, *args, **kwargs):
     with open(path, 'wt') as f:
@@ -90,6 +94,51 @@ class UtilsTestCaseWriteTmp(unittest.TestCase):
     def test_debug_off(self):
         self.check_debug(False)
 
+    @mock.patch.object(utils, 'get_ring1_addr', lambda: '10.1.0.1')
+    @mock.patch.object(utils, 'local_unit', lambda: 'hacluster/0')
+    @mock.patch.object(utils, 'peer_topology')
+    @mock.patch.object(utils, 'get_ha_nodes')
+    @mock.patch.object(utils, 'config')
+    def test_redundant_ring(self, mock_config, get_ha_nodes, peer_topology):
+        cfg = {'prefer-ipv6': False,
+               'corosync_transport': 'udpu',
+               'corosync_rrp_mode': 'passive'}
+        mock_config.side_effect = lambda k: cfg.get(k)
+        get_ha_nodes.return_value = {1000: '10.0.0.1', 1001: '10.0.0.2'}
+        topology = peer_topology.return_value
+        topology.corosync_ids = {'hacluster/1': 1001}
+        topology.settings = {'hacluster/1': {'private-address': '10.0.0.2'}}
+
+        # the peer has not published its ring1 address yet
+        conf = utils.get_corosync_conf()
+        self.assertNotIn('rrp_mode', conf)
+        self.assertEqual(utils.corosync_ring_count(), 1)
+
+        topology.settings['hacluster/1']['ring1-address'] = '10.1.0.2'
+        conf = utils.get_corosync_conf()
+        self.assertEqual(conf['rrp_mode'], 'passive')
+        self.assertEqual(conf['ring1_nodes'],
+                         {1000: '10.1.0.1', 1001: '10.1.0.2'})
+        self.assertEqual(utils.corosync_ring_count(), 2)
+
+        self.assertTrue(utils.emit_corosync_conf())
+        with open(utils.COROSYNC_CONF, 'rt') as fd:
+            content = fd.read()
+        self.assertIn('rrp_mode: passive\n', content)
+        self.assertIn('ring0_addr: 10.0.0.2\n\t\tring1_addr: 10.1.0.2\n',
+                      content)
+
+        # the redundant ring isn't configured with multicast
+        cfg['corosync_transport'] = 'multicast'
+        self.assertEqual(utils.get_ring_conf(utils.get_transport(),
+                                             get_ha_nodes.return_value), {})
+        self.assertEqual(utils.corosync_ring_count(), 1)
+        cfg['corosync_transport'] = 'udpu'
+
+        cfg['corosync_rrp_mode'] = 'bogus'
+        with mock.patch.object(utils, 'status_set'):
+            self.assertRaises(ValueError, utils.get_corosync_conf)
+
 
 class UtilsTestCase(unittest.TestCase):
 
@@ -113,12 +162,16 @@ class UtilsTestCase(unittest.TestCase):
     @mock.patch.object(utils, 'get_host_ip')
     @mock.patch.object(utils.utils, 'is_ipv6', lambda *args: None)
     @mock.patch.object(utils, 'get_corosync_id', lambda u: "%s-cid" % (u))
-    @mock.patch.object(utils, 'peer_ips', lambda *args, **kwargs:
-                       {'hanode/1': '10.0.0.2'})
+    @mock.patch.object(utils, 'peer_topology', lambda *args: mock.Mock(
+        addresses={'hanode/1': '10.0.0.2'},
+        corosync_ids={'hanode/1': 'hanode/1-cid'}))
     @mock.patch.object(utils, 'unit_get')
     @mock.patch.object(utils, 'config')
-    def test_get_ha_nodes(self, mock_config, mock_unit_get, mock_get_host_ip,
-                          mock_get_ipv6_addr):
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_get_ha_nodes(self, kv, mock_config, mock_unit_get,
+                          mock_get_host_ip, mock_get_ipv6_addr):
+        # the resolved addresses are cached
+        kv.return_value = unitdata.Storage(':memory:')
         mock_get_host_ip.side_effect = lambda host: host
 
         def unit_get(key):
@@ -142,8 +195,9 @@ class UtilsTestCase(unittest.TestCase):
     @mock.patch.object(utils, 'get_host_ip')
     @mock.patch.object(utils.utils, 'is_ipv6')
     @mock.patch.object(utils, 'get_corosync_id', lambda u: "%s-cid" % (u))
-    @mock.patch.object(utils, 'peer_ips', lambda *args, **kwargs:
-                       {'hanode/1': '2001:db8:1::2'})
+    @mock.patch.object(utils, 'peer_topology', lambda *args: mock.Mock(
+        addresses={'hanode/1': '2001:db8:1::2'},
+        corosync_ids={'hanode/1': 'hanode/1-cid'}))
     @mock.patch.object(utils, 'unit_get')
     @mock.patch.object(utils, 'config')
     def test_get_ha_nodes_ipv6(self, mock_config, mock_unit_get, mock_is_ipv6,
@@ -213,17 +267,150 @@ class UtilsTestCase(unittest.TestCase):
         isfile_mock.assert_called_once_with(wish)
 
     @mock.patch.object(subprocess, 'check_output')
-    @mock.patch.object(subprocess, 'call')
-    def test_kill_legacy_ocf_daemon_process(self, call_mock,
-                                            check_output_mock):
-        ps_output = b'''
-          PID CMD
-          6863 sshd: ubuntu@pts/7
-          11109 /usr/bin/python /usr/bin/ceilometer-agent-central --config
-        '''
-        check_output_mock.return_value = ps_output
-        utils.kill_legacy_ocf_daemon_process('res_ceilometer_agent_central')
-        call_mock.assert_called_once_with(['sudo', 'kill', '-9', '11109'])
+    def test_systemd_unit_states(self, check_output):
+        check_output.return_value = (
+            'LoadState=loaded\nActiveState=active\nUnitFileState=enabled\n'
+            '\n'
+            'LoadState=not-found\nActiveState=inactive\nUnitFileState=\n')
+        self.assertEqual(
+            utils.systemd_unit_states(['haproxy', 'nonexistent']),
+            {'haproxy': {'LoadState': 'loaded', 'ActiveState': 'active',
+                         'UnitFileState': 'enabled'},
+             'nonexistent': {'LoadState': 'not-found',
+                             'ActiveState': 'inactive',
+                             'UnitFileState': ''}})
+        check_output.assert_called_once_with(
+            ['systemctl', 'show',
+             '--property=LoadState,ActiveState,UnitFileState', '--',
+             'haproxy', 'nonexistent'], universal_newlines=True)
+
+    @mock.patch.object(subprocess, 'check_call')
+    @mock.patch.object(utils, 'systemd_unit_states')
+    @mock.patch.object(utils, 'init_is_systemd')
+    def test_disable_init_services(self, init_is_systemd,
+                                   systemd_unit_states, check_call):
+        init_is_systemd.return_value = True
+        systemd_unit_states.return_value = {
+            'apache2': {'LoadState': 'loaded', 'ActiveState': 'inactive',
+                        'UnitFileState': 'disabled'},
+            'haproxy': {'LoadState': 'loaded', 'ActiveState': 'active',
+                        'UnitFileState': 'disabled'},
+            'memcached': {'LoadState': 'loaded', 'ActiveState': 'inactive',
+                          'UnitFileState': 'enabled'},
+            'nonexistent': {'LoadState': 'not-found',
+                            'ActiveState': 'inactive',
+                            'UnitFileState': ''}}
+        utils.disable_init_services(['haproxy', 'apache2', 'nonexistent'],
+                                    ['memcached', 'haproxy'])
+        systemd_unit_states.assert_called_once_with(
+            ['apache2', 'haproxy', 'memcached', 'nonexistent'])
+        check_call.assert_called_once_with(
+            ['systemctl', 'disable', '--now', '--', 'haproxy', 'memcached'])
+
+        # already disabled and stopped
+        check_call.reset_mock()
+        systemd_unit_states.return_value = {
+            'apache2': {'LoadState': 'loaded', 'ActiveState': 'inactive',
+                        'UnitFileState': 'disabled'}}
+        utils.disable_init_services(['apache2'])
+        self.assertFalse(check_call.called)
+
+    @mock.patch.object(utils, 'service_stop')
+    @mock.patch.object(utils, 'service_running')
+    @mock.patch.object(utils, 'disable_upstart_services')
+    @mock.patch.object(utils, 'disable_lsb_services')
+    @mock.patch.object(utils, 'init_is_systemd')
+    def test_disable_init_services_upstart(self, init_is_systemd,
+                                           disable_lsb_services,
+                                           disable_upstart_services,
+                                           service_running, service_stop):
+        init_is_systemd.return_value = False
+        service_running.side_effect = lambda s: s == 'haproxy'
+        utils.disable_init_services(['haproxy'], ['memcached'])
+        disable_lsb_services.assert_called_once_with('haproxy')
+        disable_upstart_services.assert_called_once_with('memcached')
+        service_stop.assert_called_once_with('haproxy')
+
+    def test_find_processes(self):
+        proc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, proc)
+        cmdlines = {
+            '6863': b'sshd: ubuntu@pts/7\0',
+            '11109': (b'/usr/bin/python\0/usr/bin/ceilometer-agent-central'
+                      b'\0--config\0'),
+            '11110': b'/usr/bin/ceilometer-agent-central\0',
+            '11112': (b'/usr/bin/python3\0-u\0/usr/bin/aodh-evaluator'
+                      b'\0--log-file\0/var/log/aodh/aodh-evaluator.log\0'),
+            # named like a daemon but only as a path argument
+            '12000': (b'tail\0-f\0/var/log/ceilometer/'
+                      b'ceilometer-agent-central\0'),
+            '12001': (b'/usr/bin/python3\0/usr/bin/vim-wrapper\0'
+                      b'/usr/bin/aodh-evaluator\0'),
+            # kernel threads have an empty command line
+            '2': b'',
+        }
+        for pid, cmdline in cmdlines.items():
+            os.mkdir(os.path.join(proc, pid))
+            with open(os.path.join(proc, pid, 'cmdline'), 'wb') as f:
+                f.write(cmdline)
+        os.mkdir(os.path.join(proc, 'sys'))
+        # exited between the listing and the read
+        os.mkdir(os.path.join(proc, '11111'))
+
+        self.assertEqual(
+            utils.find_processes(['ceilometer-agent-central',
+                                  'aodh-evaluator'], proc=proc),
+            {'ceilometer-agent-central': [11109, 11110],
+             'aodh-evaluator': [11112]})
+
+    def test_program_name(self):
+        self.assertEqual(utils.program_name(['/usr/bin/aodh-evaluator']),
+                         'aodh-evaluator')
+        self.assertEqual(utils.program_name(['python2.7', '-u',
+                                             '/usr/bin/aodh-evaluator']),
+                         'aodh-evaluator')
+        self.assertEqual(utils.program_name(['grep', 'aodh-evaluator']),
+                         'grep')
+        self.assertEqual(utils.program_name(['python3']), 'python3')
+        self.assertIsNone(utils.program_name([]))
+
+    @mock.patch('time.sleep')
+    @mock.patch('os.kill')
+    def test_terminate_processes(self, kill, sleep):
+        exited = {11109}
+
+        def fake_kill(pid, sig):
+            if pid in exited:
+                raise ProcessLookupError(pid)
+            if sig == signal.SIGTERM and pid == 11110:
+                exited.add(pid)
+
+        kill.side_effect = fake_kill
+        self.assertEqual(
+            utils.terminate_processes([11109, 11110, 11111], timeout=0.5),
+            [11111])
+        kill.assert_any_call(11110, signal.SIGTERM)
+        kill.assert_any_call(11111, signal.SIGTERM)
+        kill.assert_called_with(11111, signal.SIGKILL)
+        self.assertNotIn(mock.call(11110, signal.SIGKILL),
+                         kill.call_args_list)
+
+    @mock.patch.object(utils, 'terminate_processes')
+    @mock.patch.object(utils, 'find_processes')
+    def test_kill_legacy_ocf_daemon_processes(self, find_processes,
+                                              terminate_processes):
+        find_processes.return_value = {'ceilometer-agent-central': [11109],
+                                       'aodh-evaluator': [2001, 2002]}
+        utils.kill_legacy_ocf_daemon_processes(
+            ['res_ceilometer_agent_central', 'res_aodh_evaluator'])
+        find_processes.assert_called_once_with(
+            ['ceilometer-agent-central', 'aodh-evaluator'])
+        terminate_processes.assert_called_once_with([2001, 2002, 11109])
+
+        # nothing to scan for
+        find_processes.reset_mock()
+        utils.kill_legacy_ocf_daemon_processes([])
+        self.assertFalse(find_processes.called)
 
     @mock.patch.object(pcmk, 'wait_for_pcmk')
     def test_try_pcmk_wait(self, mock_wait_for_pcmk):
@@ -442,3 +629,486 @@ class UtilsTestCase(unittest.TestCase):
         relation_get.assert_has_calls([
             mock.call('json_testkey', 'neutron-api/0', 'hacluster:1'),
         ])
+
+    @mock.patch.object(utils, 'remove_prometheus_textfile')
+    @mock.patch.object(utils, 'charm_dir')
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils, 'write_file')
+    def test_setup_cluster_state_collector(self, write_file, config,
+                                           charm_dir, remove_textfile):
+        charm_dir.return_value = '/var/lib/juju/charm'
+        config.return_value = '/var/lib/prometheus/node-exporter'
+        utils.setup_cluster_state_collector()
+        write_file.assert_called_once_with(
+            '/etc/cron.d/hacluster-cluster-state',
+            '# Managed by juju\n'
+            '* * * * * root /usr/bin/python3 '
+            '/var/lib/juju/charm/hooks/cluster_state.py '
+            '--textfile /var/lib/prometheus/node-exporter/hacluster.prom '
+            '>/dev/null 2>&1\n', perms=0o644)
+        remove_textfile.assert_called_once_with(
+            keep='/var/lib/prometheus/node-exporter/hacluster.prom')
+
+        config.return_value = ''
+        utils.setup_cluster_state_collector()
+        self.assertNotIn('--textfile', write_file.call_args[0][1])
+        remove_textfile.assert_called_with(keep=None)
+
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_remove_prometheus_textfile(self, kv, config):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        old = os.path.join(tmpdir, 'old', 'hacluster.prom')
+        new = os.path.join(tmpdir, 'new', 'hacluster.prom')
+        for path in (old, new):
+            os.mkdir(os.path.dirname(path))
+            open(path, 'w').close()
+        # exported to old before the path was recorded
+        config.return_value.previous.return_value = os.path.dirname(old)
+
+        # the directory changed, the metrics left in old are removed
+        utils.remove_prometheus_textfile(keep=new)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+        # then new is the recorded path
+        config.return_value.previous.return_value = None
+        utils.remove_prometheus_textfile(keep=new)
+        self.assertTrue(os.path.exists(new))
+        utils.remove_prometheus_textfile()
+        self.assertFalse(os.path.exists(new))
+
+    @mock.patch.object(utils, 'get_cluster_state')
+    def test_resources_to_cleanup(self, get_cluster_state):
+        get_cluster_state.return_value = {'crm_mon': {
+            'fail_counts': {'res_foo': {'juju-0': 1}},
+            'failed_actions': [],
+            'resources': {'res_bar': {'failed': False}}}}
+        self.assertEqual(
+            utils.resources_to_cleanup(['res_foo', 'res_bar'],
+                                       {'cl_foo': 'res_foo'}, {}),
+            {'res_foo': ['juju-0']})
+        get_cluster_state.assert_called_once_with(max_age=0)
+
+        # pacemaker can't be queried, clean up as much as possible
+        get_cluster_state.return_value = None
+        self.assertEqual(
+            utils.resources_to_cleanup(['res_foo', 'res_bar'],
+                                       {'cl_foo': 'res_foo'},
+                                       {'grp_foo': 'res_bar'}),
+            {'cl_foo': [], 'grp_foo': []})
+
+    @mock.patch.object(utils.time, 'time')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_compact_unit_state(self, kv, _time):
+        db = unitdata.Storage(':memory:')
+        kv.return_value = db
+        for i in range(utils.UNIT_STATE_KEEP_HOOKS + 2):
+            with db.hook_scope('update-status'):
+                db.set('env', {'JUJU_CONTEXT_ID': i})
+        _time.return_value = 100000
+
+        with mock.patch.object(utils.unitstate, 'vacuum') as vacuum:
+            self.assertEqual(utils.compact_unit_state(), 2)
+            vacuum.assert_called_once_with(db)
+            self.assertEqual(len(db.gethistory('env')),
+                             utils.UNIT_STATE_KEEP_HOOKS)
+
+            # vacuumed once a day
+            _time.return_value += 3600
+            self.assertEqual(utils.compact_unit_state(), 0)
+            vacuum.assert_called_once_with(db)
+
+    @mock.patch.object(utils, 'peer_topology')
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils, 'leader_set')
+    @mock.patch.object(utils, 'leader_get')
+    def test_assign_admission_slots(self, leader_get, leader_set, config,
+                                    peer_topology):
+        config.return_value = 2
+        peer_topology.return_value.units = ['hacluster/10', 'hacluster/1',
+                                            'hacluster/2']
+        leader_get.return_value = None
+        self.assertTrue(utils.assign_admission_slots())
+        assignment = ('{"hacluster/1": 0, "hacluster/10": 0, '
+                      '"hacluster/2": 1}')
+        leader_set.assert_called_once_with({'admission-slots': assignment})
+
+        leader_set.reset_mock()
+        leader_get.return_value = assignment
+        self.assertFalse(utils.assign_admission_slots())
+        self.assertFalse(leader_set.called)
+
+    @mock.patch('time.sleep')
+    @mock.patch('random.uniform')
+    @mock.patch.object(utils, 'modulo_distribution')
+    @mock.patch.object(utils, 'local_unit')
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils, 'leader_get')
+    @mock.patch.object(utils, 'is_leader')
+    def test_admission_wait(self, is_leader, leader_get, config, local_unit,
+                            modulo_distribution, uniform, sleep):
+        cfg = {'admission_slots': 2, 'admission_slot_wait': 30,
+               'hook_jitter': 10}
+        config.side_effect = lambda key: cfg.get(key)
+        leader_get.return_value = '{"hacluster/1": 1}'
+        uniform.return_value = 4.0
+
+        # the leader never waits
+        is_leader.return_value = True
+        self.assertEqual(utils.admission_wait(), 0)
+        self.assertFalse(sleep.called)
+
+        is_leader.return_value = False
+        local_unit.return_value = 'hacluster/1'
+        self.assertEqual(utils.admission_wait(), 64.0)
+        uniform.assert_called_once_with(0, 10)
+        sleep.assert_called_once_with(64.0)
+
+        # not assigned a slot yet
+        local_unit.return_value = 'hacluster/3'
+        modulo_distribution.return_value = 30
+        self.assertEqual(utils.admission_wait(), 34.0)
+        modulo_distribution.assert_called_once_with(modulo=2, wait=30,
+                                                    non_zero_wait=True)
+
+        # disabled
+        cfg = {}
+        sleep.reset_mock()
+        self.assertEqual(utils.admission_wait(), 0)
+        self.assertFalse(sleep.called)
+
+    @mock.patch('pcmk.update_cluster_options')
+    @mock.patch.object(utils, 'config')
+    def test_configure_cluster_global(self, config, update_cluster_options):
+        config.return_value = 'true'
+        utils.configure_cluster_global()
+        update_cluster_options.assert_called_once_with(
+            properties={'no-quorum-policy': 'stop',
+                        'cluster-recheck-interval': 60,
+                        'stonith-enabled': 'true'},
+            rsc_defaults={'resource-stickiness': 100})
+
+    @mock.patch.object(utils.unitdata, 'kv')
+    @mock.patch('pcmk.commit')
+    @mock.patch('pcmk.is_resource_present')
+    @mock.patch('pcmk.list_nodes')
+    @mock.patch.object(utils, 'apt_install')
+    @mock.patch.object(utils, 'filter_installed_packages')
+    @mock.patch.object(utils.maas, 'MAASHelper')
+    @mock.patch.object(utils, 'config')
+    def test_configure_stonith_timeouts_changed(
+            self, config, MAASHelper, filter_installed_packages, apt_install,
+            list_nodes, is_resource_present, commit, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        cfg = {'stonith_enabled': 'true',
+               'maas_url': 'http://maas/MAAS',
+               'maas_credentials': 'key',
+               'stonith_timeouts': ''}
+        config.side_effect = lambda key: cfg.get(key)
+        MAASHelper.return_value.list_nodes.return_value = [
+            {'hostname': 'juju-0.maas', 'power_type': 'ipmi',
+             'power_parameters': {'power_address': '10.0.0.100',
+                                  'power_user': 'admin',
+                                  'power_pass': 'secret'}}]
+        list_nodes.return_value = ['juju-0']
+        is_resource_present.return_value = False
+        commit.return_value = 0
+
+        utils.configure_stonith()
+        commit.assert_any_call(
+            'crm -F configure primitive res_stonith_juju-0 '
+            'stonith:fence_ipmilan params pcmk_host_list=juju-0 '
+            'ipaddr=10.0.0.100 login=admin passwd=secret lanplus=1 '
+            'login_timeout=5 power_timeout=10 shell_timeout=5')
+        self.assertEqual(commit.call_count, 2)
+
+        # deployed, unchanged: nothing is written
+        is_resource_present.return_value = True
+        commit.reset_mock()
+        utils.configure_stonith()
+        commit.assert_not_called()
+
+        # the new timeouts are pushed to the existing primitive
+        cfg['stonith_timeouts'] = 'ipmi:power_timeout=30'
+        written = []
+
+        def load_update(cmd):
+            with open(cmd.split()[-1]) as f:
+                written.append(f.read())
+            return 0
+
+        commit.side_effect = load_update
+        utils.configure_stonith()
+        self.assertEqual(commit.call_count, 1)
+        self.assertIn('power_timeout=30', written[0])
+        self.assertTrue(written[0].startswith(
+            'primitive res_stonith_juju-0 stonith:fence_ipmilan'))
+
+    @mock.patch.object(utils, 'configure_stonith')
+    @mock.patch.object(utils, 'configure_monitor_host')
+    @mock.patch.object(utils, 'configure_cluster_global')
+    @mock.patch.object(utils, 'get_cluster_nodes')
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils, 'leader_set')
+    @mock.patch.object(utils, 'leader_get')
+    @mock.patch.object(utils, 'is_leader')
+    def test_configure_cluster_globals(self, is_leader, leader_get,
+                                       leader_set, config, get_cluster_nodes,
+                                       configure_cluster_global,
+                                       configure_monitor_host,
+                                       configure_stonith):
+        cfg = {'stonith_enabled': 'false', 'monitor_host': '10.0.0.1'}
+        config.side_effect = lambda key: cfg.get(key)
+        get_cluster_nodes.return_value = ['10.0.0.11', '10.0.0.10']
+        applied = [configure_cluster_global, configure_monitor_host,
+                   configure_stonith]
+
+        is_leader.return_value = True
+        self.assertTrue(utils.configure_cluster_globals())
+        fingerprint = utils.cluster_globals_fingerprint()
+        leader_set.assert_called_once_with(
+            {'cluster-globals-fingerprint': fingerprint})
+        for f in applied:
+            f.assert_called_once_with()
+
+        # followers skip what the leader already applied
+        is_leader.return_value = False
+        leader_get.return_value = fingerprint
+        self.assertFalse(utils.configure_cluster_globals())
+        leader_get.assert_called_once_with('cluster-globals-fingerprint')
+        for f in applied:
+            self.assertEqual(f.call_count, 1)
+
+        # but not a configuration the leader hasn't applied yet
+        cfg['monitor_host'] = '10.0.0.2'
+        self.assertTrue(utils.configure_cluster_globals())
+        for f in applied:
+            self.assertEqual(f.call_count, 2)
+        self.assertEqual(leader_set.call_count, 1)
+
+    @mock.patch.object(utils, 'status_set')
+    @mock.patch.object(utils, 'config')
+    def test_get_resource_wait_mode(self, config, status_set):
+        config.return_value = None
+        self.assertEqual(utils.get_resource_wait_mode(), 'serial')
+        config.return_value = 'batch'
+        self.assertEqual(utils.get_resource_wait_mode(), 'batch')
+        status_set.assert_not_called()
+        config.return_value = 'bacth'
+        self.assertRaises(ValueError, utils.get_resource_wait_mode)
+        status_set.assert_called_once_with(
+            'blocked', "Unsupported resource_wait_mode 'bacth' - supported "
+                       "modes are: serial, batch")
+
+    @mock.patch.object(utils, 'corosync_ring_count')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_nrpe_ring_count_changed(self, kv, corosync_ring_count):
+        kv.return_value = unitdata.Storage(':memory:')
+        corosync_ring_count.return_value = 1
+        self.assertTrue(utils.nrpe_ring_count_changed())
+        utils.set_nrpe_ring_count(1)
+        self.assertFalse(utils.nrpe_ring_count_changed())
+        # the redundant ring was added
+        corosync_ring_count.return_value = 2
+        self.assertTrue(utils.nrpe_ring_count_changed())
+
+    def test_sync_files(self):
+        src = tempfile.mkdtemp()
+        dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        self.addCleanup(shutil.rmtree, dst)
+        for name in ('check_a', 'check_b'):
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(name)
+
+        self.assertEqual(utils.sync_files(src, dst),
+                         [os.path.join(dst, 'check_a'),
+                          os.path.join(dst, 'check_b')])
+        self.assertEqual(utils.sync_files(src, dst), [])
+
+        with open(os.path.join(src, 'check_b'), 'w') as f:
+            f.write('updated')
+        self.assertEqual(utils.sync_files(src, dst),
+                         [os.path.join(dst, 'check_b')])
+
+    @mock.patch.object(utils.os, 'chown')
+    @mock.patch.object(utils.grp, 'getgrnam')
+    @mock.patch.object(utils.pwd, 'getpwnam')
+    @mock.patch.object(utils, 'relation_set')
+    @mock.patch.object(utils, 'relation_ids')
+    @mock.patch.object(utils, 'service_reload')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_write_nrpe_checks(self, kv, service_reload, relation_ids,
+                               relation_set, getpwnam, getgrnam, chown):
+        confdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, confdir)
+        logdir = os.path.join(confdir, 'nagios')
+        getpwnam.return_value.pw_uid = 107
+        getgrnam.return_value.gr_gid = 112
+        store = {}
+        kv.return_value.get.side_effect = lambda k: store.get(k)
+        kv.return_value.set.side_effect = lambda k, v: store.update({k: v})
+        relation_ids.side_effect = lambda r: (['nrpe-external-master:1']
+                                              if r == 'nrpe-external-master'
+                                              else [])
+
+        check = mock.MagicMock(shortname='crm_status',
+                               description='Check crm status',
+                               check_cmd='/usr/lib/check_cluster',
+                               command='check_crm_status')
+        check.write.side_effect = lambda *args: open(
+            os.path.join(confdir, 'check_crm_status.cfg'), 'w').close()
+        nrpe_setup = mock.MagicMock(hostname='juju-hacluster-0',
+                                    nagios_context='juju',
+                                    nagios_servicegroups='juju',
+                                    checks=[check])
+
+        with mock.patch.object(utils.nrpe.NRPE, 'nrpe_confdir', confdir), \
+                mock.patch.object(utils.nrpe.NRPE, 'nagios_logdir', logdir):
+            self.assertTrue(utils.write_nrpe_checks(nrpe_setup))
+            self.assertTrue(os.path.isdir(logdir))
+            chown.assert_called_once_with(logdir, 107, 112)
+            check.write.assert_called_once_with('juju', 'juju-hacluster-0',
+                                                'juju')
+            service_reload.assert_called_once_with('nagios-nrpe-server',
+                                                   restart_on_failure=True)
+            relation_set.assert_called_once_with(
+                relation_id='nrpe-external-master:1', monitors=mock.ANY)
+
+            # nothing changed, nothing written or reloaded
+            self.assertFalse(utils.write_nrpe_checks(nrpe_setup))
+            self.assertEqual(service_reload.call_count, 1)
+
+            check.check_cmd = '/usr/lib/check_cluster -w'
+            self.assertTrue(utils.write_nrpe_checks(nrpe_setup))
+            self.assertEqual(service_reload.call_count, 2)
+
+            # the nagios user isn't set up yet
+            getpwnam.side_effect = KeyError('nagios')
+            check.check_cmd = '/usr/lib/check_cluster -c'
+            self.assertFalse(utils.write_nrpe_checks(nrpe_setup))
+            self.assertEqual(check.write.call_count, 2)
+            self.assertEqual(service_reload.call_count, 2)
+
+    @mock.patch.object(utils, 'ensure_dnspython')
+    @mock.patch.object(utils, 'log')
+    @mock.patch.object(utils, 'get_host_ip')
+    @mock.patch.object(utils.unitdata, 'kv')
+    @mock.patch.object(utils.time, 'time')
+    def test_resolve_host_ips(self, time, kv, get_host_ip, log,
+                              ensure_dnspython):
+        store = {utils.HOST_IP_CACHE_KEY: {
+            'fresh': {'addr': '10.0.0.1', 'timestamp': 900},
+            'stale': {'addr': '10.0.0.2', 'timestamp': 0},
+        }}
+        kv.return_value.get.side_effect = lambda k: store.get(k)
+        kv.return_value.set.side_effect = lambda k, v: store.update({k: v})
+        time.return_value = 1000
+        dns_answered = threading.Event()
+
+        def fake_get_host_ip(name):
+            if name == 'stale':
+                # DNS is stuck, the stale answer is used
+                dns_answered.wait(5)
+                return '10.0.0.20'
+            return {'new': '10.0.0.3'}.get(name)
+
+        get_host_ip.side_effect = fake_get_host_ip
+        self.assertEqual(
+            utils.resolve_host_ips(['fresh', 'stale', 'new'], timeout=0.1),
+            {'fresh': '10.0.0.1', 'stale': '10.0.0.2', 'new': '10.0.0.3'})
+        ensure_dnspython.assert_called_once_with()
+        dns_answered.set()
+        self.assertEqual(store[utils.HOST_IP_CACHE_KEY]['stale'],
+                         {'addr': '10.0.0.2', 'timestamp': 0})
+        self.assertEqual(store[utils.HOST_IP_CACHE_KEY]['new'],
+                         {'addr': '10.0.0.3', 'timestamp': 1000})
+
+        # never resolved, there is no address to fall back to
+        self.assertRaises(ValueError, utils.resolve_host_ips,
+                          ['new', 'unknown'], timeout=0.1)
+        self.assertNotIn('unknown', store[utils.HOST_IP_CACHE_KEY])
+
+    @mock.patch.object(utils, 'apt_install')
+    def test_ensure_dnspython(self, apt_install):
+        utils.ensure_dnspython()
+        apt_install.assert_not_called()
+        with mock.patch.dict('sys.modules', {'dns': None,
+                                             'dns.resolver': None}):
+            utils.ensure_dnspython()
+        apt_install.assert_called_once_with('python3-dnspython', fatal=True)
+
+    @mock.patch.object(utils, 'relation_get')
+    @mock.patch.object(utils, 'related_units')
+    @mock.patch.object(utils, 'relation_ids')
+    def test_peer_topology(self, relation_ids, related_units, relation_get):
+        relation_ids.return_value = ['hanode:1']
+        related_units.return_value = ['hacluster/2', 'hacluster/1']
+        settings = {
+            'hacluster/1': {'private-address': '10.0.0.2', 'ready': 'True'},
+            'hacluster/2': {'private-address': '10.0.0.3'},
+        }
+        relation_get.side_effect = lambda rid, unit: settings[unit]
+
+        topology = utils.PeerTopology()
+        self.assertEqual(topology.units, ['hacluster/1', 'hacluster/2'])
+        self.assertEqual(topology.addresses,
+                         {'hacluster/1': '10.0.0.2',
+                          'hacluster/2': '10.0.0.3'})
+        self.assertEqual(topology.corosync_ids,
+                         {'hacluster/1': 1001, 'hacluster/2': 1002})
+        self.assertEqual(topology.ready_units, ['hacluster/1'])
+        self.assertEqual(topology.ready_addresses, ['10.0.0.2'])
+        self.assertEqual(topology.peer_count('hanode:1'), 2)
+        self.assertEqual(topology.peer_count('hanode:2'), 0)
+        # a single relation-get per unit
+        relation_get.assert_has_calls([
+            mock.call(rid='hanode:1', unit='hacluster/1'),
+            mock.call(rid='hanode:1', unit='hacluster/2'),
+        ])
+        self.assertEqual(relation_get.call_count, 2)
+
+    @mock.patch.object(utils, 'peer_topology')
+    @mock.patch.object(utils, 'unit_get')
+    @mock.patch.object(utils, 'config')
+    def test_get_cluster_nodes(self, config, unit_get, peer_topology):
+        config.return_value = False
+        unit_get.return_value = '10.0.0.4'
+        peer_topology.return_value.ready_addresses = ['10.0.0.2', '10.0.0.5']
+        self.assertEqual(utils.get_cluster_nodes(),
+                         ['10.0.0.2', '10.0.0.4', '10.0.0.5'])
+
+    @mock.patch.object(utils, 'leader_set')
+    @mock.patch.object(utils, 'leader_get')
+    @mock.patch.object(utils.totem, 'measure_rtt')
+    @mock.patch.object(utils, 'peer_topology')
+    @mock.patch.object(utils, 'get_ha_nodes')
+    @mock.patch.object(utils, 'config')
+    def test_update_peer_rtt(self, config, get_ha_nodes, peer_topology,
+                             measure_rtt, leader_get, leader_set):
+        cfg = {'corosync_totem_profile': 'low-latency',
+               'corosync_measure_rtt': True}
+        config.side_effect = lambda k: cfg.get(k)
+        get_ha_nodes.return_value = {1000: '10.0.0.1', 1001: '10.0.0.2',
+                                     1002: '10.0.0.3'}
+        peer_topology.return_value.addresses = {'hacluster/1': '10.0.0.2',
+                                                'hacluster/2': '10.0.0.3'}
+        leader_get.return_value = None
+        measure_rtt.return_value = 25.3
+
+        self.assertTrue(utils.update_peer_rtt())
+        measure_rtt.assert_called_once_with(['10.0.0.2', '10.0.0.3'])
+        leader_set.assert_called_once_with({'corosync-peer-rtt': '25.300'})
+
+        # a measure giving the same timings isn't published
+        leader_get.return_value = '25.300'
+        measure_rtt.return_value = 26.0
+        self.assertFalse(utils.update_peer_rtt())
+        self.assertEqual(leader_set.call_count, 1)
+
+        self.assertEqual(utils.get_totem_conf(3)['token'], 1600)
+        cfg['corosync_measure_rtt'] = False
+        self.assertEqual(utils.get_totem_conf(3)['token'], 1000)
@@ -0,0 +1,144 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+import hooktools
+
+from charmhelpers.core import unitdata
+
+
+@mock.patch.object(hooktools.hookenv, 'log')
+class TestLogBuffer(unittest.TestCase):
+
+    def test_flush(self, log):
+        buf = hooktools.LogBuffer(level='INFO')
+        buf.log('debug', level='DEBUG')
+        buf.log('one')
+        buf.log('two', level='INFO')
+        buf.log('three', level='INFO')
+        buf.log({'four': 4}, level='WARNING')
+        buf.log('five', level='WARN')
+        log.assert_not_called()
+
+        buf.flush()
+        self.assertEqual(log.call_args_list,
+                         [mock.call('one', level=None),
+                          mock.call('two\nthree', level='INFO'),
+                          mock.call("{'four': 4}", level='WARNING'),
+                          mock.call('five', level='WARN')])
+        log.reset_mock()
+        buf.flush()
+        log.assert_not_called()
+
+    def test_flush_on_error(self, log):
+        buf = hooktools.LogBuffer()
+        buf.log('configuring', level='DEBUG')
+        buf.log('failed', level='ERROR')
+        self.assertEqual(log.call_args_list,
+                         [mock.call('configuring', level='DEBUG'),
+                          mock.call('failed', level='ERROR')])
+
+    @mock.patch.object(hooktools, 'FLUSH_SIZE', 12)
+    def test_flush_size(self, log):
+        buf = hooktools.LogBuffer()
+        buf.log('12345')
+        log.assert_not_called()
+        buf.log('67890')
+        log.assert_called_once_with('12345\n67890', level=None)
+
+        # the queued messages are written before one which would take them
+        # over the limit, a message over the limit is written alone
+        log.reset_mock()
+        buf.log('abc')
+        buf.log('x' * 20)
+        self.assertEqual(log.call_args_list,
+                         [mock.call('abc', level=None),
+                          mock.call('x' * 20, level=None)])
+        buf.log('def')
+        self.assertEqual(log.call_count, 2)
+        buf.flush()
+        log.assert_called_with('def', level=None)
+
+    @mock.patch.object(hooktools, 'FLUSH_SIZE', 12)
+    def test_flush_splits_runs(self, log):
+        buf = hooktools.LogBuffer()
+        buf.records = [('INFO', 'one'), ('INFO', 'x' * 20), ('INFO', 'two'),
+                       ('INFO', 'three')]
+        buf.flush()
+        self.assertEqual(log.call_args_list,
+                         [mock.call('one', level='INFO'),
+                          mock.call('x' * 20, level='INFO'),
+                          mock.call('two\nthree', level='INFO')])
+
+    @mock.patch.object(hooktools, 'atexit')
+    @mock.patch.object(hooktools, '_buffer', None)
+    def test_log(self, atexit, log):
+        hooktools.log('unbuffered', level='DEBUG')
+        log.assert_called_once_with('unbuffered', level='DEBUG')
+
+        hooktools.enable_log_buffer('VERBOSE')
+        log.assert_called_with('Unknown log level VERBOSE, using DEBUG',
+                               level='WARNING')
+        atexit.register.assert_called_once_with(hooktools._buffer.flush)
+        log.reset_mock()
+        hooktools.log('buffered', level='DEBUG')
+        log.assert_not_called()
+        hooktools._buffer.flush()
+        log.assert_called_once_with('buffered', level='DEBUG')
+
+
+@mock.patch.object(hooktools.hookenv, 'log', lambda *args, **kwargs: None)
+@mock.patch.object(hooktools.hookenv, 'status_set')
+class TestStatusBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        patcher = mock.patch.object(hooktools.unitdata, 'kv')
+        patcher.start().return_value = self.db
+        self.addCleanup(patcher.stop)
+
+    def test_flush(self, status_set):
+        buf = hooktools.StatusBuffer()
+        buf.set('maintenance', 'Setting up corosync')
+        buf.set('active', 'Unit is ready and clustered')
+        status_set.assert_not_called()
+        buf.flush()
+        status_set.assert_called_once_with('active',
+                                           'Unit is ready and clustered')
+
+        # the next hook ends with the same status
+        status_set.reset_mock()
+        buf.set('blocked', 'Oops')
+        buf.set('active', 'Unit is ready and clustered')
+        buf.flush()
+        buf.flush()
+        status_set.assert_not_called()
+
+    @mock.patch.object(hooktools, 'atexit')
+    @mock.patch.object(hooktools, '_status', None)
+    def test_status_set(self, atexit, status_set):
+        self.assertRaises(ValueError, hooktools.status_set, 'ready', '')
+        hooktools.status_set('maintenance', 'Paused')
+        status_set.assert_called_once_with('maintenance', 'Paused')
+        self.assertEqual(self.db.get(hooktools.STATUS_KEY),
+                         ['maintenance', 'Paused'])
+
+        hooktools.enable_status_buffer()
+        atexit.register.assert_called_once_with(hooktools._status.flush)
+        hooktools.status_set('maintenance', 'Installing apt packages')
+        hooktools.status_set('maintenance', 'Paused')
+        hooktools._status.flush()
+        status_set.assert_called_once_with('maintenance', 'Paused')
@@ -78,6 +78,10 @@ CRM_CONFIGURE_SHOW_XML_MAINT_MODE_TRUE = '''<?xml version="1.0" ?>
 class TestPcmk(unittest.TestCase):
     def setUp(self):
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False)
+        # the checksums, journal and metadata cache are committed by pcmk
+        patcher = mock.patch.object(unitdata, 'kv')
+        patcher.start().return_value = unitdata.Storage(':memory:')
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         os.remove(self.tmpfile.name)
@@ -177,6 +181,72 @@ class TestPcmk(unittest.TestCase):
                                               'maintenance-mode=false'],
                                              universal_newlines=True)
 
+    @mock.patch.object(pcmk.cluster_state, 'invalidate_snapshot')
+    @mock.patch.object(pcmk.subprocess, 'call')
+    def test_commit_invalidates_snapshot_after(self, call,
+                                               invalidate_snapshot):
+        calls = mock.Mock()
+        calls.attach_mock(call, 'call')
+        calls.attach_mock(invalidate_snapshot, 'invalidate_snapshot')
+        call.return_value = 0
+        self.assertEqual(pcmk.commit('crm -w -F configure delete res_foo'),
+                         0)
+        self.assertEqual(calls.mock_calls, [
+            mock.call.call(['crm', '-w', '-F', 'configure', 'delete',
+                            'res_foo']),
+            mock.call.invalidate_snapshot()])
+
+    @mock.patch.object(pcmk.cluster_state, 'invalidate_snapshot')
+    @mock.patch.object(pcmk.subprocess, 'check_call')
+    def test_set_property_invalidates_snapshot(self, check_call,
+                                               invalidate_snapshot):
+        check_call.side_effect = pcmk.subprocess.CalledProcessError(1, 'crm')
+        self.assertRaises(pcmk.subprocess.CalledProcessError,
+                          pcmk.set_property, 'maintenance-mode', 'true')
+        invalidate_snapshot.assert_called_once_with()
+
+    @mock.patch('subprocess.check_output')
+    def test_get_cluster_options(self, mock_check_output):
+        mock_check_output.return_value = CRM_CONFIGURE_SHOW_XML
+        options = pcmk.get_cluster_options()
+        self.assertEqual(options['property']['no-quorum-policy'], 'stop')
+        self.assertEqual(options['rsc_defaults'],
+                         {'resource-stickiness': '100'})
+        mock_check_output.assert_called_once_with(
+            ['crm', 'configure', 'show', 'xml'], universal_newlines=True)
+
+    @mock.patch.object(pcmk, 'commit')
+    @mock.patch('subprocess.check_output')
+    def test_update_cluster_options(self, mock_check_output, commit):
+        mock_check_output.return_value = CRM_CONFIGURE_SHOW_XML
+        commit.return_value = 0
+
+        # nothing to change, nothing written
+        self.assertEqual(pcmk.update_cluster_options(
+            properties={'no-quorum-policy': 'stop',
+                        'stonith-enabled': 'false'},
+            rsc_defaults={'resource-stickiness': 100}), 0)
+        self.assertFalse(commit.called)
+
+        self.assertEqual(pcmk.update_cluster_options(
+            properties={'cluster-recheck-interval': 60,
+                        'no-quorum-policy': 'ignore'},
+            rsc_defaults={'resource-stickiness': 100}), 0)
+        # only the changed properties are written, not the options of the
+        # set maintained by pacemaker such as dc-version
+        commit.assert_called_once_with(
+            'crm configure property cluster-recheck-interval=60 '
+            'no-quorum-policy=ignore')
+
+        commit.reset_mock()
+        commit.return_value = 1
+        self.assertEqual(pcmk.update_cluster_options(
+            properties={'stonith-enabled': 'true'},
+            rsc_defaults={'resource-stickiness': 200}), 1)
+        commit.assert_has_calls([
+            mock.call('crm configure property stonith-enabled=true'),
+            mock.call('crm configure rsc_defaults resource-stickiness=200')])
+
     @mock.patch('subprocess.call')
     def test_crm_update_resource(self, mock_call):
         mock_call.return_value = 0
@@ -222,7 +292,200 @@ class TestPcmk(unittest.TestCase):
         mock_call.assert_any_call(['crm', 'configure', 'load',
                                    'update', self.tmpfile.name])
 
+    @mock.patch('subprocess.call')
+    def test_crm_update_resource_checksums(self, mock_call):
+        mock_call.return_value = 0
+        db = unitdata.kv()
+        db.set('res_test-IPaddr2', 'ef395293b1b7c29c5bf1c99774f75cf4')
+        checksums = pcmk.resource_checksums({'res_test': 'IPaddr2',
+                                             'res_new': 'IPaddr2'})
+        self.assertEqual(checksums,
+                         {'res_test-IPaddr2':
+                          'ef395293b1b7c29c5bf1c99774f75cf4'})
+
+        pcmk.crm_update_resource('res_test', 'IPaddr2',
+                                 'params ip=1.2.3.4 cidr_netmask=255.0.0.0',
+                                 checksums=checksums)
+        self.assertNotIn(mock.call(['crm', 'configure', 'load', 'update',
+                                    mock.ANY]), mock_call.call_args_list)
+
+        with mock.patch.object(tempfile, "NamedTemporaryFile",
+                               side_effect=lambda: self.tmpfile):
+            pcmk.crm_update_resource('res_new', 'IPaddr2',
+                                     'params ip=1.2.3.5',
+                                     checksums=checksums)
+        mock_call.assert_any_call(['crm', 'configure', 'load',
+                                   'update', self.tmpfile.name])
+        # stored once all the resources were updated
+        self.assertIsNone(db.get('res_new-IPaddr2'))
+        self.assertEqual(pcmk.save_resource_checksums(checksums),
+                         ['res_new-IPaddr2'])
+        self.assertEqual(db.get('res_new-IPaddr2'),
+                         pcmk.resource_checksum('res_new', 'IPaddr2',
+                                                'params ip=1.2.3.5'))
+
     def test_resource_checksum(self):
         r = pcmk.resource_checksum('res_test', 'IPaddr2',
                                    'params ip=1.2.3.4 cidr_netmask=255.0.0.0')
         self.assertEqual(r, 'ef395293b1b7c29c5bf1c99774f75cf4')
+
+    def test_maas_stonith_primitive(self):
+        maas_nodes = [{'hostname': 'juju-0.maas',
+                       'power_type': 'redfish',
+                       'power_parameters': {'power_address': '10.0.0.100',
+                                            'power_user': 'admin',
+                                            'power_pass': 'secret'}},
+                      {'hostname': 'juju-1.maas',
+                       'power_type': 'amt',
+                       'power_parameters': {'power_address': '10.0.0.101'}}]
+        rsc, constraint = pcmk.maas_stonith_primitive(
+            maas_nodes, 'juju-0', {'redfish': {'power_timeout': 30}})
+        self.assertTrue(rsc.startswith('primitive res_stonith_juju-0 '
+                                       'stonith:fence_redfish '))
+        self.assertIn(' power_timeout=30', rsc)
+        self.assertEqual(constraint,
+                         'location const_loc_stonith_avoid_juju-0 '
+                         'res_stonith_juju-0 -inf: juju-0')
+
+        with mock.patch.object(pcmk, 'log'):
+            self.assertEqual(pcmk.maas_stonith_primitive(maas_nodes,
+                                                         'juju-1'),
+                             (False, False))
+        self.assertEqual(pcmk.maas_stonith_primitive(maas_nodes, 'juju-2'),
+                         (False, False))
+
+    @mock.patch.object(pcmk, 'log', lambda *args, **kwargs: None)
+    @mock.patch.object(pcmk, 'commit')
+    def test_apply_journal(self, commit):
+        db = unitdata.Storage(':memory:')
+        plan = {'resources': {'res_foo': 'ocf:heartbeat:IPaddr2'}}
+        # the hook fails on the second change
+        commit.side_effect = [0, 1]
+        journal = pcmk.ApplyJournal(plan, db)
+        self.assertEqual(journal.commit('primitive:res_foo', 'crm foo'), 0)
+        self.assertEqual(journal.commit('cleanup:res_foo', 'crm bar'), 1)
+        db.flush(False)
+
+        # and the retry only makes the change which failed
+        commit.reset_mock()
+        commit.side_effect = None
+        commit.return_value = 0
+        journal = pcmk.ApplyJournal(plan, db)
+        self.assertTrue(journal.applied('primitive:res_foo'))
+        journal.commit('primitive:res_foo', 'crm foo')
+        journal.commit('cleanup:res_foo', 'crm bar')
+        commit.assert_called_once_with('crm bar')
+
+        # new relation data starts a new plan
+        journal = pcmk.ApplyJournal({'resources': {}}, db)
+        self.assertFalse(journal.applied('primitive:res_foo'))
+        journal.complete()
+        self.assertIsNone(db.get(pcmk.APPLY_JOURNAL_KEY))
+
+    @mock.patch.object(pcmk, 'log', lambda *args, **kwargs: None)
+    @mock.patch.object(pcmk, 'commit')
+    def test_apply_journal_no_wait(self, commit):
+        commit.return_value = 0
+        journal = pcmk.ApplyJournal({}, unitdata.Storage(':memory:'),
+                                    wait=False)
+        journal.commit('primitive:res_foo',
+                       'crm -w -F configure primitive res_foo IPaddr2')
+        journal.commit('stop:res_bar', 'crm -w -F resource stop res_bar',
+                       wait=True)
+        self.assertEqual(commit.call_args_list,
+                         [mock.call('crm -F configure primitive res_foo '
+                                    'IPaddr2'),
+                          mock.call('crm -w -F resource stop res_bar')])
+
+    @mock.patch.object(pcmk, 'log', lambda *args, **kwargs: None)
+    @mock.patch.object(pcmk.cluster_state, '_run')
+    @mock.patch('subprocess.call')
+    def test_wait_for_resources(self, call, _run):
+        call.return_value = 0
+        _run.return_value = (
+            '<crm_mon><resources>'
+            '<resource id="res_foo" active="true" failed="false"/>'
+            '<resource id="res_bar" active="true" failed="true"/>'
+            '</resources></crm_mon>')
+        self.assertEqual(pcmk.wait_for_resources(['res_foo', 'res_bar',
+                                                  'res_baz'], 300),
+                         ['res_bar', 'res_baz'])
+        call.assert_called_once_with(['crm_resource', '--wait',
+                                      '--timeout', '300s'])
+
+        # crm_mon output that can't be parsed
+        _run.return_value = '<crm_mon>'
+        self.assertEqual(pcmk.wait_for_resources(['res_foo'], 300),
+                         ['res_foo'])
+
+    def test_parse_params(self):
+        self.assertEqual(
+            pcmk.parse_params('params ip="10.0.0.1" cidr_netmask=24 '
+                              'op monitor interval=10s meta a=b '
+                              'params nic="eth 0"'),
+            {'ip': '10.0.0.1', 'cidr_netmask': '24', 'nic': 'eth 0'})
+        self.assertEqual(pcmk.parse_params('ip=10.0.0.1'), {'ip': '10.0.0.1'})
+        self.assertEqual(pcmk.parse_params(None), {})
+        self.assertRaises(ValueError, pcmk.parse_params, 'params ip="1')
+
+    @mock.patch.object(pcmk, 'file_hash')
+    @mock.patch.object(pcmk.subprocess, 'check_output')
+    def test_validate_resource_params(self, check_output, file_hash):
+        file_hash.return_value = 'v1'
+        check_output.return_value = (
+            '<resource-agent name="IPaddr2"><parameters>'
+            '<parameter name="ip" required="1"><content type="string"/>'
+            '</parameter>'
+            '<parameter name="nic"><content type="string" default=""/>'
+            '</parameter>'
+            '</parameters></resource-agent>')
+
+        self.assertEqual(
+            pcmk.validate_resource_params('IPaddr2', 'params ip=10.0.0.1 '
+                                                     'op monitor foo=bar'),
+            [])
+        self.assertEqual(
+            pcmk.validate_resource_params('ocf:heartbeat:IPaddr2',
+                                          'params nic=eth0 netmask=24'),
+            ['unknown parameters for ocf:heartbeat:IPaddr2: netmask',
+             'missing required parameters for ocf:heartbeat:IPaddr2: ip'])
+        # deployed before the validation, only logged
+        self.assertEqual(
+            pcmk.validate_resource_params('IPaddr2', 'params ip=10.0.0.1 '
+                                                     'netmask=24',
+                                          existing=True),
+            [])
+        self.assertEqual(
+            pcmk.validate_resource_params('IPaddr2', 'params netmask=24',
+                                          existing=True),
+            ['missing required parameters for ocf:heartbeat:IPaddr2: ip'])
+        # the metadata is read once per version of the agent
+        check_output.assert_called_once_with(
+            ['crm_resource', '--show-metadata', 'ocf:heartbeat:IPaddr2'],
+            universal_newlines=True)
+        file_hash.assert_called_with(
+            '/usr/lib/ocf/resource.d/heartbeat/IPaddr2', 'sha256')
+        file_hash.return_value = 'v2'
+        pcmk.validate_resource_params('IPaddr2', 'params ip=10.0.0.1')
+        self.assertEqual(check_output.call_count, 2)
+
+        # the cached metadata of all the agents is read at once
+        cache = pcmk.cached_agent_metadata()
+        self.assertEqual(list(cache), ['ocf:heartbeat:IPaddr2'])
+        with mock.patch.object(unitdata.kv(), 'get') as get:
+            self.assertEqual(
+                pcmk.validate_resource_params('IPaddr2', 'params ip=10.0.0.1',
+                                              cache=cache),
+                [])
+            get.assert_not_called()
+        self.assertEqual(check_output.call_count, 2)
+        pcmk.clear_agent_metadata()
+        self.assertEqual(pcmk.cached_agent_metadata(), {})
+
+        self.assertEqual(
+            pcmk.validate_resource_params('lsb:haproxy', 'params foo=bar'),
+            [])
+        file_hash.return_value = None
+        self.assertEqual(
+            pcmk.validate_resource_params('ocf:foo:bar', 'params foo=bar'),
+            [])
@@ -0,0 +1,217 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import subprocess
+import unittest
+
+import stonith
+
+
+CIB_RESOURCES_XML = '''<resources>
+  <primitive id="res_stonith_juju-1" class="stonith" type="external/ipmi">
+    <instance_attributes id="res_stonith_juju-1-instance_attributes">
+      <nvpair name="hostname" value="juju-1" id="a1"/>
+      <nvpair name="ipaddr" value="10.0.0.101" id="a2"/>
+      <nvpair name="userid" value="admin" id="a3"/>
+      <nvpair name="passwd" value="secret" id="a4"/>
+      <nvpair name="interface" value="lan" id="a5"/>
+    </instance_attributes>
+  </primitive>
+  <primitive id="res_stonith_juju-0" class="stonith" type="external/ipmi">
+    <instance_attributes id="res_stonith_juju-0-instance_attributes">
+      <nvpair name="hostname" value="juju-0" id="b1"/>
+      <nvpair name="ipaddr" value="10.0.0.100" id="b2"/>
+      <nvpair name="userid" value="admin" id="b3"/>
+      <nvpair name="passwd" value="secret" id="b4"/>
+    </instance_attributes>
+  </primitive>
+  <primitive id="res_vip" class="ocf" provider="heartbeat" type="IPaddr2"/>
+</resources>
+'''
+
+
+class TestStonith(unittest.TestCase):
+
+    def test_parse_fencing_devices(self):
+        devices = stonith.parse_fencing_devices(CIB_RESOURCES_XML)
+        self.assertEqual([d.resource for d in devices],
+                         ['res_stonith_juju-0', 'res_stonith_juju-1'])
+        self.assertEqual(devices[0].node, 'juju-0')
+        self.assertEqual(devices[0].agent, 'external/ipmi')
+        self.assertEqual(devices[0].params['ipaddr'], '10.0.0.100')
+
+    @mock.patch('subprocess.check_output')
+    def test_probe_device_ipmi(self, check_output):
+        check_output.return_value = 'Chassis Power is on\n'
+        device = stonith.parse_fencing_devices(CIB_RESOURCES_XML)[1]
+        self.assertEqual(stonith.probe_device(device, timeout=4),
+                         {'resource': 'res_stonith_juju-1',
+                          'healthy': True,
+                          'message': 'Chassis Power is on'})
+        args, kwargs = check_output.call_args
+        self.assertEqual(args[0], ['ipmitool', '-I', 'lan',
+                                   '-H', '10.0.0.101', '-U', 'admin', '-E',
+                                   '-N', '2', '-R', '1',
+                                   'chassis', 'power', 'status'])
+        self.assertEqual(kwargs['timeout'], 4)
+        self.assertEqual(kwargs['env']['IPMI_PASSWORD'], 'secret')
+
+    @mock.patch.object(stonith, 'log')
+    @mock.patch('subprocess.check_output')
+    def test_probe_device_ipmi_missing_params(self, check_output, log):
+        device = stonith.FencingDevice('res_stonith_juju-2', 'juju-2',
+                                       'external/ipmi', {'passwd': 'secret'})
+        self.assertEqual(stonith.probe_devices([device]),
+                         {'juju-2': {'resource': 'res_stonith_juju-2',
+                                     'healthy': False,
+                                     'message': 'missing ipaddr, userid'}})
+        check_output.assert_not_called()
+
+    @mock.patch.object(stonith, 'log')
+    @mock.patch('subprocess.check_output')
+    def test_probe_device_timeout(self, check_output, log):
+        check_output.side_effect = subprocess.TimeoutExpired('ipmitool', 4)
+        device = stonith.parse_fencing_devices(CIB_RESOURCES_XML)[0]
+        res = stonith.probe_device(device, timeout=4)
+        self.assertFalse(res['healthy'])
+        self.assertEqual(res['message'], 'no answer after 4s')
+
+    @mock.patch.object(stonith, 'log')
+    @mock.patch('subprocess.check_output')
+    def test_probe_devices(self, check_output, log):
+        def fake_check_output(cmd, **kwargs):
+            if '10.0.0.100' in cmd:
+                raise subprocess.CalledProcessError(
+                    1, cmd, output='Error: Unable to establish LAN session\n')
+            return 'Chassis Power is on\n'
+
+        check_output.side_effect = fake_check_output
+        devices = stonith.parse_fencing_devices(CIB_RESOURCES_XML)
+        results = stonith.probe_devices(devices)
+        self.assertEqual(sorted(results), ['juju-0', 'juju-1'])
+        self.assertEqual(results['juju-0']['message'],
+                         'Error: Unable to establish LAN session')
+        self.assertEqual(stonith.unhealthy_nodes(results), ['juju-0'])
+
+    @mock.patch.object(stonith, 'probe_devices')
+    @mock.patch.object(stonith, 'list_fencing_devices')
+    @mock.patch.object(stonith.unitdata, 'kv')
+    @mock.patch.object(stonith.time, 'time')
+    def test_check_fencing_devices_cache(self, time, kv, list_devices,
+                                         probe_devices):
+        store = {}
+        kv.return_value.get.side_effect = lambda k: store.get(k)
+        kv.return_value.set.side_effect = lambda k, v: store.update({k: v})
+        probe_devices.return_value = {'juju-0': {'healthy': True}}
+
+        time.return_value = 1000
+        stonith.check_fencing_devices()
+        self.assertEqual(probe_devices.call_count, 1)
+
+        # Cached results are used until they expire
+        time.return_value = 1000 + stonith.STONITH_HEALTH_TTL - 1
+        self.assertEqual(stonith.check_fencing_devices(),
+                         {'juju-0': {'healthy': True}})
+        self.assertEqual(probe_devices.call_count, 1)
+        stonith.check_fencing_devices(force=True)
+        self.assertEqual(probe_devices.call_count, 2)
+
+        time.return_value = 2000 + stonith.STONITH_HEALTH_TTL
+        stonith.check_fencing_devices()
+        self.assertEqual(probe_devices.call_count, 3)
+        self.assertEqual(stonith.cached_fencing_health(),
+                         {'juju-0': {'healthy': True}})
+
+
+class TestStonithBackends(unittest.TestCase):
+
+    def test_ipmi_primitive(self):
+        rsc, constraint = stonith.get_backend('ipmi').primitive(
+            'juju-0', {'power_address': '10.0.0.100',
+                       'power_user': 'admin',
+                       'power_pass': 'secret',
+                       'power_driver': 'LAN_2_0'})
+        self.assertEqual(rsc,
+                         'primitive res_stonith_juju-0 stonith:fence_ipmilan '
+                         'params pcmk_host_list=juju-0 ipaddr=10.0.0.100 '
+                         'login=admin passwd=secret lanplus=1 '
+                         'login_timeout=5 power_timeout=10 shell_timeout=5')
+        self.assertEqual(constraint,
+                         'location const_loc_stonith_avoid_juju-0 '
+                         'res_stonith_juju-0 -inf: juju-0')
+
+    def test_redfish_primitive_timeouts(self):
+        rsc, _ = stonith.get_backend('redfish').primitive(
+            'juju-0', {'power_address': '10.0.0.100',
+                       'power_user': 'admin',
+                       'power_pass': 'secret',
+                       'node_id': '1'},
+            timeouts={'power_timeout': 30})
+        self.assertEqual(rsc,
+                         'primitive res_stonith_juju-0 stonith:fence_redfish '
+                         'params pcmk_host_list=juju-0 ipaddr=10.0.0.100 '
+                         'login=admin passwd=secret ssl_insecure=1 '
+                         'systems_uri=/redfish/v1/Systems/1 '
+                         'login_timeout=10 power_timeout=30 shell_timeout=10')
+
+    def test_virsh_primitive(self):
+        rsc, _ = stonith.get_backend('virsh').primitive(
+            'juju-0', {'power_address': 'qemu+ssh://ubuntu@10.0.0.1/system',
+                       'power_id': 'juju-0-vm'})
+        self.assertIn('stonith:fence_virsh params pcmk_host_list=juju-0 '
+                      'ipaddr=10.0.0.1 login=ubuntu port=juju-0-vm ', rsc)
+
+    @mock.patch.object(stonith, 'log')
+    def test_virsh_primitive_local_uri(self, log):
+        self.assertEqual(stonith.get_backend('virsh').primitive(
+            'juju-0', {'power_address': 'qemu:///system',
+                       'power_id': 'juju-0-vm'}), (False, False))
+        log.assert_called_once_with(mock.ANY, level=stonith.ERROR)
+
+    @mock.patch.object(stonith, 'log')
+    def test_backend_without_agent_params(self, log):
+        self.assertEqual(stonith.StonithBackend().primitive('juju-0', {}),
+                         (False, False))
+        log.assert_called_once_with(mock.ANY, level=stonith.ERROR)
+
+    def test_get_backend_unsupported(self):
+        self.assertIsNone(stonith.get_backend('amt'))
+
+    def test_parse_timeouts(self):
+        self.assertEqual(stonith.parse_timeouts(None), {})
+        self.assertEqual(
+            stonith.parse_timeouts('redfish:power_timeout=30 '
+                                   'redfish:login_timeout=5 '
+                                   'ipmi:login_timeout=3'),
+            {'redfish': {'power_timeout': 30, 'login_timeout': 5},
+             'ipmi': {'login_timeout': 3}})
+        self.assertRaises(ValueError, stonith.parse_timeouts,
+                          'power_timeout=30')
+        self.assertRaises(ValueError, stonith.parse_timeouts,
+                          'ipmi:power_timeout=soon')
+
+    @mock.patch('subprocess.check_output')
+    def test_probe_fence_agent(self, check_output):
+        check_output.return_value = 'Status: ON\n'
+        device = stonith.FencingDevice(
+            'res_stonith_juju-0', 'juju-0', 'fence_ipmilan',
+            {'pcmk_host_list': 'juju-0', 'ipaddr': '10.0.0.100',
+             'login': 'admin', 'passwd': 'secret', 'lanplus': '1'})
+        self.assertTrue(stonith.probe_device(device, timeout=5)['healthy'])
+        args, kwargs = check_output.call_args
+        self.assertEqual(args[0], ['fence_ipmilan'])
+        self.assertEqual(kwargs['input'],
+                         'action=monitor\nipaddr=10.0.0.100\nlanplus=1\n'
+                         'login=admin\npasswd=secret\n')
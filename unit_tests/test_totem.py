@@ -0,0 +1,65 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import subprocess
+import unittest
+
+import totem
+
+PING_OUTPUT = '''PING 10.0.0.2 (10.0.0.2) 56(84) bytes of data.
+
+--- 10.0.0.2 ping statistics ---
+5 packets transmitted, 5 received, 0% packet loss, time 802ms
+rtt min/avg/max/mdev = 0.310/0.402/1.520/0.102 ms
+'''
+
+
+class TestTotem(unittest.TestCase):
+
+    def test_parse_ping_rtt(self):
+        self.assertEqual(totem.parse_ping_rtt(PING_OUTPUT), 1.52)
+        self.assertIsNone(totem.parse_ping_rtt(''))
+
+    @mock.patch.object(totem, 'log')
+    @mock.patch('subprocess.check_output')
+    def test_measure_rtt(self, check_output, log):
+        def fake_ping(cmd, **kwargs):
+            if cmd[-1] == '10.0.0.3':
+                raise subprocess.CalledProcessError(1, cmd, output='')
+            if cmd[-1] == '10.0.0.4':
+                return PING_OUTPUT.replace('1.520', '7.250')
+            return PING_OUTPUT
+
+        check_output.side_effect = fake_ping
+        self.assertEqual(
+            totem.measure_rtt(['10.0.0.2', '10.0.0.3', '10.0.0.4']), 7.25)
+        self.assertIsNone(totem.measure_rtt([]))
+        check_output.assert_any_call(
+            ['ping', '-q', '-n', '-c', '5', '-i', '0.2', '-W', '1',
+             '10.0.0.2'], stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def test_totem_settings(self):
+        self.assertEqual(totem.totem_settings('default', 3),
+                         totem.PROFILES['default'])
+        self.assertEqual(totem.totem_settings('low-latency', 3)['token'],
+                         1000)
+        # a fast network keeps the profile's token
+        self.assertEqual(totem.totem_settings('low-latency', 3, 0.5)['token'],
+                         1000)
+        # a slow one stretches it, consensus follows
+        settings = totem.totem_settings('low-latency', 3, 25.3)
+        self.assertEqual(settings['token'], 1600)
+        self.assertEqual(settings['consensus'], 1920)
+        self.assertRaises(KeyError, totem.totem_settings, 'fast', 3)
@@ -0,0 +1,109 @@
+# Copyright 2019 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import unitstate
+
+from charmhelpers.core import unitdata
+
+
+class TestUnitState(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+
+    def query_plan(self, query, params):
+        self.db.cursor.execute('explain query plan ' + query, params)
+        return ' '.join(row[-1] for row in self.db.cursor.fetchall())
+
+    def test_getrange(self):
+        self.db.update({'rels.a': 1, 'rels.b': 2, 'relsx': 3, 'RELS.c': 4})
+        self.assertEqual(unitstate.getrange(self.db, 'rels.', strip=True),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(len(unitstate.getrange(self.db, '')), 4)
+        with self.db.hook_scope('test'):
+            unitstate.unsetrange(self.db, 'rels.')
+        self.assertEqual(sorted(unitstate.getrange(self.db, '')),
+                         ['RELS.c', 'relsx'])
+        self.assertEqual([h[2] for h in self.db.gethistory('rels.%')],
+                         ['"DELETED"'])
+
+    def test_getrange_uses_index(self):
+        where, params = unitstate._prefix_clause('rels.')
+        self.assertEqual(params, ['rels.', 'rels/'])
+        self.assertIn('USING INDEX',
+                      self.query_plan('select key, data from kv where ' +
+                                      where, params))
+
+    def test_bulk(self):
+        keys = ['res_{}'.format(i) for i in range(1200)]
+        with self.db.hook_scope('test'):
+            changed = unitstate.setmany(
+                self.db, {k: i for i, k in enumerate(keys)}, prefix='c-')
+            self.assertEqual(len(changed), 1200)
+            # unchanged values aren't written again
+            self.assertEqual(unitstate.setmany(self.db, {'res_2': 2},
+                                               prefix='c-'), [])
+        values = unitstate.getmany(self.db, keys + ['res_missing'],
+                                   prefix='c-')
+        self.assertEqual(len(values), 1200)
+        self.assertEqual(values['res_2'], 2)
+        self.assertEqual(self.db.get('c-res_2'), 2)
+        self.assertEqual([h[2] for h in self.db.gethistory('c-res_1')],
+                         ['1'])
+
+    def test_prune(self):
+        for i in range(5):
+            with self.db.hook_scope('update-status'):
+                self.db.set('env', i)
+        self.assertEqual(unitstate.prune(self.db, keep=2), 3)
+        self.assertEqual([h[0] for h in self.db.gethistory('env')], [4, 5])
+        self.assertEqual(self.db.get('env'), 4)
+        with self.db.hook_scope('update-status'):
+            self.db.set('env', 5)
+            # the revision of the current hook is kept
+            self.assertEqual(unitstate.prune(self.db, keep=0), 2)
+        self.assertEqual([h[0] for h in self.db.gethistory('env')], [6])
+        self.assertIn('USING INDEX kv_revisions_revision',
+                      self.query_plan('delete from kv_revisions '
+                                      'where revision <= ?', [1]))
+
+    def test_vacuum(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = unitdata.Storage(os.path.join(tmpdir, 'state.db'))
+        self.addCleanup(db.close)
+        unitstate.setmany(db, {str(i): 'x' * 1024 for i in range(200)})
+        db.flush()
+        size = os.path.getsize(os.path.join(tmpdir, 'state.db'))
+        db.unsetrange([str(i) for i in range(200)])
+        unitstate.vacuum(db)
+        self.assertLess(os.path.getsize(os.path.join(tmpdir, 'state.db')),
+                        size)
+
+    def test_enable_wal(self):
+        self.assertEqual(unitstate.enable_wal(self.db), 'memory')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = unitdata.Storage(os.path.join(tmpdir, 'state.db'))
+        self.addCleanup(db.close)
+        self.assertEqual(unitstate.enable_wal(db), 'wal')
+        db.set('key', 'value')
+        db.flush()
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'state.db-wal')))